@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Mobile Map Downloader - Download maps for your mobile phone.
+
+The program's logging is set up here once, for all modules of the package.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+
+
+#Set up logging fore useful debug output, and time stamps in UTC.
+import logging
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
+                    level=logging.DEBUG)
+#Time stamps must be in UTC
+logging.Formatter.converter = time.gmtime
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+On-disk catalog of the maps, that are available on the servers.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+import logging
+import datetime
+import threading
+import sqlite3
+
+from mob_map_dl.common import MapMeta, literal_prefix
+
+
+def fnmatch_to_glob(pattern):
+    """
+    Convert a shell wildcard pattern (see module ``fnmatch``) to a pattern
+    for SQLite's ``GLOB`` operator. Only the negated character sets differ:
+    "[!abc]" becomes "[^abc]".
+    """
+    return pattern.replace("[!", "[^")
+
+
+def format_time(date_time):
+    """Convert a ``datetime`` to a string, that sorts like the dates."""
+    if date_time is None:
+        return None
+    return date_time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_time(time_str):
+    """Convert a string from ``format_time`` back to a ``datetime``."""
+    if time_str is None:
+        return None
+    return datetime.datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
+
+
+class MapCatalog(object):
+    """
+    Catalog of the maps, that are available on the servers, stored in an
+    SQLite database. It contains the maps of all downloaders (sources).
+
+    The maps are grouped by the HTML pages from which they were parsed.
+    For each page the validators (``ETag``, ``Last-Modified``), and the time
+    of the last download are stored too. When a page has changed, only the
+    maps that have changed are written. Queries for patterns, sizes and
+    dates are performed by the database, with the help of indexes.
+
+    The database is opened when it is first needed. All methods are thread
+    safe.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS pages (
+            source TEXT NOT NULL,
+            url TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL NOT NULL,
+            PRIMARY KEY (source, url));
+        CREATE TABLE IF NOT EXISTS maps (
+            source TEXT NOT NULL,
+            page_url TEXT NOT NULL,
+            disp_name TEXT NOT NULL,
+            name_low TEXT NOT NULL,
+            page_index INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            full_name TEXT,
+            size REAL,
+            time TEXT,
+            description TEXT,
+            map_type TEXT,
+            PRIMARY KEY (source, page_url, disp_name));
+        CREATE INDEX IF NOT EXISTS maps_name ON maps (source, name_low);
+        CREATE INDEX IF NOT EXISTS maps_source
+            ON maps (source, page_index, position);
+        CREATE INDEX IF NOT EXISTS maps_size ON maps (size);
+        CREATE INDEX IF NOT EXISTS maps_time ON maps (time);
+        """
+    map_columns = ("page_index, position, disp_name, full_name, size, time, "
+                   "description, map_type")
+
+    def __init__(self, db_path):
+        """
+        db_path: str
+            Path of the database file, or ":memory:" for a catalog that only
+            exists in memory.
+        """
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = None
+
+    def connect(self):
+        """Open the database, and create the tables. Lock must be held."""
+        if self.conn is None:
+            try:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                conn.executescript(self.schema)
+            except sqlite3.Error, err:
+                #Directory not writable, or file damaged: work in memory.
+                logging.debug("Can't open catalog %s: %s", self.db_path, err)
+                conn = sqlite3.connect(":memory:", check_same_thread=False)
+                conn.executescript(self.schema)
+            conn.text_factory = str
+            self.conn = conn
+        return self.conn
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def get_pages(self, source):
+        """
+        Return the stored pages of a source.
+
+        Returns
+        -------
+
+        dict[str:dict[str:object]]
+            ``{url: page}``, page has keys: "etag", "last_modified",
+            "fetched" (time of the last download in seconds since the epoch).
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT url, etag, last_modified, fetched FROM pages "
+                "WHERE source = ?", (source,)).fetchall()
+        return {url: {"etag": etag, "last_modified": last_modified,
+                      "fetched": fetched}
+                for url, etag, last_modified, fetched in rows}
+
+    def touch_page(self, source, url, fetched=None):
+        """Mark a page as fresh: it has not changed on the server."""
+        fetched = time.time() if fetched is None else fetched
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute("UPDATE pages SET fetched = ? "
+                             "WHERE source = ? AND url = ?",
+                             (fetched, source, url))
+
+    def update_page(self, source, url, page_index, etag, last_modified,
+                    map_metas):
+        """
+        Store a page, that has been downloaded and parsed. Only maps that
+        have been added, changed or removed are written to the database.
+
+        Arguments
+        ---------
+
+        source: str
+            Name of the downloader, the page belongs to.
+
+        url: str
+            URL of the page.
+
+        page_index: int
+            Position of the page in the source's list of pages. Maps are
+            returned in the order of the pages, and in the order in which
+            they appear on the page.
+
+        etag, last_modified: str | NoneType
+            Validators of the page, for conditional requests.
+
+        map_metas: list[MapMeta]
+            The maps on the page.
+            
+        Returns
+        -------
+        
+        bool
+            ``True`` if maps have been added, changed or removed.
+        """
+        new_rows = {}
+        for position, meta in enumerate(map_metas):
+            new_rows[meta.disp_name] = (
+                            page_index, position, meta.disp_name,
+                            meta.full_name, float(meta.size),
+                            format_time(meta.time), meta.description,
+                            meta.map_type)
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                old_rows = {row[2]: row for row in conn.execute(
+                    "SELECT " + self.map_columns + " FROM maps "
+                    "WHERE source = ? AND page_url = ?", (source, url))}
+                removed = [(source, url, name) for name in old_rows
+                           if name not in new_rows]
+                changed = [(source, url, row[2].lower()) + row
+                           for name, row in new_rows.iteritems()
+                           if old_rows.get(name) != row]
+                conn.executemany("DELETE FROM maps WHERE source = ? AND "
+                                 "page_url = ? AND disp_name = ?", removed)
+                conn.executemany("INSERT OR REPLACE INTO maps (source, "
+                                 "page_url, name_low, " + self.map_columns +
+                                 ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 changed)
+                conn.execute("INSERT OR REPLACE INTO pages (source, url, "
+                             "etag, last_modified, fetched) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (source, url, etag, last_modified, time.time()))
+        logging.debug("Catalog: %s: %d maps changed, %d removed.",
+                      url, len(changed), len(removed))
+        return bool(changed or removed)
+
+    def remove_other_pages(self, source, urls):
+        """
+        Remove the pages of ``source``, that are not in ``urls``. Returns
+        ``True`` if pages have been removed.
+        """
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                old_urls = set(self.get_pages(source).keys()) - set(urls)
+                for url in old_urls:
+                    conn.execute("DELETE FROM maps WHERE source = ? AND "
+                                 "page_url = ?", (source, url))
+                    conn.execute("DELETE FROM pages WHERE source = ? AND "
+                                 "url = ?", (source, url))
+        return bool(old_urls)
+
+    def query(self, source, pattern=None, min_size=None, max_size=None,
+              newer_than=None, older_than=None):
+        """
+        Return the maps of a source, that match all conditions.
+
+        Arguments
+        ---------
+
+        source: str
+            Name of the downloader.
+
+        pattern: str | NoneType
+            Shell wildcard pattern for the canonical names of the maps.
+            Matching is not case sensitive.
+
+        min_size, max_size: float | NoneType
+            Limits for the size of the maps. [Byte]
+
+        newer_than, older_than: datetime.datetime | NoneType
+            Limits for the dates of the maps.
+
+        Returns
+        -------
+
+        list[MapMeta]
+            Sorted by name if a pattern is given, otherwise in the order of
+            the pages.
+        """
+        conditions = ["source = ?"]
+        args = [source]
+        if pattern is not None:
+            pattern = pattern.lower()
+            conditions.append("name_low GLOB ?")
+            args.append(fnmatch_to_glob(pattern))
+            #SQLite can't use the index for ``GLOB ?``; search the names 
+            #with the literal prefix explicitly.
+            prefix = literal_prefix(pattern)
+            if prefix:
+                conditions.append("name_low >= ?")
+                args.append(prefix)
+            if prefix and prefix[-1] != "\xff":
+                conditions.append("name_low < ?")
+                args.append(prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if min_size is not None:
+            conditions.append("size >= ?")
+            args.append(min_size)
+        if max_size is not None:
+            conditions.append("size <= ?")
+            args.append(max_size)
+        if newer_than is not None:
+            conditions.append("time > ?")
+            args.append(format_time(newer_than))
+        if older_than is not None:
+            conditions.append("time < ?")
+            args.append(format_time(older_than))
+        order = "page_index, position"
+        if pattern is not None:
+            order = "name_low, " + order
+
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT disp_name, full_name, size, time, description, "
+                "map_type FROM maps WHERE " + " AND ".join(conditions) +
+                " ORDER BY " + order, args).fetchall()
+        return [MapMeta(disp_name=disp_name, full_name=full_name, size=size,
+                        time=parse_time(time_str), description=description,
+                        map_type=map_type)
+                for disp_name, full_name, size, time_str, description,
+                    map_type in rows]
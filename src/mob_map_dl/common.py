@@ -27,24 +27,23 @@ Common functionality for all modules.
 from __future__ import division
 from __future__ import absolute_import              
 
-import time
+import logging
 from collections import namedtuple
 import sys
 import os
 import os.path as path
 import platform
-
-
-#Set up logging fore useful debug output, and time stamps in UTC.
-import logging
-logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
-                    level=logging.DEBUG)
-#Time stamps must be in UTC
-logging.Formatter.converter = time.gmtime
+import threading
+import Queue
+import re
+import fnmatch
 
 
 VERSION = "0.1.12"
 #Version of the program
+MAP_HASH_SUFFIX = ".sha256.json"
+#The SHA-256 hash of an installed map is stored in a file next to the map,
+#with this suffix. See: ``BaseManager.read_map_hash``
 
 
 MapMeta = namedtuple("MapMeta", 
@@ -122,8 +121,321 @@ class TextProgressBar(object):
         
         self.num_backspace = None
         self.anim_frame_i = None
+
+
+class MultiProgressBar(object):
+    """
+    A progress bar for several concurrent transfers on the console.
+
+    A single line shows the sum of the values of all transfers. When a
+    transfer is finished a line with its final message is printed, above the
+    line with the sum.
+
+    Each transfer gets its own progress bar from ``make_bar``. These objects
+    have the same interface as ``TextProgressBar``, and can be used in its
+    place. All methods are thread safe.
+
+    Usage::
+
+        progress = MultiProgressBar("Downloading", val_max=total_size)
+        bar = progress.make_bar("osmand/Monaco_europe_2.obf", size)
+        bar.update_val(1000)
+        bar.update_final(size, "Downloaded")
+        progress.update_final("Finished")
+    """
+    def __init__(self, text, val_max):
+        """
+        text: str
+            Constant text of the line with the sum.
+
+        val_max: int | float
+            Sum of the maximum values of all transfers, used for computing
+            percent. Transfers that are created with ``make_bar`` can increase
+            this value.
+        """
+        self.text = text
+        self.val_max = val_max
+        self.lock = threading.Lock()
+        self.bar_values = {}
+        #Current value of each unfinished transfer: {id(bar): value}
+        self.val_finished = 0
+        #Sum of values of the finished transfers
+        self.max_known = 0
+        #Sum of maximum values of all transfers, that have been created
+        self.num_finished = 0
+        self.num_backspace = 0
+        self.anim_frames = "\|/-"
+        self.anim_frame_i = 0
+
+    def make_bar(self, text, val_max):
+        """
+        Create progress bar for an individual transfer. Has the same
+        signature as the constructor of ``TextProgressBar``.
+        """
+        with self.lock:
+            self.max_known += val_max
+            self.val_max = max(self.val_max, self.max_known)
+        return _PartialProgressBar(self, text, val_max)
+
+    def _print_line(self, msg, final):
+        """Print (and overwrite) the line with the sum. Lock must be held."""
+        padding = " " * max(self.num_backspace - 1 - len(msg), 0)
+        if final:
+            print chr(8) * self.num_backspace + msg + padding
+            self.num_backspace = 0
+        else:
+            print chr(8) * self.num_backspace + msg + padding,
+            sys.stdout.flush()
+            self.num_backspace = len(msg) + len(padding) + 1
+
+    def _sum_msg(self):
+        """Create text of the line with the sum. Lock must be held."""
+        val_sum = self.val_finished + sum(self.bar_values.values())
+        if self.val_max:
+            val_msg = "{:3.1f}%".format(val_sum / self.val_max * 100)
+        else:
+            val_msg = "{}".format(val_sum)
+        return "{text} - {val} - {act} active, {fin} finished".format(
+                        text=self.text, val=val_msg, act=len(self.bar_values),
+                        fin=self.num_finished)
+
+    def _update_bar(self, bar, value):
+        """Update the value of one transfer, and redraw the line with the sum."""
+        with self.lock:
+            self.bar_values[id(bar)] = value
+            self.anim_frame_i = (self.anim_frame_i + 1) % len(self.anim_frames)
+            msg = self._sum_msg() + "  [{}]".format(
+                                            self.anim_frames[self.anim_frame_i])
+            self._print_line(msg, final=False)
+
+    def _finish_bar(self, bar, value, msg):
+        """
+        Finish one transfer: Print its final message, and redraw the line with
+        the sum below it.
+        """
+        with self.lock:
+            self.bar_values.pop(id(bar), None)
+            self.val_finished += value
+            self.num_finished += 1
+            self._print_line(msg, final=True)
+            self._print_line(self._sum_msg(), final=False)
+
+    def print_message(self, msg):
+        """
+        Print a message above the line with the sum, while transfers are
+        running, and redraw the line with the sum below it.
+        """
+        with self.lock:
+            self._print_line(msg, final=True)
+            self._print_line(self._sum_msg(), final=False)
+
+    def update_final(self, final_text):
+        """
+        Create last update of the line with the sum, with newline.
+        The ``final_text`` is printed at the end of the line.
+        """
+        with self.lock:
+            self._print_line(self._sum_msg() + " - " + final_text, final=True)
+
+
+class _PartialProgressBar(TextProgressBar):
+    """
+    Progress bar of a single transfer, that is displayed by a
+    ``MultiProgressBar``. Created by ``MultiProgressBar.make_bar``.
+    """
+    def __init__(self, parent, text, val_max):
+        TextProgressBar.__init__(self, text, val_max)
+        self.parent = parent
+
+    def format_val(self, value):
+        """Format the value, guard against files with zero length."""
+        if self.display_percent and not self.val_max:
+            return "100.0%"
+        return TextProgressBar.format_val(self, value)
+
+    def update_val(self, value):
+        """Update the progress bar with new value."""
+        self.parent._update_bar(self, value)                #IGNORE:W0212
+
+    def update_final(self, value, final_text):
+        """Print a line with the final message of this transfer."""
+        val_msg = self.format_val(value)
+        msg = "{text} - {val} - {fin}".format(
+                                text=self.text, val=val_msg, fin=final_text)
+        self.parent._finish_bar(self, value, msg)           #IGNORE:W0212
+
+
+def run_parallel(func, arg_list, num_workers):
+    """
+    Call ``func`` for each element of ``arg_list`` in a pool of threads.
+
+    Exceptions raised by ``func`` don't stop the other calls. They are
+    collected and returned to the caller.
+
+    Arguments
+    ---------
+
+    func: callable
+        Function with one argument.
+
+    arg_list: list[object]
+        The arguments for ``func``. ``func`` is called once for each element.
+
+    num_workers: int
+        Number of threads. The calls are performed in the current thread
+        if ``num_workers <= 1``.
+
+    Returns
+    -------
+
+    results: list[object]
+        Return values of ``func``, in the order of ``arg_list``. ``None`` if
+        the call raised an exception.
+
+    errors: list[(object, Exception)]
+        Arguments, whose calls raised an exception, and the exception.
+    """
+    results = [None] * len(arg_list)
+    errors = []
+    if num_workers <= 1 or len(arg_list) <= 1:
+        for i, arg in enumerate(arg_list):
+            try:
+                results[i] = func(arg)
+            except Exception, err:                          #IGNORE:W0703
+                errors.append((arg, err))
+        return results, errors
+
+    work_queue = Queue.Queue()
+    for i, arg in enumerate(arg_list):
+        work_queue.put((i, arg))
+    errors_lock = threading.Lock()
+
+    def worker():
+        "Take work from the queue, until it is empty."
+        while True:
+            try:
+                i, arg = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(arg)
+            except Exception, err:                          #IGNORE:W0703
+                logging.debug("Error in worker thread.", exc_info=True)
+                with errors_lock:
+                    errors.append((i, arg, err))
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(num_workers, len(arg_list)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        #Joining with timeout keeps the main thread responsive to Ctrl-C
+        while thread.is_alive():
+            thread.join(0.2)
+
+    #Return errors in the order of ``arg_list``
+    errors.sort(key=lambda e: e[0])
+    return results, [(arg, err) for _, arg, err in errors]
+
+
+class WorkerPool(object):
+    """
+    Pool of threads, that calls a function for arguments, which are 
+    submitted while the pool is running. Unlike ``run_parallel`` the work 
+    need not be known in advance: a producer (for example the downloads) 
+    can submit work to a consumer (the installations), while it is still 
+    running.
+    
+    Exceptions raised by the function don't stop the other calls. They are
+    collected and returned by ``join``.
+    
+    Usage::
+    
+        pool = WorkerPool(install, num_workers=2)
+        for map_ in maps:
+            pool.submit(map_)
+        errors = pool.join()
+    """
+    def __init__(self, func, num_workers):
+        """
+        func: callable
+            Function with one argument.
+            
+        num_workers: int
+            Number of threads.
+        """
+        self.func = func
+        self.work_queue = Queue.Queue()
+        self.stop_marker = object()
+        #Put into the queue, to stop a worker thread.
+        self.errors = []
+        #Arguments, whose calls raised an exception, and the exception.
+        self.errors_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.worker)
+                        for _ in range(max(num_workers, 1))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+    
+    def submit(self, arg):
+        """Call ``func`` for ``arg`` in one of the threads."""
+        self.work_queue.put(arg)
+    
+    def worker(self):
+        "Take work from the queue, until the stop marker arrives."
+        while True:
+            arg = self.work_queue.get()
+            if arg is self.stop_marker:
+                return
+            try:
+                self.func(arg)
+            except Exception, err:                          #IGNORE:W0703
+                logging.debug("Error in worker thread.", exc_info=True)
+                with self.errors_lock:
+                    self.errors.append((arg, err))
+    
+    def cancel(self):
+        """
+        Remove the work, that has not started yet, from the queue. Calls, 
+        that are running, are not interrupted. Call ``join`` afterwards, 
+        to wait for them, and to stop the threads.
+        
+        Returns
+        -------
+        
+        list[object]
+            The arguments, whose calls have been cancelled.
+        """
+        cancelled = []
+        while True:
+            try:
+                arg = self.work_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if arg is not self.stop_marker:
+                cancelled.append(arg)
+        return cancelled
+    
+    def join(self):
+        """
+        Wait until all submitted work is done, and stop the threads.
         
+        Returns
+        -------
         
+        list[(object, Exception)]
+            Arguments, whose calls raised an exception, and the exception.
+        """
+        for _ in self.threads:
+            self.work_queue.put(self.stop_marker)
+        for thread in self.threads:
+            #Joining with timeout keeps the main thread responsive to Ctrl-C
+            while thread.is_alive():
+                thread.join(0.2)
+        return self.errors
+
+
 def items_sorted(in_dict):
     """
     Create ``list`` or (key, value) pairs, from the contents of ``in_dict``.
@@ -134,6 +446,94 @@ def items_sorted(in_dict):
     return items
 
 
+def literal_prefix(pattern):
+    """
+    Return the part of a shell wildcard pattern before the first wildcard.
+    All names that match the pattern start with this prefix.
+    """
+    for i, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+class PatternMatcher(object):
+    """
+    Match names against several shell wildcard patterns at once. Matching 
+    is not case sensitive. Patterns that start with "!" exclude the names
+    that they match. If there are only exclusion patterns, all other names
+    match.
+    
+    The patterns are grouped by the component of their literal prefix (the
+    part up to the first "/", for example "osmand/"). Each group is compiled
+    into a single regular expression. A name is therefore only tested 
+    against its own group, and against the patterns without component.
+    
+    Usage::
+    
+        matcher = PatternMatcher(["osmand/France*", "*Monaco*", "!oam/*"])
+        maps = matcher.filter(maps)
+    """
+    def __init__(self, patterns):
+        includes = [pat.lower() for pat in patterns if not pat.startswith("!")]
+        excludes = [pat[1:].lower() for pat in patterns if pat.startswith("!")]
+        self.includes = self.compile_group(includes) if includes else None
+        #Regular expressions of the included patterns, by component. 
+        #``None`` if all names are included.
+        self.excludes = self.compile_group(excludes)
+        #Regular expressions of the excluded patterns, by component.
+    
+    @staticmethod
+    def get_component(name_low):
+        """Return the component of a name: "osmand/", or "" if none."""
+        return name_low[:name_low.find("/") + 1]
+    
+    def compile_group(self, patterns):
+        """
+        Compile patterns into one regular expression per component.
+        
+        Returns
+        -------
+        
+        dict[str:regex]
+        """
+        groups = {}
+        for pattern in patterns:
+            regex = fnmatch.translate(pattern)
+            #Python 2.7 appends: "\Z(?ms)"
+            if regex.endswith("\\Z(?ms)"):
+                regex = regex[:-len("\\Z(?ms)")]
+            component = self.get_component(literal_prefix(pattern))
+            groups.setdefault(component, []).append(regex)
+        return {component: re.compile("(?:" + "|".join(regexes) + ")\\Z", 
+                                      re.DOTALL | re.MULTILINE)
+                for component, regexes in groups.iteritems()}
+    
+    def search_group(self, group, name_low):
+        """Return ``True`` if a pattern of ``group`` matches ``name_low``."""
+        component = self.get_component(name_low)
+        regex = group.get(component)
+        if regex is not None and regex.match(name_low):
+            return True
+        regex = group.get("") if component else None
+        return regex is not None and regex.match(name_low) is not None
+    
+    def match(self, name):
+        """Return ``True`` if ``name`` matches the patterns."""
+        name_low = name.lower()
+        if self.includes is not None and \
+           not self.search_group(self.includes, name_low):
+            return False
+        return not self.search_group(self.excludes, name_low)
+    
+    def filter(self, map_metas):
+        """
+        Return the maps whose ``disp_name`` matches the patterns. Each map
+        is returned only once, in the original order.
+        """
+        return [map_ for map_ in map_metas if self.match(map_.disp_name)]
+
+
 class PartFile(file):
     """
     Self renaming "*.part" file.
@@ -168,3 +568,10 @@ class PartFile(file):
             
         os.rename(part_name, self.orig_name)
         return close_ret
+    
+    def close_unfinished(self):
+        """
+        Close the file without renaming it. The "*.part" file is kept, so 
+        that the work can be continued later.
+        """
+        return file.close(self)
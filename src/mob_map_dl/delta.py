@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Block checksums for delta downloads, in the style of ``zsync``.
+
+The indexer (``make_control``) splits a file into blocks, and computes a
+weak rolling checksum and a strong checksum (MD5) for each block. The
+checksums are stored in a control file, that is published next to the
+file on the server (URL + ``CONTROL_SUFFIX``).
+
+The client searches an old version of the file (the seed) for these blocks
+(``match_seed``): first at the block boundaries, then at every byte offset
+of the regions that did not match, within a budget of CPU time. Blocks that
+are found are copied from the seed, only the remaining blocks are
+downloaded.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+import mmap
+import operator
+
+from mob_map_dl.common import PartFile
+
+
+CONTROL_SUFFIX = ".zsync.json"
+#The control file of a file is published under the file's URL + this suffix.
+CONTROL_VERSION = 1
+#Version of the control file's format.
+SCAN_BUDGET = 1024**2 * 4
+#Number of byte offsets, at which ``match_seed`` searches the seed for 
+#shifted blocks. Searching one offset is a Python loop iteration; 4 MiB take
+#a few seconds.
+
+
+def weak_checksum(buf):
+    """
+    Compute the weak checksum of a block, as in ``rsync``.
+
+    Returns
+    -------
+
+    (int, int)
+        The two 16 bit halves ``a``, ``b`` of the checksum. The checksum of
+        the block shifted by one byte can be computed from them, see
+        ``match_seed``.
+    """
+    data = bytearray(buf)
+    sum_a = sum(data) & 0xffff
+    sum_b = sum(map(operator.mul, xrange(len(data), 0, -1), data)) & 0xffff
+    return sum_a, sum_b
+
+
+def make_control(file_path, block_size=1024 * 64):
+    """
+    Compute the block checksums of a file.
+
+    Arguments
+    ---------
+
+    file_path: str
+        Path of the file.
+
+    block_size: int
+        Size of the blocks. Smaller blocks find more data in the seed, but
+        make the control file larger. [Byte]
+
+    Returns
+    -------
+
+    dict[str:object]
+        The control data. Keys: "version", "size", "block_size", "sha256",
+        "blocks". "blocks" is a list of ``[weak, strong]`` checksums;
+        ``weak`` is an int, ``strong`` the MD5 hex digest. The last block
+        may be shorter than ``block_size``.
+    """
+    blocks = []
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as fdata:
+        while True:
+            buf = fdata.read(block_size)
+            if not buf:
+                break
+            sha256.update(buf)
+            sum_a, sum_b = weak_checksum(buf)
+            blocks.append([sum_a | sum_b << 16, hashlib.md5(buf).hexdigest()])
+            size += len(buf)
+    return {"version": CONTROL_VERSION, "size": size,
+            "block_size": block_size, "sha256": sha256.hexdigest(),
+            "blocks": blocks}
+
+
+def write_control_file(file_path, block_size=1024 * 64):
+    """
+    Compute the block checksums of a file, and store them next to the file
+    (path + ``CONTROL_SUFFIX``). The control file must be published on the
+    server together with the file.
+
+    Returns
+    -------
+
+    str
+        Path of the control file.
+    """
+    control = make_control(file_path, block_size)
+    ctrl_path = file_path + CONTROL_SUFFIX
+    with PartFile(ctrl_path, "w") as fctrl:
+        json.dump(control, fctrl)
+    return ctrl_path
+
+
+def check_control(control):
+    """
+    Check the structure of control data, that was received from a server.
+
+    Raises
+    ------
+
+    ValueError
+        If the data is not valid control data.
+    """
+    try:
+        size, block_size = control["size"], control["block_size"]
+        valid = control["version"] == CONTROL_VERSION and \
+                isinstance(control["sha256"], basestring) and \
+                block_size > 0 and \
+                len(control["blocks"]) == -(-size // block_size) and \
+                all(len(block) == 2 for block in control["blocks"])
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise ValueError("Invalid control data.")
+
+
+def match_seed(seed_path, control, scan_budget=SCAN_BUDGET):
+    """
+    Search the seed (an old version of the file) for blocks of the new file.
+
+    First the seed is compared at the block boundaries, with the strong 
+    checksums (MD5). This finds all blocks, that have not moved, fast. Then
+    the regions of the seed, that did not match, are searched at every byte
+    offset, to find blocks that were shifted by insertions or deletions
+    (see ``scan_region``). This search is slow, because it is a Python loop
+    over the bytes; it stops after ``scan_budget`` offsets. The search time 
+    is therefore bounded, also for large seeds that don't match at all, 
+    for example compressed archives.
+
+    Arguments
+    ---------
+
+    seed_path: str
+        Path of the seed.
+
+    control: dict[str:object]
+        Block checksums of the new file, see ``make_control``.
+        
+    scan_budget: int
+        Maximum number of byte offsets, that are searched in the regions,
+        that did not match at the block boundaries.
+
+    Returns
+    -------
+
+    dict[int:int]
+        ``{block_index: seed_offset}`` The blocks of the new file, that
+        were found in the seed, and their positions in the seed.
+    """
+    block_size = control["block_size"]
+    blocks = control["blocks"]
+    found = {}
+    if not blocks or os.path.getsize(seed_path) == 0:
+        return found
+    strong_table = {}
+    for index, (_, strong) in enumerate(blocks):
+        strong_table.setdefault(strong, []).append(index)
+
+    with open(seed_path, "rb") as fseed:
+        data = mmap.mmap(fseed.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        seed_size = len(data)
+        #The last block is usually shorter, try it at the end of the seed.
+        last_index = len(blocks) - 1
+        last_size = control["size"] - last_index * block_size
+        if last_size < block_size and last_size <= seed_size and \
+           hashlib.md5(data[seed_size - last_size:]).hexdigest() == \
+           blocks[last_index][1]:
+            found[last_index] = seed_size - last_size
+
+        #Compare at the block boundaries. Remember the unmatched regions.
+        regions = []
+        for pos in xrange(0, seed_size, block_size):
+            indices = None
+            if pos + block_size <= seed_size:
+                strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+                indices = strong_table.get(strong)
+            if indices:
+                for index in indices:
+                    found.setdefault(index, pos)
+            elif regions and regions[-1][1] == pos:
+                regions[-1][1] = min(pos + block_size, seed_size)
+            else:
+                regions.append([pos, min(pos + block_size, seed_size)])
+        
+        #Search the unmatched regions at every byte offset.
+        weak_table = {}
+        for index, (weak, _) in enumerate(blocks):
+            weak_table.setdefault(weak, []).append(index)
+        for start, end in regions:
+            if scan_budget <= 0:
+                break
+            scan_budget -= scan_region(data, start, end, control, weak_table,
+                                       found, scan_budget)
+    finally:
+        data.close()
+    return found
+
+
+def scan_region(data, start, end, control, weak_table, found, max_steps):
+    """
+    Search a region of the seed for blocks of the new file, at every byte
+    offset. Helper function of ``match_seed``.
+    
+    The weak checksum is computed for the block at every byte offset, by 
+    updating it with the byte that enters and the byte that leaves the 
+    block. Only when a weak checksum is in the control data, the strong 
+    checksum is computed. After a match the search continues behind the
+    block, so that regions, that were shifted, are processed a block at a 
+    time.
+
+    Arguments
+    ---------
+
+    data: mmap.mmap
+        The seed.
+        
+    start, end: int
+        Blocks that start in this range of ``data`` are searched. They may 
+        end behind ``end``.
+        
+    control: dict[str:object]
+        Block checksums of the new file, see ``make_control``.
+        
+    weak_table: dict[int:list[int]]
+        ``{weak_checksum: [block_index, ...]}`` for the blocks in 
+        ``control``.
+        
+    found: dict[int:int]
+        The blocks that were found are added: ``{block_index: seed_offset}``
+        
+    max_steps: int
+        The search stops after this many byte offsets.
+
+    Returns
+    -------
+
+    int
+        Number of byte offsets, at which the weak checksum was updated.
+    """
+    block_size = control["block_size"]
+    blocks = control["blocks"]
+    seed_size = len(data)
+    steps = 0
+    pos = start
+    if pos + block_size > seed_size:
+        return steps
+    sum_a, sum_b = weak_checksum(data[pos:pos + block_size])
+    while True:
+        indices = weak_table.get(sum_a | sum_b << 16)
+        matched = False
+        if indices:
+            strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+            for index in indices:
+                if blocks[index][1] == strong:
+                    found.setdefault(index, pos)
+                    matched = True
+        if matched:
+            pos += block_size
+            if pos >= end or pos + block_size > seed_size:
+                break
+            sum_a, sum_b = weak_checksum(data[pos:pos + block_size])
+            continue
+        if pos + 1 >= end or pos + block_size >= seed_size or \
+           steps >= max_steps:
+            break
+        byte_out = ord(data[pos])
+        byte_in = ord(data[pos + block_size])
+        sum_a = (sum_a - byte_out + byte_in) & 0xffff
+        sum_b = (sum_b - block_size * byte_out + sum_a) & 0xffff
+        pos += 1
+        steps += 1
+    return steps
+
+
+def missing_ranges(control, found):
+    """
+    Compute the byte ranges of the new file, that were not found in the
+    seed. Adjacent missing blocks are merged into one range.
+
+    Returns
+    -------
+
+    list[(int, int)]
+        ``(start, end)`` of each range, ``end`` is exclusive.
+    """
+    block_size = control["block_size"]
+    ranges = []
+    for index in range(len(control["blocks"])):
+        if index in found:
+            continue
+        start = index * block_size
+        end = min(start + block_size, control["size"])
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
@@ -28,22 +28,35 @@ from __future__ import division
 from __future__ import absolute_import              
 
 import time
+import logging
 import urllib2
+import os
 from os import path
-import cPickle
-import lxml.html
-import dateutil.parser
+import re
+import json
+import hashlib
+import threading
 import urlparse
+from cStringIO import StringIO
 
-from mob_map_dl.common import MapMeta, TextProgressBar, PartFile, VERSION
+from mob_map_dl.common import (MapMeta, TextProgressBar, PartFile, VERSION, 
+                               run_parallel)
+from mob_map_dl.httppool import ConnectionPool, HostLimiter
+from mob_map_dl.ratelimit import RateLimiter
+from mob_map_dl.catalog import MapCatalog
+from mob_map_dl.delta import (CONTROL_SUFFIX, check_control, match_seed, 
+                              missing_ranges)
 
 
-#Set up logging fore useful debug output, and time stamps in UTC.
-import logging
-logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
-                    level=logging.DEBUG)
-#Time stamps must be in UTC
-logging.Formatter.converter = time.gmtime
+CONNECTION_POOL = ConnectionPool(max_per_host=6)
+#Persistent HTTP connections, that are shared by all downloaders.
+
+SEGMENT_LIMITER = HostLimiter(max_per_host=4)
+#Limits the number of segments that are downloaded concurrently from each 
+#server, by all downloaders.
+
+RATE_LIMITER = RateLimiter()
+#Limits the bandwidth of all downloads together. Unlimited by default.
 
 
 class BaseDownloader(object):
@@ -51,6 +64,16 @@ class BaseDownloader(object):
     Base class for objects that download maps from the Internet.
     """ 
     list_url = "Put URL of map list here."
+    min_segment_size = 1024**2 * 16
+    #Segmented downloads create no segments smaller than this size. [Byte]
+    list_container_tag = "table"
+    #Tag of the element, whose rows (``<tr>``) describe the maps.
+    list_chunk_size = 1024 * 64
+    #Size of the chunks in which the lists of maps are read and parsed. [Byte]
+    publishes_control = True
+    #``True`` if the server may publish control files (block checksums) 
+    #next to the maps. Otherwise delta downloads don't ask for them. 
+    #See: ``download_delta``
     
     def __init__(self, application_dir=None, cache_time=3600):
         """
@@ -62,6 +85,28 @@ class BaseDownloader(object):
         #Directory of the application. Used to cache list of available maps.
         self.cache_time = cache_time
         #Duration in seconds how long a directory listing is cached.
+        self.source = type(self).__name__
+        #Name under which the maps are stored in the catalog.
+        self.catalog = MapCatalog(self.get_cache_path())
+        #The list of available maps of all downloaders. See: ``get_file_list``
+        self.background_refresh = False
+        #If ``True``, outdated lists of maps are returned immediately, and
+        #are refreshed in a background thread. See: ``update_catalog``
+        self.refresh_thread = None
+        #Thread that refreshes the catalog in the background.
+        self.refresh_changed = False
+        #``True`` if the last refresh has changed the catalog.
+        self.segments = 1
+        #Number of segments, that are downloaded in parallel, for each file.
+        #See: ``download_segments``
+        self.delta = False
+        #If ``True``, archives that exist locally are updated by downloading 
+        #only the changed blocks. See: ``download_delta``
+        self.list_jobs = 4
+        #Number of HTML pages with lists of maps, that are downloaded and 
+        #parsed in parallel. See: ``get_file_list``
+        self.date_cache = {}
+        #Dates of maps, that have been parsed. See: ``parse_date``
     
     def make_disp_name(self, server_name):
         """
@@ -90,15 +135,337 @@ class BaseDownloader(object):
         """
         Get list of files (maps) that are available for download.
         
+        The list is assembled from the HTML pages in ``get_list_urls``, and 
+        stored in the catalog (``self.catalog``). See ``update_catalog``.
+        
         Return
         -------
         
         list[MapMeta]
+            In the order of the pages, and of the maps on each page.
         """
-        raise NotImplementedError()   
-
+        self.update_catalog()
+        return self.catalog.query(self.source)
+    
+    def query_file_list(self, pattern=None, min_size=None, max_size=None,
+                        newer_than=None, older_than=None):
+        """
+        Get the maps, that are available for download, and match all 
+        conditions. The maps are filtered by the catalog's database.
+        
+        Arguments
+        ---------
+        
+        pattern: str | NoneType
+            Shell wildcard pattern for the canonical names. Not case 
+            sensitive.
+            
+        min_size, max_size: float | NoneType
+            Limits for the size of the maps. [Byte]
+            
+        newer_than, older_than: datetime.datetime | NoneType
+            Limits for the dates of the maps.
+        
+        Return
+        -------
+        
+        list[MapMeta]
+            Sorted by name if a pattern is given.
+        """
+        self.update_catalog()
+        return self.catalog.query(self.source, pattern, min_size, max_size,
+                                  newer_than, older_than)
+    
+    def update_catalog(self):
+        """
+        Bring the maps of this downloader in the catalog up to date.
+        
+        The stored pages are fresh for ``self.cache_time`` seconds. When 
+        they are older, they are refreshed by ``refresh_catalog``. 
+        
+        If ``self.background_refresh`` is ``True``, and all pages are 
+        stored, outdated pages are refreshed in a background thread, and 
+        this method returns immediately. Meanwhile the outdated maps are 
+        returned by the queries. See: ``wait_refresh``, ``get_catalog_age``
+        """
+        if self.is_refreshing():
+            return
+        list_urls = self.get_list_urls()
+        stored_pages = self.catalog.get_pages(self.source)
+        now = time.time()
+        is_complete = set(stored_pages.keys()) == set(list_urls)
+        if is_complete and all(now - page["fetched"] <= self.cache_time 
+                               for page in stored_pages.values()):
+            return
+        
+        if self.background_refresh and is_complete:
+            self.refresh_thread = threading.Thread(
+                                    target=self.refresh_catalog, 
+                                    args=(list_urls, stored_pages),
+                                    name="refresh-" + self.source)
+            self.refresh_thread.daemon = True
+            self.refresh_thread.start()
+        else:
+            self.refresh_catalog(list_urls, stored_pages)
+    
+    def refresh_catalog(self, list_urls, stored_pages):
+        """
+        Download the HTML pages with the lists of maps, and store the maps
+        in the catalog. 
+        
+        The HTML pages are parsed by ``iter_list_stream``. Each stored page 
+        is revalidated with a conditional request; pages that have not 
+        changed are not downloaded and parsed again. Of the changed pages 
+        only the maps that have changed are written.
+        
+        Up to ``self.list_jobs`` pages are downloaded and parsed in 
+        parallel. If a page can't be read, an error message is printed, and
+        its stored version is kept. It is retried at the next call.
+        
+        Arguments
+        ---------
+        
+        list_urls: list[str]
+            The URLs of the pages, see ``get_list_urls``.
+            
+        stored_pages: dict[str:dict[str:object]]
+            The pages in the catalog, see ``MapCatalog.get_pages``.
+        """
+        fetch = lambda url: self.fetch_list_page(url, stored_pages.get(url))
+        pages, errors = run_parallel(fetch, list_urls, self.list_jobs)
+        for url, err in errors:
+            print "Error while reading list of maps: {url}: {err}".format(
+                                                            url=url, err=err)
+        changed = False
+        for page_index, url in enumerate(list_urls):
+            page = pages[page_index]
+            if page is None:
+                continue
+            if page is stored_pages.get(url):
+                #Nothing changed on the server; only mark the page as fresh.
+                self.catalog.touch_page(self.source, url)
+            else:
+                changed |= self.catalog.update_page(
+                                        self.source, url, page_index, 
+                                        page["etag"], page["last_modified"],
+                                        page["maps"])
+        changed |= self.catalog.remove_other_pages(self.source, list_urls)
+        self.refresh_changed = changed
+    
+    def is_refreshing(self):
+        """Return ``True`` while the catalog is refreshed in the background."""
+        return self.refresh_thread is not None and \
+               self.refresh_thread.is_alive()
+    
+    def wait_refresh(self, timeout=None):
+        """
+        Wait until the refresh in the background has finished.
+        
+        Returns
+        -------
+        
+        bool
+            ``True`` if the background refresh has changed the maps of this
+            downloader in the catalog. ``False`` if nothing has changed, no 
+            refresh was running, or the timeout has expired.
+        """
+        thread = self.refresh_thread
+        if thread is None:
+            return False
+        thread.join(timeout)
+        if thread.is_alive():
+            return False
+        self.refresh_thread = None
+        return self.refresh_changed
+    
+    def get_catalog_age(self):
+        """
+        Return the age of the maps in the catalog: The time since the 
+        oldest page was downloaded (or revalidated). [s]
+        
+        Returns ``None`` if the catalog contains no pages of this 
+        downloader.
+        """
+        stored_pages = self.catalog.get_pages(self.source)
+        if not stored_pages:
+            return None
+        oldest = min(page["fetched"] for page in stored_pages.values())
+        return max(time.time() - oldest, 0)
+    
+    def get_list_urls(self):
+        """
+        Return the URLs of the HTML pages, that list the available maps.
+        
+        Returns
+        -------
+        
+        list[str]
+        """
+        return [self.list_url]
+    
+    def parse_list_page(self, list_html):
+        """
+        Parse a HTML page with a list of available maps.
+        
+        Argument
+        --------
+        
+        list_html: str
+            The HTML page.
+            
+        Returns
+        -------
+        
+        list[MapMeta]
+        """
+        return list(self.iter_list_stream(StringIO(list_html)))
+    
+    def iter_list_stream(self, fsrv):
+        """
+        Parse a HTML page with a list of available maps, while it is read
+        from ``fsrv``. Yields each map as soon as its table row is complete.
+        
+        The page is parsed incrementally, no complete document tree is 
+        built: Only the rows (``<tr>``) of the first ``list_container_tag``
+        element are given to ``parse_list_row``, and are deleted from the 
+        tree afterwards. The memory consumption is therefore independent of 
+        the size of the page.
+        
+        Argument
+        --------
+        
+        fsrv: file like
+            The HTML page, for example a HTTP response. Must have a method 
+            ``read(size)``.
+            
+        Yields
+        ------
+        
+        MapMeta
+        """
+        #``lxml`` is only loaded when lists of maps are parsed. Imported 
+        #here to keep the program's start fast.
+        import lxml.etree
+        parser = lxml.etree.HTMLPullParser(events=("end",), tag="tr")
+        container = None
+        #The element that contains the rows with the maps.
+        row_index = 0
+        #Index of the row in ``container``.
+        rest = ""
+        #Incomplete tag at the end of the last chunk.
+        while True:
+            buff = fsrv.read(self.list_chunk_size)
+            if buff:
+                #Libxml2's HTML push parser stalls until ``close`` is called,
+                #when chunks end inside a tag. Feed only complete tags.
+                buff = rest + buff
+                tag_end = buff.rfind(">") + 1
+                rest = buff[tag_end:]
+                parser.feed(buff[:tag_end])
+            else:
+                parser.feed(rest)
+                parser.close()
+            
+            for _, row in parser.read_events():
+                parent = row.getparent()
+                if container is None and parent is not None and \
+                   parent.tag == self.list_container_tag:
+                    container = parent
+                if parent is container:
+                    map_meta = self.parse_list_row(row, row_index)
+                    row_index += 1
+                    if map_meta is not None:
+                        yield map_meta
+                #Free the memory of rows that have been processed.
+                row.clear()
+                while parent is not None and row.getprevious() is not None:
+                    del parent[0]
+            
+            if not buff:
+                break
+    
+    def parse_list_row(self, row, row_index):
+        """
+        Parse one row of the table, that lists the available maps.
+        
+        Arguments
+        ---------
+        
+        row: lxml.etree._Element
+            The ``<tr>`` element, including its children.
+            
+        row_index: int
+            Index of the row in the table (or ``<tbody>``).
+            
+        Returns
+        -------
+        
+        MapMeta | NoneType
+            ``None`` if the row does not describe a map.
+        """
+        raise NotImplementedError()
+    
+    def parse_date(self, date_text, dayfirst=False):
+        """
+        Parse the date of a map. The dates of many maps are equal, therefore
+        the results are cached.
+        """
+        key = (date_text, dayfirst)
+        date = self.date_cache.get(key)
+        if date is None:
+            import dateutil.parser
+            date = dateutil.parser.parse(date_text, dayfirst=dayfirst)
+            self.date_cache[key] = date
+        return date
+    
+    def fetch_list_page(self, url, cached_page):
+        """
+        Download and parse a HTML page with a list of available maps.
+        The page is parsed while it is downloaded (``iter_list_stream``).
+        
+        If a stored version of the page exists, the server is asked with 
+        a conditional request (``If-None-Match``, ``If-Modified-Since``) 
+        whether the page has changed. If the server answers with status 304 
+        ("Not Modified") the stored page is returned.
+        
+        Arguments
+        ---------
+        
+        url: str
+            URL of the page.
+            
+        cached_page: dict[str:object] | NoneType
+            Stored version of the page, or ``None``. 
+            See: ``MapCatalog.get_pages``
+            
+        Returns
+        -------
+        
+        dict[str:object]
+            Keys: "etag", "last_modified" (validators of the page), 
+            "maps" (list[MapMeta]).
+        """
+        headers = {}
+        if cached_page:
+            if cached_page["etag"]:
+                headers["If-None-Match"] = cached_page["etag"]
+            if cached_page["last_modified"]:
+                headers["If-Modified-Since"] = cached_page["last_modified"]
+        fsrv = self.open_url(url, headers)
+        try:
+            if fsrv.getcode() == 304 and cached_page:
+                return cached_page
+            map_metas = list(self.iter_list_stream(fsrv))
+        finally:
+            fsrv.close()
+        
+        meta = fsrv.info()
+        return {"etag": meta.getheader("ETag"), 
+                "last_modified": meta.getheader("Last-Modified"),
+                "maps": map_metas}
     
-    def download_file(self, srv_url, loc_name, disp_name):
+    def download_file(self, srv_url, loc_name, disp_name, 
+                      make_progress=TextProgressBar, tee=None):
         """
         Download a file from the server and store it in the local file system.
         
@@ -117,81 +484,545 @@ class BaseDownloader(object):
         disp_name: str 
             File name for display in the progress bar.
             
+        make_progress: callable(text, val_max)
+            Creates the progress bar. For concurrent downloads use 
+            ``MultiProgressBar.make_bar``.
+            
+        tee: file like | NoneType
+            Additionally receives the complete data of the file, in order, 
+            through its method ``write``. For example a 
+            ``ZipStreamExtractor``, that installs the map while it is 
+            downloaded. Downloads with a ``tee`` are never segmented.
+            
+        If an earlier download of the same file was interrupted, its 
+        "*.part" file is continued with a ``Range`` request. The download
+        starts again from the beginning, if the server ignores the ``Range``
+        header, or if the file on the server has changed. Changes are 
+        detected with the validators ``ETag`` and ``Last-Modified``.
+
+        With ``self.segments > 1`` large files are downloaded in several 
+        segments in parallel. See: ``download_segments``
+        
+        With ``self.delta = True`` an existing old version of the file is 
+        updated, by downloading only the blocks that have changed. If this
+        is not possible, or the server publishes no control files 
+        (``self.publishes_control``), the complete file is downloaded. See: 
+        ``download_delta``
+        
+        The bandwidth of all downloads together is limited by 
+        ``RATE_LIMITER``.
+        
+        Returns
+        -------
+        
+        str
+            SHA-256 hash of the downloaded file (hex digest). Computed while
+            the file is downloaded.
+            
         TODO: Dynamically adapt ``buff_size`` so that the animation is updated
               once per second.  
         """
-        req = urllib2.Request(srv_url, None, self.headers)
-        fsrv = urllib2.urlopen(req)
-        floc = PartFile(loc_name, "wb")
+        part_name = loc_name + ".part"
+        valid_name = loc_name + ".part.json"
+        old_valid = self.read_part_validators(valid_name, srv_url)
+        size_start = 0
+        if old_valid and not old_valid.get("segmented") \
+           and path.exists(part_name):
+            size_start = path.getsize(part_name)
         
-        meta = fsrv.info()
-        size_total = int(meta.getheaders("Content-Length")[0])
+        if self.delta and self.publishes_control and size_start == 0 and \
+           tee is None and path.isfile(loc_name):
+            try:
+                sha256 = self.download_delta(srv_url, loc_name, disp_name, 
+                                             make_progress)
+            except IOError, err:
+                logging.debug("Delta download failed: %s", err)
+                sha256 = None
+            if sha256:
+                return sha256
+        
+        validators = None
+        if self.segments > 1 and size_start == 0 and tee is None:
+            validators = self.probe_segmented(srv_url)
+        
+        fsrv = None
+        if not validators:
+            if size_start > 0:
+                fsrv = self.open_range(srv_url, size_start, old_valid)
+            if fsrv is None:
+                size_start = 0
+                fsrv = self.open_url(srv_url)
+            meta = fsrv.info()
+            validators = {"url": srv_url, 
+                          "size": self.get_total_size(fsrv, size_start),
+                          "etag": meta.getheader("ETag"), 
+                          "last_modified": meta.getheader("Last-Modified")}
+        
+        size_total = validators["size"]
         size_mib = round(size_total / 1024**2, 1)
         msg = "{name} : {size} MiB".format(name=disp_name[0:50], size=size_mib)
-        progress = TextProgressBar(msg, val_max=size_total)
+        progress = make_progress(msg, val_max=size_total)
+        self.write_part_validators(valid_name, validators)
+        if fsrv is None:
+            sha256 = self.download_segments(srv_url, loc_name, validators, 
+                                            progress)
+        else:
+            sha256 = self.download_stream(fsrv, loc_name, size_start, 
+                                          validators, progress, tee)
+        self.remove_part_validators(valid_name)
+        progress.update_final(size_total, "Downloaded")
+        return sha256
+        
+    def download_stream(self, fsrv, loc_name, size_start, validators, 
+                        progress, tee=None):
+        """
+        Download a file over a single connection.
+        
+        Arguments
+        ---------
         
+        fsrv: file like object
+            Response of the server, supplies the data.
+            
+        loc_name: str
+            Name of the file in the local file system.
+            
+        size_start: int
+            Size of an existing "*.part" file, that is continued. 
+            Must be 0 for a new download.
+            
+        validators: dict[str:object]
+            Size and validators of the file, see ``read_part_validators``.
+            
+        progress: TextProgressBar
+            Progress bar of this download.
+            
+        tee: file like | NoneType
+            Receives the data of the file too. See: ``download_file``
+            
+        Returns
+        -------
+        
+        str
+            SHA-256 hash of the file (hex digest).
+        """
+        size_total = validators["size"]
         buff_size = 1024 * 100
-        size_down = 0
-        while True:
-            progress.update_val(size_down)
-            buf = fsrv.read(buff_size)
-            if not buf:
-                break
-            floc.write(buf)
-            size_down += len(buf)
+        sha256 = hashlib.sha256()
+        if size_start > 0:
+            #The hash and the ``tee`` need the data from the start of the file
+            with open(loc_name + ".part", "rb") as fpart:
+                for buf in iter(lambda: fpart.read(buff_size), ""):
+                    sha256.update(buf)
+                    if tee is not None:
+                        tee.write(buf)
+        floc = PartFile(loc_name, "ab" if size_start > 0 else "wb")
+        
+        size_down = size_start
+        try:
+            while True:
+                progress.update_val(size_down)
+                buf = fsrv.read(buff_size)
+                if not buf:
+                    break
+                RATE_LIMITER.consume(len(buf))
+                floc.write(buf)
+                sha256.update(buf)
+                if tee is not None:
+                    tee.write(buf)
+                size_down += len(buf)
+        finally:
+            fsrv.close()
             
+        if size_down != size_total:
+            #Leave the "*.part" file, the download can be continued later.
+            floc.close_unfinished()
+            progress.update_final(size_down, "Interrupted")
+            raise IOError("Download interrupted: {} of {} bytes received. "
+                          "URL: {}".format(size_down, size_total, 
+                                           validators["url"]))
+        floc.close()
+        return sha256.hexdigest()
+        
+    def probe_segmented(self, srv_url):
+        """
+        Find out if a file should be downloaded in segments, with a "HEAD"
+        request. The file must be large enough, and the server must support
+        ``Range``.
+        
+        Returns
+        -------
+        
+        dict[str:object] | NoneType
+            Size and validators of the file, see ``read_part_validators``.
+            ``None`` if the file should not be downloaded in segments.
+        """
+        fsrv = self.open_url(srv_url, method="HEAD")
         fsrv.close()
+        meta = fsrv.info()
+        size_total = meta.getheader("Content-Length")
+        if meta.getheader("Accept-Ranges") != "bytes" or size_total is None \
+           or int(size_total) < 2 * self.min_segment_size:
+            return None
+        return {"url": srv_url, "size": int(size_total), "segmented": True,
+                "etag": meta.getheader("ETag"), 
+                "last_modified": meta.getheader("Last-Modified")}
+        
+    def download_segments(self, srv_url, loc_name, validators, progress):
+        """
+        Download a file in several segments in parallel. 
+        
+        The file is split into ``self.segments`` byte ranges, which are 
+        downloaded with separate ``Range`` requests, and written into a 
+        preallocated "*.part" file. When all segments are complete the file
+        is renamed, like a regular download.
+        
+        The number of segments, that are downloaded simultaneously from the 
+        same server, is limited by ``SEGMENT_LIMITER``.
+        
+        An interrupted segmented download is not continued, it is started
+        again from the beginning.
+        
+        The segments arrive out of order, therefore the SHA-256 hash is 
+        computed from the complete file. It is usually still in the 
+        operating system's cache.
+        
+        Arguments
+        ---------
+        
+        srv_url: str
+            URL of the file on the remote server.
+            
+        loc_name: str
+            Name of the file in the local file system.
+            
+        validators: dict[str:object]
+            Size and validators of the file, see ``read_part_validators``.
+            
+        progress: TextProgressBar
+            Progress bar of this download.
+            
+        Returns
+        -------
+        
+        str
+            SHA-256 hash of the file (hex digest).
+        """
+        size_total = validators["size"]
+        num_segments = min(self.segments, size_total // self.min_segment_size)
+        seg_size = -(-size_total // num_segments)   #Rounds up
+        ranges = [(start, min(start + seg_size, size_total)) 
+                  for start in range(0, size_total, seg_size)]
+        host = urlparse.urlsplit(srv_url).netloc
+        
+        floc = PartFile(loc_name, "wb")
+        floc.truncate(size_total)
+        floc.flush()
+        progress_lock = threading.Lock()
+        size_down = [0]
+        
+        def fetch_segment(seg_range):
+            "Download one segment, and write it into the '*.part' file."
+            start, end = seg_range
+            SEGMENT_LIMITER.acquire(host)
+            fseg = None
+            try:
+                fseg = self.open_range(srv_url, start, validators, end)
+                if fseg is None:
+                    raise IOError("File changed on server, or server does "
+                                  "not support 'Range'. URL: " + srv_url)
+                with open(floc.name, "r+b") as fpart:
+                    fpart.seek(start)
+                    pos = start
+                    while pos < end:
+                        buf = fseg.read(min(1024 * 100, end - pos))
+                        if not buf:
+                            raise IOError("Segment interrupted at byte {}. "
+                                          "URL: {}".format(pos, srv_url))
+                        RATE_LIMITER.consume(len(buf))
+                        fpart.write(buf)
+                        pos += len(buf)
+                        with progress_lock:
+                            size_down[0] += len(buf)
+                            progress.update_val(size_down[0])
+            finally:
+                if fseg:
+                    fseg.close()
+                SEGMENT_LIMITER.release(host)
+        
+        _, errors = run_parallel(fetch_segment, ranges, len(ranges))
+        if errors:
+            floc.close_unfinished()
+            progress.update_final(size_down[0], "Interrupted")
+            raise errors[0][1]
         floc.close()
-        progress.update_final(size_down, "Downloaded")
         
-    def get_cached_file_list(self):
+        sha256 = hashlib.sha256()
+        with open(loc_name, "rb") as fdown:
+            for buf in iter(lambda: fdown.read(1024**2), ""):
+                sha256.update(buf)
+        return sha256.hexdigest()
+        
+    def fetch_control(self, srv_url):
         """
-        Return the cached list of available maps (and other files).
-        Returns ``None`` if cached list is too old, or none exists.
+        Download the block checksums of a file, that are published next to 
+        it on the server. See: ``delta.make_control``
         
-        This is a utility function that should only be called inside the 
-        download module. High level code should call ``get_file_list``.
+        Returns
+        -------
+        
+        dict[str:object] | NoneType
+            The control data, ``None`` if the server has no valid control 
+            file.
+        """
+        try:
+            fctrl = self.open_url(srv_url + CONTROL_SUFFIX)
+            try:
+                control = json.loads(fctrl.read())
+            finally:
+                fctrl.close()
+            check_control(control)
+        except (urllib2.URLError, ValueError), err:
+            logging.debug("No block checksums for %s: %s", srv_url, err)
+            return None
+        return control
+        
+    def download_delta(self, srv_url, loc_name, disp_name, make_progress):
+        """
+        Update a local file to the version on the server, by downloading 
+        only the blocks that have changed. Similar to ``zsync``.
+        
+        The block checksums of the new version are downloaded from the 
+        server (see ``fetch_control``). The blocks, that are found in the 
+        old version (the seed, at ``loc_name``), are copied from it. The 
+        missing blocks are downloaded with ``Range`` requests. The new 
+        version is assembled in a "*.part" file, that replaces the old 
+        version when its SHA-256 hash is correct.
+        
+        Arguments as in ``download_file``.
         
         Returns
         -------
         
-        list[MapMeta] | NoneType
+        str | NoneType
+            SHA-256 hash of the new file (hex digest). ``None`` if the server
+            publishes no block checksums, or the checksums are outdated; 
+            the file must then be downloaded normally.
+            
+        Raises
+        ------
+        
+        IOError
+            If the download fails. The old version is kept.
         """
-        if not self.application_dir:
+        control = self.fetch_control(srv_url)
+        if control is None:
             return None
+        fsrv = self.open_url(srv_url, method="HEAD")
+        fsrv.close()
+        meta = fsrv.info()
+        validators = {"url": srv_url, 
+                      "size": int(meta.getheader("Content-Length") or -1),
+                      "etag": meta.getheader("ETag"), 
+                      "last_modified": meta.getheader("Last-Modified")}
+        if validators["size"] != control["size"] or \
+           meta.getheader("Accept-Ranges") != "bytes":
+            logging.debug("Block checksums are outdated: %s", srv_url)
+            return None
+        
+        found = match_seed(loc_name, control)
+        ranges = missing_ranges(control, found)
+        size_total = control["size"]
+        block_size = control["block_size"]
+        size_mib = round(size_total / 1024**2, 1)
+        msg = "{name} : {size} MiB".format(name=disp_name[0:50], size=size_mib)
+        progress = make_progress(msg, val_max=size_total)
+        
+        floc = PartFile(loc_name, "wb")
+        size_down = 0
         try:
-            pickle_name = str(type(self)) + "-dirlist.pickle"
-            pickle_path = path.join(self.application_dir, pickle_name)
-            pickle_time = path.getmtime(pickle_path)
-            if time.time() - pickle_time > self.cache_time:
+            floc.truncate(size_total)
+            with open(loc_name, "rb") as fseed:
+                for index, seed_pos in sorted(found.items()):
+                    fseed.seek(seed_pos)
+                    buf = fseed.read(block_size)[:size_total - 
+                                                 index * block_size]
+                    floc.seek(index * block_size)
+                    floc.write(buf)
+                    size_down += len(buf)
+                    progress.update_val(size_down)
+            
+            for start, end in ranges:
+                fseg = self.open_range(srv_url, start, validators, end)
+                if fseg is None:
+                    raise IOError("File changed on server, or server does "
+                                  "not support 'Range'. URL: " + srv_url)
+                try:
+                    floc.seek(start)
+                    pos = start
+                    while pos < end:
+                        buf = fseg.read(min(1024 * 100, end - pos))
+                        if not buf:
+                            raise IOError("Block interrupted at byte {}. "
+                                          "URL: {}".format(pos, srv_url))
+                        RATE_LIMITER.consume(len(buf))
+                        floc.write(buf)
+                        pos += len(buf)
+                        size_down += len(buf)
+                        progress.update_val(size_down)
+                finally:
+                    fseg.close()
+            
+            floc.flush()
+            sha256 = hashlib.sha256()
+            with open(floc.name, "rb") as fcheck:
+                for buf in iter(lambda: fcheck.read(1024**2), ""):
+                    sha256.update(buf)
+            if sha256.hexdigest() != control["sha256"]:
+                raise IOError("Wrong SHA-256 after delta download. URL: " + 
+                              srv_url)
+        except:                                     #IGNORE:W0702
+            floc.close_unfinished()
+            os.remove(floc.name)
+            progress.update_final(size_down, "Interrupted")
+            raise
+        floc.close()
+        
+        size_fetched = sum(end - start for start, end in ranges)
+        progress.update_final(size_total, 
+                              "Downloaded {p:.0f}%, rest from old version"
+                              .format(p=size_fetched / max(size_total, 1) * 
+                                        100))
+        return sha256.hexdigest()
+        
+    def get_total_size(self, fsrv, size_start):
+        """
+        Compute the size of the complete file from the headers of a 
+        response. ``size_start`` is the start of the requested range.
+        """
+        meta = fsrv.info()
+        if fsrv.getcode() == 206:
+            content_range = meta.getheader("Content-Range")
+            return int(content_range.rsplit("/", 1)[1])
+        return size_start + int(meta.getheader("Content-Length"))
+        
+    def open_url(self, url, extra_headers=None, method="GET"):
+        """
+        Open a URL with a GET (or HEAD) request. The connection is taken 
+        from ``CONNECTION_POOL``; the returned object must be closed, or 
+        read completely, to return the connection to the pool.
+        
+        Arguments
+        ---------
+        
+        url: str
+            The URL that is opened.
+            
+        extra_headers: dict[str:str] | NoneType
+            Headers that are sent in addition to ``self.headers``.
+            
+        method: str
+            The HTTP method: "GET" or "HEAD".
+            
+        Returns
+        -------
+        
+        file like object
+            Object with the methods ``read``, ``close``, ``info``, 
+            ``getcode``.
+        """
+        headers = dict(self.headers)
+        if extra_headers:
+            headers.update(extra_headers)
+        return CONNECTION_POOL.request(method, url, headers)
+    
+    def open_range(self, srv_url, size_start, old_valid, size_end=None):
+        """
+        Request the remainder of a file, starting at byte ``size_start``.
+        With ``size_end`` only the bytes up to ``size_end - 1`` are requested.
+        
+        Returns ``None`` if the server ignores the ``Range`` header, or if 
+        the file has changed on the server. The validators of the earlier 
+        download ``old_valid`` are used to detect changes.
+        
+        Returns
+        -------
+        
+        file like object | NoneType
+        """
+        headers = {"Range": "bytes={}-{}".format(
+                    size_start, "" if size_end is None else size_end - 1)}
+        #The server sends the complete file, when the validator has changed.
+        #``If-Range`` requires a strong ETag.
+        etag, last_mod = old_valid["etag"], old_valid["last_modified"]
+        if etag and not etag.startswith("W/"):
+            headers["If-Range"] = etag
+        elif last_mod:
+            headers["If-Range"] = last_mod
+        try:
+            fsrv = self.open_url(srv_url, headers)
+        except urllib2.HTTPError, err:
+            #Status 416: "Range Not Satisfiable"
+            if err.code == 416:
                 return None
-            pickle_file = open(pickle_path, "rb")
-            file_list = cPickle.load(pickle_file)
-            pickle_file.close()
-            return file_list
-        except (OSError, cPickle.PickleError):
+            raise
+        
+        meta = fsrv.info()
+        content_range = meta.getheader("Content-Range") or ""
+        range_match = re.match(r"bytes\s+(\d+)-\d+/(\d+)", content_range)
+        if fsrv.getcode() != 206 or not range_match \
+           or int(range_match.group(1)) != size_start \
+           or int(range_match.group(2)) != old_valid["size"] \
+           or meta.getheader("ETag") != etag \
+           or meta.getheader("Last-Modified") != last_mod:
+            fsrv.close()
             return None
-    
-    def set_cached_file_list(self, file_list):
+        return fsrv
+        
+    def read_part_validators(self, valid_name, srv_url):
         """
-        Store the list of available maps (and other files) for later reuse.
-        Does nothing if application directory is not writable.
+        Read the validators of an interrupted download. Returns ``None`` if 
+        they don't exist or belong to a different URL.
         
-        Argument
-        --------
+        Returns
+        -------
         
-        file_list: list[MapMeta]
+        dict[str:object] | NoneType
+            Keys: "url", "size", "etag", "last_modified"
         """
-        if not self.application_dir:
-            return
         try:
-            pickle_name = str(type(self)) + "-dirlist.pickle"
-            pickle_path = path.join(self.application_dir, pickle_name)
-            pickle_file = open(pickle_path, "wb")
-            cPickle.dump(file_list, pickle_file, protocol=-1)
-            pickle_file.close()
-        except (OSError, cPickle.PickleError):
+            with open(valid_name, "rb") as valid_file:
+                validators = json.load(valid_file)
+        except (IOError, ValueError):
+            return None
+        if validators.get("url") != srv_url:
+            return None
+        return validators
+    
+    def write_part_validators(self, valid_name, validators):
+        """
+        Store the validators of a download, next to its "*.part" file.
+        Needed to safely continue the download, if it is interrupted.
+        """
+        with open(valid_name, "wb") as valid_file:
+            json.dump(validators, valid_file)
+            
+    def remove_part_validators(self, valid_name):
+        """Remove the validators of a download when it is complete."""
+        try:
+            os.remove(valid_name)
+        except OSError:
             pass
+        
+    def get_cache_path(self):
+        """
+        Return path of the catalog's database, which stores the lists of 
+        available maps. The catalog is kept in memory if there is no 
+        application directory.
+        """
+        if not self.application_dir:
+            return ":memory:"
+        return path.join(self.application_dir, "catalog.sqlite")
 
 
 class OsmandDownloader(BaseDownloader):
@@ -199,6 +1030,7 @@ class OsmandDownloader(BaseDownloader):
     Download maps from the servers of the Osmand project.
     """
     list_url = "http://download.osmand.net/list.php"
+    publishes_control = False
     
     def __init__(self, application_dir=None, cache_time=3600):
         BaseDownloader.__init__(self, application_dir, cache_time)
@@ -220,14 +1052,15 @@ class OsmandDownloader(BaseDownloader):
         disp_name = "osmand/" + server_name.rsplit(".", 1)[0]
         return disp_name
     
-    def get_file_list(self):
+    def parse_list_row(self, row, row_index):
         """
-        Get list of maps for Osmand that are available for download.
+        Parse one row of the list of maps for Osmand, that are available for
+        download.
         
         Return
         -------
         
-        list[MapMeta]
+        MapMeta | NoneType
         
         Note
         ------
@@ -258,35 +1091,17 @@ class OsmandDownloader(BaseDownloader):
             </body>
         </html>
         """
-        #Return cached file list if it exists and is recent
-        cached_file_list = self.get_cached_file_list()
-        if cached_file_list:
-            return cached_file_list
-        
-        #Download HTML document with list of maps from server of Osmand project
-        req = urllib2.Request(self.list_url, None, self.headers)
-        u = urllib2.urlopen(req)
-        list_html = u.read()
-#        print list_html
-
-        #Parse HTML list of maps
-        root = lxml.html.document_fromstring(list_html)
-        table = root.find(".//table")
-        map_metas = []
-        for row in table[2:]:
-            link = row[0][0]
-            download_url = urlparse.urljoin(self.list_url, link.get("href"))
-            map_meta = MapMeta(disp_name=self.make_disp_name(link.text), 
-                               full_name=download_url, 
-                               size=float(row[2].text) * 1024**2, #[Byte]
-                               time=dateutil.parser.parse(row[1].text,
-                                                          dayfirst=True), 
-                               description=row[3].text, 
-                               map_type="osmand")
-            map_metas.append(map_meta)
-        
-        self.set_cached_file_list(map_metas)
-        return map_metas
+        #Skip the table headers and the nonsense row
+        if row_index < 2:
+            return None
+        link = row[0][0]
+        download_url = urlparse.urljoin(self.list_url, link.get("href"))
+        return MapMeta(disp_name=self.make_disp_name(link.text), 
+                       full_name=download_url, 
+                       size=float(row[2].text) * 1024**2, #[Byte]
+                       time=self.parse_date(row[1].text, dayfirst=True), 
+                       description=row[3].text, 
+                       map_type="osmand")
     
     
 class OpenandromapsDownloader(BaseDownloader):
@@ -294,6 +1109,8 @@ class OpenandromapsDownloader(BaseDownloader):
     Downloader for maps from the Open Andro Maps project. 
     """
     list_url = "http://www.openandromaps.org/downloads"
+    list_container_tag = "tbody"
+    publishes_control = False
     list_urls = ["http://www.openandromaps.org/downloads/europa", 
                  "http://www.openandromaps.org/downloads/deutschland", 
                  "http://www.openandromaps.org/downloads/russlan", 
@@ -339,47 +1156,35 @@ class OpenandromapsDownloader(BaseDownloader):
         disp_name = "oam/" + "_".join(tail2_lst)
         return disp_name
     
-    def get_file_list(self):
+    def get_list_urls(self):
+        """
+        Return the URLs of the HTML pages, that list the available maps.
+        There is one page for each region.
         """
-        Get list of maps for Osmand that are available for download.
+        return self.list_urls
+    
+    def parse_list_row(self, row, row_index):
+        """
+        Parse one row of a list of maps for Openandromaps, that are 
+        available for download.
         
         Return
         -------
         
-        list[MapMeta]
+        MapMeta
         
         Note
         ------
         
         The function parses the regular, human readable, HTML documents, that
-        lists the existing maps for Openandromaps. 
-        """
-        #Return cached file list if it exists and is recent
-        cached_file_list = self.get_cached_file_list()
-        if cached_file_list:
-            return cached_file_list
-        
-        map_metas = []
-        for url in self.list_urls:
-            #Download HTML document with list of maps from server of Osmand project
-            req = urllib2.Request(url, None, self.headers)
-            downloader = urllib2.urlopen(req)
-            list_html = downloader.read()
-            
-            #Parse HTML list of maps
-            root = lxml.html.document_fromstring(list_html)
-            table = root.find(".//tbody")
-    #        print lxml.html.tostring(table, pretty_print=True)
-            for row in table:
-                link = row[3][0]
-                download_url = link.get("href")
-                map_meta = MapMeta(disp_name=self.make_disp_name(download_url), 
-                                   full_name=download_url, 
-                                   size=float(row[2].text) * 1024**2, #[Byte]
-                                   time=dateutil.parser.parse(row[1].text), 
-                                   description="", 
-                                   map_type="openandromaps")
-                map_metas.append(map_meta)
-        
-        self.set_cached_file_list(map_metas)
-        return map_metas
+        lists the existing maps for Openandromaps. The maps are the rows of
+        the first ``<tbody>`` element.
+        """
+        link = row[3][0]
+        download_url = link.get("href")
+        return MapMeta(disp_name=self.make_disp_name(download_url), 
+                       full_name=download_url, 
+                       size=float(row[2].text) * 1024**2, #[Byte]
+                       time=self.parse_date(row[1].text), 
+                       description="", 
+                       map_type="openandromaps")
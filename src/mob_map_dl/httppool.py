@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Persistent (keep-alive) HTTP connections, that are shared by all downloaders.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import logging
+import threading
+import socket
+import httplib
+import urllib
+import urllib2
+import urlparse
+from cStringIO import StringIO
+
+
+class HostLimiter(object):
+    """
+    Limit the number of simultaneous connections to each host.
+
+    Usage::
+
+        limiter.acquire("download.osmand.net")
+        try:
+            ...
+        finally:
+            limiter.release("download.osmand.net")
+    """
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get_semaphore(self, host):
+        """Return the semaphore for ``host``, create it when necessary."""
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.Semaphore(self.max_per_host)
+            return self.semaphores[host]
+
+    def acquire(self, host):
+        """Wait until a connection to ``host`` is allowed."""
+        self.get_semaphore(host).acquire()
+
+    def release(self, host):
+        """Signal that a connection to ``host`` has been closed."""
+        self.get_semaphore(host).release()
+
+
+class PooledResponse(object):
+    """
+    Response of a ``ConnectionPool``. Behaves like the responses of
+    ``urllib2.urlopen``.
+
+    The connection is returned to the pool, when the response has been
+    read completely, or when it is closed. The response should therefore
+    always be closed.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    def read(self, amt=None):
+        """Read at most ``amt`` bytes, or everything if ``amt`` is None."""
+        if self.conn is None:
+            return ""
+        data = self.response.read(amt) if amt else self.response.read()
+        if self.response.isclosed():
+            self.close()
+        return data
+
+    def info(self):
+        """Return the headers: ``httplib.HTTPMessage``"""
+        return self.response.msg
+
+    def getcode(self):
+        """Return the HTTP status code."""
+        return self.response.status
+
+    def geturl(self):
+        """Return the URL, after redirects have been followed."""
+        return self.url
+
+    def close(self):
+        """
+        Close the response, and return the connection to the pool. If the
+        response has not been read completely the connection is closed.
+        """
+        if self.conn is None:
+            return
+        #Body has been read completely (``length`` is the remaining length) 
+        reusable = not self.response.will_close and \
+                   (self.response.length == 0 or 
+                    self.response.isclosed() and not self.response.length)
+        self.response.close()
+        self.pool.put_connection(self.key, self.conn, reusable)
+        self.conn = None
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP connections.
+
+    Connections to the same host are reused, which avoids the latency of
+    new TCP (and TLS) handshakes. The number of connections to each host,
+    that are used at the same time, is limited. Redirects are followed,
+    and the proxies from the environment variables are used.
+
+    Usage::
+
+        pool = ConnectionPool(max_per_host=4)
+        resp = pool.request("GET", "http://download.osmand.net/list.php")
+        html = resp.read()
+        resp.close()
+
+    All methods are thread safe.
+    """
+    max_redirects = 10
+
+    def __init__(self, max_per_host=6, timeout=60):
+        """
+        max_per_host: int
+            Maximum number of connections to each host, that are used at the
+            same time.
+
+        timeout: float
+            Timeout for blocking socket operations. [s]
+        """
+        self.timeout = timeout
+        self.limiter = HostLimiter(max_per_host)
+        self.lock = threading.Lock()
+        self.idle = {}
+        #Idle connections: {(scheme, host, proxy): [HTTPConnection]}
+        self.num_created = 0
+        #Number of connections that have been opened, for statistics.
+
+    def get_connection(self, key):
+        """
+        Take an idle connection from the pool, or create a new one.
+        Waits if too many connections to the host are in use.
+
+        Returns
+        -------
+
+        conn: httplib.HTTPConnection
+
+        reused: bool
+            ``True`` if the connection has been used before.
+        """
+        scheme, host, proxy = key
+        self.limiter.acquire(host)
+        with self.lock:
+            idle_conns = self.idle.get(key)
+            if idle_conns:
+                return idle_conns.pop(), True
+            self.num_created += 1
+
+        conn_host = proxy if proxy else host
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(conn_host, timeout=self.timeout)
+            if proxy:
+                conn.set_tunnel(host)
+        else:
+            conn = httplib.HTTPConnection(conn_host, timeout=self.timeout)
+        return conn, False
+
+    def put_connection(self, key, conn, reusable):
+        """Return a connection to the pool, or close it."""
+        _, host, _ = key
+        if reusable:
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.limiter.release(host)
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get_proxy(self, scheme, host):
+        """
+        Return the proxy ("host:port") for a URL, from the environment
+        variables. Returns ``None`` if no proxy should be used.
+        """
+        proxy_url = urllib.getproxies().get(scheme)
+        if not proxy_url or urllib.proxy_bypass(host.split(":")[0]):
+            return None
+        return urlparse.urlsplit(proxy_url).netloc or proxy_url
+
+    def request(self, method, url, headers=None):
+        """
+        Send a request, and return the response. Follows redirects.
+
+        Arguments
+        ---------
+
+        method: str
+            The HTTP method: "GET" or "HEAD"
+
+        url: str
+            The URL that is requested.
+
+        headers: dict[str:str] | NoneType
+            Additional headers.
+
+        Returns
+        -------
+
+        PooledResponse
+            The response. Behaves like the return value of
+            ``urllib2.urlopen``.
+
+        Raises
+        ------
+
+        urllib2.HTTPError
+            For responses with status codes >= 400.
+
+        urllib2.URLError
+            When the connection fails.
+        """
+        headers = headers or {}
+        for _ in range(self.max_redirects + 1):
+            resp = self.request_once(method, url, headers)
+            status = resp.getcode()
+            location = resp.info().getheader("Location")
+            if status in (301, 302, 303, 307, 308) and location:
+                resp.read()
+                resp.close()
+                url = urlparse.urljoin(url, location)
+                continue
+            if status >= 400:
+                body = resp.read()
+                resp.close()
+                raise urllib2.HTTPError(url, status, resp.response.reason,
+                                        resp.info(), StringIO(body))
+            return resp
+        raise urllib2.URLError("Too many redirects: " + url)
+
+    def request_once(self, method, url, headers):
+        """
+        Send a single request over a pooled connection. Retries once with
+        a new connection, if the server has closed an idle connection.
+
+        Returns
+        -------
+
+        PooledResponse
+        """
+        scheme, host, url_path, query, _ = urlparse.urlsplit(url)
+        proxy = self.get_proxy(scheme, host)
+        key = (scheme, host, proxy)
+        selector = url_path or "/"
+        if query:
+            selector += "?" + query
+        if proxy and scheme == "http":
+            selector = url
+
+        while True:
+            conn, reused = self.get_connection(key)
+            try:
+                conn.putrequest(method, selector, skip_accept_encoding=True)
+                for name, value in headers.items():
+                    conn.putheader(name, value)
+                conn.endheaders()
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), err:
+                self.put_connection(key, conn, reusable=False)
+                if reused:
+                    #Server has closed the idle connection; try a new one.
+                    logging.debug("Retry with new connection: %s", err)
+                    continue
+                raise urllib2.URLError(err)
+            return PooledResponse(self, key, conn, response, url)
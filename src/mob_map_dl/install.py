@@ -32,20 +32,46 @@ import os
 import fnmatch
 from os import path
 import datetime
+import json
 
-from mob_map_dl.common import MapMeta
+from mob_map_dl.common import MapMeta, MAP_HASH_SUFFIX
 
 
-#Set up logging fore useful debug output, and time stamps in UTC.
-import logging
-logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
-                    level=logging.DEBUG)
-#Time stamps must be in UTC
-logging.Formatter.converter = time.gmtime
+_scandir_cache = []
+#Contains the result of ``get_scandir`` after the first call.
+
+def get_scandir():
+    """
+    Return the function ``scandir``, from module ``os`` or from the 
+    backport ``scandir``; ``None`` if neither exists. The backport imports
+    ``ctypes``, therefore it is only loaded when a directory is scanned.
+    
+    On Python 2.7 the backport is a dependency of this program (see 
+    ``setup.py``). Without it the directory is listed with ``os.listdir``,
+    and each file is queried with ``os.stat``, which is much slower on 
+    slow devices.
+    """
+    if _scandir_cache:
+        return _scandir_cache[0]
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = None
+    _scandir_cache.append(scandir)
+    return scandir
 
 
 class BaseInstaller(object):
     """Base class of installers."""
+    manifest_name = ".mob_map_dl-listing.json"
+    #Name of the file in ``install_dir``, that stores the listing across 
+    #runs. See: ``get_listing``
+    mtime_resolution = 2
+    #Coarsest resolution of modification times of the supported file 
+    #systems (FAT). [s]
+    
     def __init__(self, _device_dir=None):
         """
         Object is initialized with the mobile device's directory by the top 
@@ -55,6 +81,11 @@ class BaseInstaller(object):
         self.install_dir = ""
         #Directory where the maps are installed. Is accessed by command: 
         # ``dlmap lsd -l`` 
+        self.use_manifest = False
+        #If ``True`` the listing is stored in a manifest on the device, so 
+        #that the next run does not need to scan the device again.
+        self.listing = None
+        #The cached listing of ``install_dir``. See: ``get_listing``
         
     #--- Called by high level algorithms -------------------------------
     def make_disp_name(self, file_path):
@@ -93,25 +124,163 @@ class BaseInstaller(object):
         
         list[MapMeta]
         """
-        dir_names = os.listdir(self.install_dir)
-        map_names = fnmatch.filter(dir_names, filter_pattern)
-        map_names.sort()
-        
+        entries = self.get_listing(filter_pattern)
         map_metas = []
-        for name in map_names:
-            map_name = path.join(self.install_dir, name)
-            disp_name = self.make_disp_name(name)
-            map_size = path.getsize(map_name)
-            mod_time = path.getmtime(map_name)
-            map_meta = MapMeta(disp_name=disp_name, 
-                               full_name=map_name, 
-                               size=map_size, 
-                               time=datetime.datetime.fromtimestamp(mod_time), 
-                               description="", 
-                               map_type=None)
-            map_metas.append(map_meta)
-        
+        for name in sorted(entries.keys()):
+            map_size, mod_time = entries[name]
+            map_metas.append(self.make_map_meta(
+                            path.join(self.install_dir, name), map_size, 
+                            mod_time))
         return map_metas
+    
+    def get_map_hash_path(self, map_name):
+        """
+        Return the path of the file with the hash of an installed map. 
+        See: ``BaseManager.read_map_hash``
+        """
+        return map_name + MAP_HASH_SUFFIX
+    
+    def get_auxiliary_paths(self, map_name):
+        """
+        Return the paths of the files, that belong to an installed map: its
+        hash, and the "*.part" file of an interrupted installation.
+        They must be deleted together with the map.
+        """
+        return [self.get_map_hash_path(map_name), map_name + ".part"]
+    
+    def get_map_meta(self, map_name):
+        """
+        Return the metadata of a single installed map, for example after it 
+        has been installed.
+        
+        Returns
+        -------
+        
+        MapMeta
+        """
+        map_stat = os.stat(map_name)
+        return self.make_map_meta(map_name, map_stat.st_size, 
+                                  map_stat.st_mtime)
+    
+    def make_map_meta(self, map_name, map_size, mod_time):
+        """Create the ``MapMeta`` of an installed map."""
+        return MapMeta(disp_name=self.make_disp_name(map_name), 
+                       full_name=map_name, 
+                       size=map_size, 
+                       time=datetime.datetime.fromtimestamp(mod_time), 
+                       description="", 
+                       map_type=None)
+    
+    def get_listing(self, filter_pattern):
+        """
+        Return the names, sizes and modification times of the maps in 
+        ``self.install_dir``. 
+        
+        Stat calls on removable devices (USB, FUSE) can be slow. Therefore
+        the listing is cached, and (with ``self.use_manifest``) stored in a 
+        manifest in ``self.install_dir``. The cached listing is used as long
+        as the modification time of ``self.install_dir`` is unchanged; this
+        time changes when files are created, deleted or renamed. Maps that 
+        are modified in place must be reported with ``forget_listing``.
+        
+        Returns
+        -------
+        
+        dict[str:(int, float)]
+            ``{file_name: (size, mtime)}`` of the files that match 
+            ``filter_pattern``.
+        """
+        if self.listing is None and self.use_manifest:
+            self.listing = self.read_listing_manifest()
+        if self.listing is None and self.use_manifest:
+            #Creating the manifest changes ``install_dir``'s mtime.
+            self.write_listing_manifest()
+        dir_mtime = os.stat(self.install_dir).st_mtime
+        listing = self.listing
+        #Changes in the same time step as the scan can't be detected.
+        if listing is not None and listing["pattern"] == filter_pattern and \
+           listing["dir_mtime"] == dir_mtime and \
+           listing["scan_time"] - dir_mtime > self.mtime_resolution:
+            return listing["entries"]
+        
+        scan_time = time.time()
+        entries = self.scan_install_dir(filter_pattern)
+        self.listing = {"pattern": filter_pattern, "dir_mtime": dir_mtime, 
+                        "scan_time": scan_time, "entries": entries}
+        if self.use_manifest:
+            self.write_listing_manifest()
+        return entries
+    
+    def scan_install_dir(self, filter_pattern):
+        """
+        List the files in ``self.install_dir``, that match 
+        ``filter_pattern``, in a single pass with ``scandir``. Without
+        ``scandir`` each file is examined with a single ``stat`` call.
+        
+        Returns
+        -------
+        
+        dict[str:(int, float)]
+            ``{file_name: (size, mtime)}``
+        """
+        entries = {}
+        scandir = get_scandir()
+        if scandir is not None:
+            for entry in scandir(self.install_dir):
+                if fnmatch.fnmatch(entry.name, filter_pattern):
+                    stat = entry.stat()
+                    entries[entry.name] = (stat.st_size, stat.st_mtime)
+        else:
+            names = fnmatch.filter(os.listdir(self.install_dir), 
+                                   filter_pattern)
+            for name in names:
+                stat = os.stat(path.join(self.install_dir, name))
+                entries[name] = (stat.st_size, stat.st_mtime)
+        return entries
+    
+    def forget_listing(self):
+        """
+        Discard the cached listing, and the manifest on the device. Must be 
+        called when a map has been changed.
+        """
+        self.listing = None
+        try:
+            os.remove(path.join(self.install_dir, self.manifest_name))
+        except OSError:
+            pass
+        
+    def read_listing_manifest(self):
+        """
+        Read the listing from the manifest in ``self.install_dir``. 
+        Returns ``None`` if there is no valid manifest.
+        """
+        try:
+            with open(path.join(self.install_dir, self.manifest_name), 
+                      "r") as fman:
+                listing = json.load(fman)
+            listing["entries"] = {str(name): tuple(entry) for name, entry 
+                                  in listing["entries"].iteritems()}
+            listing["pattern"] = str(listing["pattern"])
+        except (IOError, ValueError, KeyError, AttributeError, TypeError):
+            return None
+        return listing
+    
+    def write_listing_manifest(self):
+        """
+        Store the listing in the manifest in ``self.install_dir``. Does 
+        nothing if the device is not writable.
+        
+        The manifest is written in place, otherwise renaming it would change
+        the modification time of ``self.install_dir``, which invalidates 
+        the listing.
+        """
+        try:
+            with open(path.join(self.install_dir, self.manifest_name), 
+                      "w") as fman:
+                if self.listing is not None:
+                    json.dump(self.listing, fman)
+        except (IOError, OSError):
+            pass
 
 
 class OsmandInstaller(BaseInstaller):
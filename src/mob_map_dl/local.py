@@ -28,27 +28,105 @@ from __future__ import division
 from __future__ import absolute_import              
 
 import time
+import logging
 import os
+import errno
 import fnmatch
 from os import path
 import zipfile
+import zlib
+import hashlib
+import json
+import struct
 import datetime
+import platform
+import threading
+import Queue
+from collections import namedtuple
 
-from mob_map_dl.common import MapMeta, TextProgressBar, PartFile
+from mob_map_dl.common import (MapMeta, TextProgressBar, PartFile, 
+                               MAP_HASH_SUFFIX)
 
 
-#Set up logging fore useful debug output, and time stamps in UTC.
-import logging
-logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
-                    level=logging.DEBUG)
-#Time stamps must be in UTC
-logging.Formatter.converter = time.gmtime
+StoredMap = namedtuple("StoredMap", "entry_name, offset, size, crc")
+#Location of a map, that is stored uncompressed in its archive.
+#    offset: position of the map's data in the archive file
+
+
+class _NoLimit(object):
+    """Stand-in for a ``write_limiter``, that never blocks."""
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, *_):
+        pass
+
+
+_sendfile_cache = []
+#Contains the result of ``get_sendfile`` after the first call.
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+#Error numbers of ``sendfile``, that mean that it can't copy between these
+#files. Other errors (for example ``ENOSPC``) are real I/O errors.
+
+def get_sendfile():
+    """
+    Return a function that copies data between files inside the 
+    operating system's kernel, without passing it through Python:
+    
+        ``sendfile(out_fd, in_fd, offset, count) -> int``
+        
+    Data is read from ``in_fd`` at ``offset``, and written at the current 
+    position of ``out_fd``. Returns the number of copied bytes, raises 
+    ``OSError`` on errors.
+    
+    Uses ``os.sendfile`` if it exists, and the C library's ``sendfile`` 
+    on Linux otherwise. Returns ``None`` if neither is available.
+    """
+    if _sendfile_cache:
+        return _sendfile_cache[0]
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile is None and platform.system() == "Linux":
+        try:
+            import ctypes
+            c_sendfile = ctypes.CDLL(None, use_errno=True).sendfile
+            c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, 
+                                   ctypes.POINTER(ctypes.c_int64), 
+                                   ctypes.c_size_t]
+            c_sendfile.restype = ctypes.c_ssize_t
+        except (ImportError, OSError, AttributeError):
+            c_sendfile = None
+        if c_sendfile is not None:
+            def sendfile(out_fd, in_fd, offset, count):
+                "Call ``sendfile`` from the C library."
+                c_offset = ctypes.c_int64(offset)
+                num_copied = c_sendfile(out_fd, in_fd, ctypes.byref(c_offset),
+                                        count)
+                if num_copied < 0:
+                    err_num = ctypes.get_errno()
+                    raise OSError(err_num, os.strerror(err_num))
+                return num_copied
+    _sendfile_cache.append(sendfile)
+    return sendfile
 
 
 class BaseManager(object):
     """
     Base class for local manager objects.
     """
+    index_name = "archive-index.json"
+    #Name of the file in ``self.download_dir``, that stores the metadata of 
+    #the archives. See: ``get_file_list_base``
+    extract_chunk_size = 1024**2 * 4
+    #Size of the buffers, in which maps are extracted. [Byte]
+    extract_buffers = 4
+    #Number of buffers, that are shared by the reading and the writing 
+    #thread of ``inflate_map``. With one buffer reading and writing 
+    #alternate.
+    verify_archives = False
+    #Compare archives with the hash in their manifest before a map is 
+    #extracted. Costs an additional pass over the archive. 
+    #See: ``check_archive_hash``
+    
     def __init__(self, _application_dir=None):
         """
         Object is initialized with the application's directory by top level, 
@@ -57,6 +135,8 @@ class BaseManager(object):
         self.download_dir = ""
         #Path to directory where the maps are stored. Is accessed by command: 
         # ``dlmap lsd -l`` 
+        self.index_lock = threading.Lock()
+        #Serializes the updates of the archive index. See: ``read_index``
     
     #--- Called by high level algorithms -------------------------------
     def make_disp_name(self, file_path):
@@ -78,7 +158,9 @@ class BaseManager(object):
         """
         raise NotImplementedError()
         
-    def extract_map(self, arch_path, map_path, disp_name):
+    def extract_map(self, arch_path, map_path, disp_name, 
+                    make_progress=TextProgressBar, write_limiter=None,
+                    differential=False):
         """
         Extract a map from its downloaded archive.
         
@@ -97,29 +179,440 @@ class BaseManager(object):
         
         disp_name: str
             Canonical name of the map. Used in the progress bar.
+            
+        make_progress: callable(str, int) -> TextProgressBar
+            Creates the progress bar. For concurrent extractions pass 
+            ``MultiProgressBar.make_bar``.
+            
+        write_limiter: threading.Semaphore | NoneType
+            Is held while data is written to ``map_path``. Limits the 
+            number of concurrent writes to the mobile device, when several 
+            maps are extracted in parallel. Inflating the data is not 
+            limited by it.
+            
+        differential: bool
+            If ``True`` and the map already exists, the map is not written if
+            it is unchanged. See: ``extract_map_differential``
+            
+        The SHA-256 hash of the installed map is stored in a file next to 
+        it (see ``write_map_hash``).
+            
+        The SHA-256 hash of the map is computed while it is written. It is 
+        compared with the hash in the archive's manifest, or stored there 
+        if the manifest contains no hash of the map. See: ``check_map_hash``
+        With ``self.verify_archives`` the archive is additionally compared 
+        with the hash in its manifest, before anything is written (see 
+        ``check_archive_hash``).
+        
+        Maps that are stored uncompressed in their archives are copied by 
+        the operating system, if it can (see ``copy_stored_map``), and if 
+        an earlier extraction has checked their CRC-32 and recorded their 
+        hash in the manifest. The map is then not read by Python at all.
         """
+        if differential and path.isfile(map_path):
+            return self.extract_map_differential(arch_path, map_path, 
+                                    disp_name, make_progress, write_limiter)
+        #The hash of the old map would match the new map by accident, 
+        #if it has the same size and time stamp.
+        if path.exists(self.get_map_hash_path(map_path)):
+            os.remove(self.get_map_hash_path(map_path))
+        
+        if self.verify_archives:
+            self.check_archive_hash(arch_path)
         fext = PartFile(map_path, "wb")
-        fzip, size_total, _ = self.get_map_extractor(arch_path)
+        write_limiter = write_limiter or _NoLimit()
+        stored = None
+        if get_sendfile() is not None:
+            stored = self.find_stored_map(arch_path)
+            manifest = self.read_manifest(arch_path)
+            #Unchecked maps are read in Python, which checks the CRC-32
+            if stored is not None and (manifest is None or 
+                            manifest.get("map_name") != stored.entry_name or
+                            manifest.get("map_size") != stored.size):
+                stored = None
+        if stored is None:
+            fzip, size_total, _ = self.get_map_extractor(arch_path)
+        else:
+            size_total = stored.size
         
         size_mib = round(size_total / 1024**2, 1)
         msg = "{name} : {size} MiB".format(name=disp_name[0:50], size=size_mib)
-        progress = TextProgressBar(msg, val_max=size_total)
+        progress = make_progress(msg, size_total)
         progress.update_val(0)
         
-        buff_size = 1024**2 * 10
         size_down = 0
-        while True:
-            progress.update_val(size_down)
-            buf = fzip.read(buff_size)
-            if not buf:
-                break
-            fext.write(buf)
-            size_down += len(buf)
-            
-        fzip.close()
+        try:
+            if stored is not None:
+                try:
+                    size_down = self.copy_stored_map(arch_path, stored, fext, 
+                                                     progress, write_limiter)
+                    entry_name = stored.entry_name
+                    sha256 = manifest["map_sha256"]
+                except OSError, err:
+                    if err.errno not in SENDFILE_UNSUPPORTED:
+                        raise
+                    #The file system can't ``sendfile``; copy in Python.
+                    logging.debug("Can't copy with sendfile: %s", err)
+                    fext.seek(0)
+                    fext.truncate()
+                    fzip, _, _ = self.get_map_extractor(arch_path)
+                    stored = None
+            if stored is None:
+                entry_name, size_down, sha256 = self.inflate_map(
+                                fzip, fext, progress, write_limiter)
+            self.check_map_hash(arch_path, entry_name, size_down, sha256)
+        except:                                     #IGNORE:W0702
+            fext.close_unfinished()
+            os.remove(fext.name)
+            progress.update_final(size_down, "Corrupted")
+            raise
         fext.close()
+        self.write_map_hash(map_path, sha256)
         progress.update_final(size_down, "Installed")
         
+    def inflate_map(self, fzip, fext, progress, write_limiter):
+        """
+        Copy the map from the file like object ``fzip`` (see 
+        ``get_map_extractor``) to ``fext``. Arguments as in ``extract_map``.
+        
+        Reading and inflating happens in the calling thread, writing in a
+        second thread, so that the CPU and the device work at the same 
+        time. The threads pass a small pool of buffers 
+        (``self.extract_buffers``) back and forth; the memory consumption 
+        is therefore constant.
+        
+        Returns
+        -------
+        
+        entry_name: str
+            Name of the map's entry in the archive.
+        
+        size, sha256: int, str
+            Size and SHA-256 hash (hex digest) of the extracted map.
+        """
+        free_buffers = Queue.Queue()
+        for _ in range(max(self.extract_buffers, 1)):
+            free_buffers.put(bytearray(self.extract_chunk_size))
+        full_buffers = Queue.Queue()
+        write_errors = []
+        
+        def write_buffers():
+            "Write the full buffers to ``fext``, and return them to the pool."
+            while True:
+                item = full_buffers.get()
+                if item is None:
+                    break
+                buf, num_bytes = item
+                try:
+                    if not write_errors:
+                        with write_limiter:
+                            fext.write(memoryview(buf)[:num_bytes])
+                except BaseException, err:            #IGNORE:W0703
+                    write_errors.append(err)
+                free_buffers.put(buf)
+        
+        writer = threading.Thread(target=write_buffers, name="map-writer")
+        writer.daemon = True
+        writer.start()
+        sha256 = hashlib.sha256()
+        size_down = 0
+        try:
+            while not write_errors:
+                progress.update_val(size_down)
+                buf = free_buffers.get()
+                num_bytes = fzip.readinto(buf)
+                if not num_bytes:
+                    break
+                sha256.update(memoryview(buf)[:num_bytes])
+                size_down += num_bytes
+                full_buffers.put((buf, num_bytes))
+        finally:
+            full_buffers.put(None)
+            writer.join()
+            fzip.close()
+        if write_errors:
+            raise write_errors[0]
+        return fzip.name, size_down, sha256.hexdigest()
+        
+    def copy_stored_map(self, arch_path, stored, fext, progress, 
+                        write_limiter):
+        """
+        Copy a map, that is stored uncompressed in its archive, from the 
+        archive to ``fext``. The data is copied inside the operating 
+        system's kernel, with ``sendfile``; it is not read by Python, and 
+        therefore not checked. ``extract_map`` uses this method only for 
+        maps, that an earlier extraction has checked.
+        
+        Arguments as in ``extract_map``; ``stored`` comes from 
+        ``find_stored_map``. 
+        
+        Returns
+        -------
+        
+        int
+            Size of the copied map.
+        
+        Raises
+        ------
+        
+        IOError
+            If the archive is truncated.
+            
+        OSError
+            If ``sendfile`` does not work for these files (error numbers in
+            ``SENDFILE_UNSUPPORTED``), or if copying fails.
+        """
+        sendfile = get_sendfile()
+        buff_size = 1024**2 * 10
+        fext.flush()
+        size_down = 0
+        with open(arch_path, "rb") as farch:
+            while size_down < stored.size:
+                progress.update_val(size_down)
+                count = min(buff_size, stored.size - size_down)
+                with write_limiter:
+                    num_copied = sendfile(fext.fileno(), farch.fileno(), 
+                                          stored.offset + size_down, count)
+                if num_copied == 0:
+                    raise IOError("Archive is truncated: " + arch_path)
+                size_down += num_copied
+        return size_down
+        
+    def extract_map_differential(self, arch_path, map_path, disp_name, 
+                                 make_progress=TextProgressBar, 
+                                 write_limiter=None):
+        """
+        Update an installed map, and skip writing it if it has not changed.
+        Saves time, and the write endurance of SD cards. Arguments as in 
+        ``extract_map``.
+        
+        The SHA-256 hash of the new map is taken from the archive's 
+        manifest, where the first extraction of the archive has stored it 
+        (see ``check_map_hash``). The hash of the installed map is taken 
+        from the file next to it (see ``read_map_hash``). Neither the 
+        archive nor the installed map is read for the comparison. 
+        
+        If the hashes are equal, nothing is written. Otherwise, or if a hash
+        is unknown, the whole map is installed by ``extract_map``; the 
+        installed map is replaced by renaming, and is therefore always 
+        either the old or the new version.
+        """
+        manifest = self.read_manifest(arch_path)
+        old_sha256 = self.read_map_hash(map_path)
+        if manifest is None or old_sha256 is None or \
+           manifest.get("map_sha256") != old_sha256 or \
+           manifest.get("map_size") != path.getsize(map_path):
+            return self.extract_map(arch_path, map_path, disp_name, 
+                                    make_progress, write_limiter)
+        
+        size_total = manifest["map_size"]
+        size_mib = round(size_total / 1024**2, 1)
+        msg = "{name} : {size} MiB".format(name=disp_name[0:50], size=size_mib)
+        progress = make_progress(msg, size_total)
+        progress.update_final(size_total, "Unchanged")
+    
+    def get_map_hash_path(self, map_path):
+        """Return the path of the file with the hash of an installed map."""
+        return map_path + MAP_HASH_SUFFIX
+    
+    def read_map_hash(self, map_path):
+        """
+        Return the SHA-256 hash of an installed map. The hash is read from 
+        a file next to the map, that is written by ``write_map_hash``. The 
+        map itself is not read.
+        
+        Returns
+        -------
+        
+        str | NoneType
+            Hex digest of the map. ``None`` if the file is missing, or the 
+            map's size or modification time have changed since it was 
+            written.
+        """
+        try:
+            with open(self.get_map_hash_path(map_path), "r") as fhash:
+                record = json.load(fhash)
+            if record.get("map_size") == path.getsize(map_path) and \
+               record.get("map_mtime") == path.getmtime(map_path):
+                return str(record["map_sha256"])
+        except (IOError, OSError, ValueError, AttributeError, KeyError):
+            pass
+        return None
+    
+    def write_map_hash(self, map_path, sha256):
+        """
+        Store the SHA-256 hash of an installed map, with the map's current 
+        size and modification time. Does nothing if the file can't be 
+        written.
+        """
+        record = {"map_size": path.getsize(map_path), 
+                  "map_mtime": path.getmtime(map_path),
+                  "map_sha256": sha256}
+        try:
+            with PartFile(self.get_map_hash_path(map_path), "w") as fhash:
+                json.dump(record, fhash)
+        except (IOError, OSError):
+            pass
+        
+    def make_stream_extractor(self, map_path):
+        """
+        Create an object that extracts a map from its archive, while the 
+        archive is downloaded. See: ``ZipStreamExtractor``
+        
+        Argument
+        --------
+        
+        map_path: str
+            Path where the extracted map should be stored. For example
+            a mobile device's SD card.
+        """
+        return ZipStreamExtractor(map_path, self.is_map_entry)
+    
+    def get_manifest_path(self, arch_path):
+        """
+        Return the path of the manifest of an archive. The manifest is a 
+        JSON file next to the archive, that contains SHA-256 hashes of the 
+        archive and of the map in it.
+        """
+        return arch_path + ".manifest.json"
+        
+    def read_manifest(self, arch_path):
+        """
+        Read the manifest of an archive. Manifests of archives, whose size 
+        or modification time have changed since the manifest was written, 
+        are ignored.
+        
+        Returns
+        -------
+        
+        dict[str:object] | NoneType
+            Keys: "archive_size", "archive_mtime", "archive_sha256", 
+            and optionally "map_name", "map_size", "map_sha256".
+            ``None`` if there is no valid manifest.
+        """
+        try:
+            with open(self.get_manifest_path(arch_path), "r") as fman:
+                manifest = json.load(fman)
+        except (IOError, ValueError):
+            return None
+        if manifest.get("archive_size") != path.getsize(arch_path) or \
+           manifest.get("archive_mtime") != path.getmtime(arch_path):
+            return None
+        return manifest
+    
+    def write_manifest(self, arch_path, manifest):
+        """
+        Write the manifest of an archive. The archive's current size and 
+        modification time are added to it.
+        """
+        manifest = dict(manifest, archive_size=path.getsize(arch_path), 
+                        archive_mtime=path.getmtime(arch_path))
+        with PartFile(self.get_manifest_path(arch_path), "w") as fman:
+            json.dump(manifest, fman)
+        
+    def record_archive_hash(self, arch_path, sha256):
+        """
+        Create a new manifest for a freshly downloaded archive.
+        
+        Arguments
+        ---------
+        
+        arch_path: str
+            Path of the archive.
+            
+        sha256: str
+            SHA-256 hash of the archive (hex digest), that was computed 
+            during the download.
+        """
+        self.write_manifest(arch_path, {"archive_sha256": sha256})
+        
+    def check_archive_hash(self, arch_path):
+        """
+        Compare the hash of an archive with the hash in its manifest, that
+        was computed during the download. Detects archives that were 
+        damaged on the local disk after the download. Archives without 
+        manifest are not checked.
+        
+        This is an additional pass over the archive, therefore it is only
+        done with ``self.verify_archives``. Without it, damaged maps are 
+        detected by the CRC-32 of the zip archive, and by ``check_map_hash``.
+        
+        Raises
+        ------
+        
+        IOError
+            If the hashes are different.
+        """
+        manifest = self.read_manifest(arch_path)
+        if manifest is None or "archive_sha256" not in manifest:
+            return
+        sha256 = hashlib.sha256()
+        with open(arch_path, "rb") as farch:
+            while True:
+                buf = farch.read(self.extract_chunk_size)
+                if not buf:
+                    break
+                sha256.update(buf)
+        if sha256.hexdigest() != manifest["archive_sha256"]:
+            raise IOError("Archive is different from the downloaded "
+                          "archive: {}".format(arch_path))
+        
+    def check_map_hash(self, arch_path, map_name, map_size, map_sha256):
+        """
+        Compare the hash of an extracted map with the hash in the archive's
+        manifest. If the manifest contains no hash of the map, the hash is 
+        stored in it. Archives without manifest are not checked.
+        
+        Arguments
+        ---------
+        
+        arch_path: str
+            Path of the archive.
+            
+        map_name: str
+            Name of the map's entry in the archive.
+        
+        map_size, map_sha256: int, str
+            Size and SHA-256 hash (hex digest) of the extracted map.
+            
+        Raises
+        ------
+        
+        IOError
+            If the hashes are different.
+        """
+        manifest = self.read_manifest(arch_path)
+        if manifest is None:
+            return
+        if manifest.get("map_name") != map_name:
+            manifest.update(map_name=map_name, map_size=map_size, 
+                            map_sha256=map_sha256)
+            self.write_manifest(arch_path, manifest)
+        elif manifest["map_size"] != map_size or \
+             manifest["map_sha256"] != map_sha256:
+            raise IOError("Extracted map is different from the map that was "
+                          "extracted before: {}: {}".format(arch_path, 
+                                                            map_name))
+        
+    def is_map_entry(self, entry_name, entry_index):
+        """
+        Return ``True`` if an entry of an archive is the map. The first 
+        entry, for which the function returns ``True``, is extracted.
+        
+        This function knows the internal structure of the archives that 
+        contain the maps. 
+        
+        Arguments
+        ---------
+        
+        entry_name: str
+            File name of the entry in the zip archive.
+            
+        entry_index: int
+            Position of the entry in the archive.
+        """
+        raise NotImplementedError()
+        
     # --- Used internally -----------------------------------------------
     def get_map_extractor(self, archive_path):
         """
@@ -151,11 +644,120 @@ class BaseManager(object):
         """
         raise NotImplementedError()
     
+    def read_map_info(self, archive_path):
+        """
+        Read the metadata of the map from the central directory of its 
+        archive. The map is the first entry for which ``is_map_entry`` 
+        returns ``True``.
+        
+        Returns
+        -------
+        
+        entry_name: str
+            Name of the map's entry in the archive.
+            
+        size_total: int
+            Uncompressed size of the map.
+            
+        date_time: tuple(int)
+            Modification time of the map, from the zip archive:
+            (year, month, day, hour, minute, second)
+        """
+        zip_container = zipfile.ZipFile(archive_path, "r")
+        try:
+            for i, map_info in enumerate(zip_container.infolist()):
+                if self.is_map_entry(map_info.filename, i):
+                    return (map_info.filename, map_info.file_size, 
+                            map_info.date_time)
+        finally:
+            zip_container.close()
+        raise ValueError("No map found in archive: " + archive_path)
+    
+    def find_stored_map(self, archive_path):
+        """
+        Find the map in its archive, if it is stored uncompressed 
+        (``ZIP_STORED``). The map is the first entry for which 
+        ``is_map_entry`` returns ``True``.
+        
+        Returns
+        -------
+        
+        StoredMap | NoneType
+            Position of the map's data in the archive. ``None`` if the map
+            is compressed or encrypted.
+        """
+        zip_container = zipfile.ZipFile(archive_path, "r")
+        try:
+            for i, map_info in enumerate(zip_container.infolist()):
+                if self.is_map_entry(map_info.filename, i):
+                    break
+            else:
+                return None
+            if map_info.compress_type != zipfile.ZIP_STORED or \
+               map_info.flag_bits & 0x1:
+                return None
+            #The data follows the local file header, whose file name and 
+            #extra field can differ from the central directory. 
+            zip_container.fp.seek(map_info.header_offset)
+            header = zip_container.fp.read(
+                                    ZipStreamExtractor.header_struct.size)
+            fields = ZipStreamExtractor.header_struct.unpack(header)
+            if fields[0] != ZipStreamExtractor.header_sig:
+                return None
+            offset = map_info.header_offset + len(header) + fields[9] + \
+                     fields[10]
+            return StoredMap(map_info.filename, offset, map_info.file_size, 
+                             map_info.CRC)
+        finally:
+            zip_container.close()
+    
+    def get_index_path(self):
+        """Return the path of the index of the archives."""
+        return path.join(self.download_dir, self.index_name)
+    
+    def read_index(self):
+        """
+        Read the index of the archives. Returns an empty ``dict`` if the 
+        index does not exist, or can't be read.
+        
+        Returns
+        -------
+        
+        dict[str:dict[str:object]]
+            ``{file_name: entry}``, entry has keys: "size", "mtime" 
+            (of the archive), "entry_name", "map_size", "map_date_time".
+        """
+        try:
+            with open(self.get_index_path(), "r") as findex:
+                index = json.load(findex)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(index, dict):
+            return {}
+        #Use byte strings for file names, like ``os.listdir``.
+        return {name.encode("utf-8"): entry for name, entry in index.items()}
+    
+    def write_index(self, index):
+        """
+        Write the index of the archives. Does nothing if 
+        ``self.download_dir`` is not writable.
+        """
+        try:
+            with PartFile(self.get_index_path(), "w") as findex:
+                json.dump(index, findex)
+        except (IOError, OSError):
+            pass
+        
     def get_file_list_base(self, filter_pattern):
         """
         Return a list of locally stored maps. Maps are searched in 
         ``self.download_dir``.
         
+        The metadata of the archives is stored in an index (see 
+        ``read_index``). Only archives, that are not in the index, or 
+        whose size or modification time has changed, are opened and 
+        scanned.
+        
         Argument
         --------
         
@@ -172,21 +774,320 @@ class BaseManager(object):
         map_names = fnmatch.filter(dir_names, filter_pattern)
         map_names.sort()
         
-        map_metas = []
-        for name in map_names:
-            archive_name = path.join(self.download_dir, name)
-            disp_name = self.make_disp_name(name)
-            _, size_total, date_time = self.get_map_extractor(archive_name)
-            map_meta = MapMeta(disp_name=disp_name, 
-                               full_name=archive_name, 
-                               size=size_total, 
-                               time=date_time, 
-                               description="", 
-                               map_type=None)
-            map_metas.append(map_meta)
-        
+        with self.index_lock:
+            index = self.read_index()
+            new_index = {}
+            map_metas = []
+            for name in map_names:
+                archive_name = path.join(self.download_dir, name)
+                entry = self.make_index_entry(archive_name, index.get(name))
+                new_index[name] = entry
+                map_metas.append(self.make_map_meta(archive_name, entry))
+            
+            #Removed archives disappear from the index too.
+            if new_index != index:
+                self.write_index(new_index)
         return map_metas
     
+    def get_map_meta(self, archive_name):
+        """
+        Return the metadata of a single archive, for example after it has
+        been downloaded. The archive's entry in the index is updated.
+        
+        Returns
+        -------
+        
+        MapMeta
+        """
+        name = path.basename(archive_name)
+        with self.index_lock:
+            index = self.read_index()
+            entry = self.make_index_entry(archive_name, index.get(name))
+            if entry != index.get(name):
+                index[name] = entry
+                self.write_index(index)
+        return self.make_map_meta(archive_name, entry)
+    
+    def make_index_entry(self, archive_name, entry):
+        """
+        Return the index entry of an archive. The old ``entry`` is returned
+        if the archive has not changed, otherwise the archive is scanned.
+        See: ``read_index``
+        """
+        arch_stat = os.stat(archive_name)
+        if entry is None or entry.get("size") != arch_stat.st_size or \
+           entry.get("mtime") != arch_stat.st_mtime:
+            entry_name, size_total, date_time = \
+                                    self.read_map_info(archive_name)
+            entry = {"size": arch_stat.st_size, 
+                     "mtime": arch_stat.st_mtime,
+                     "entry_name": entry_name, 
+                     "map_size": size_total, 
+                     "map_date_time": list(date_time)}
+        return entry
+    
+    def make_map_meta(self, archive_name, entry):
+        """Create the ``MapMeta`` of an archive from its index entry."""
+        return MapMeta(disp_name=self.make_disp_name(archive_name), 
+                       full_name=archive_name, 
+                       size=entry["map_size"], 
+                       time=datetime.datetime(*entry["map_date_time"]), 
+                       description="", 
+                       map_type=None)
+
+
+class ZipStreamExtractor(object):
+    """
+    Extract a map from a zip archive, while the archive is downloaded.
+    
+    The data of the archive is passed to ``write`` in the order in which it 
+    is downloaded. The local file headers of the archive are parsed, and the 
+    map is inflated and written to ``map_path`` immediately. The central 
+    directory at the end of the archive is not needed.
+    
+    Errors don't interrupt the download: When the map can't be extracted,
+    for example because the archive has an unexpected format, the extraction
+    is stopped, and ``close`` returns ``False``. The map should then be 
+    extracted from the downloaded archive, with ``BaseManager.extract_map``.
+    
+    Usage::
+    
+        extractor = ZipStreamExtractor(map_path, manager.is_map_entry)
+        for buf in download:
+            extractor.write(buf)
+        if not extractor.close():
+            manager.extract_map(arch_path, map_path, disp_name)
+    """
+    header_struct = struct.Struct("<4sHHHHHIIIHH")
+    #Local file header of zip archives, without file name and extra field.
+    header_sig = "PK\x03\x04"
+    descriptor_sig = "PK\x07\x08"
+    
+    def __init__(self, map_path, is_map_entry):
+        """
+        map_path: str
+            Path where the extracted map should be stored. For example
+            a mobile device's SD card.
+            
+        is_map_entry: callable(str, int) -> bool
+            Decides if an entry of the archive is the map. Is called with 
+            the entry's file name and its index. See: 
+            ``BaseManager.is_map_entry``
+        """
+        self.map_path = map_path
+        self.is_map_entry = is_map_entry
+        self.state = "header"
+        #Current state of the parser: 
+        #    "header", "data", "descriptor", "done", "failed"
+        self.error = None
+        #Reason why the map could not be extracted.
+        self.buff = ""
+        #Data that is not yet processed.
+        self.entry_index = 0
+        self.entry = None
+        #Information about the current entry: 
+        #    dict(name, method, flags, crc, size, csize, zip64, is_map)
+        self.remaining = None
+        #Compressed bytes of the current entry, that were not yet processed.
+        #``None`` if the size is only stored in the data descriptor.
+        self.decompressor = None
+        self.crc = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        #CRC, size and SHA-256 hash of the extracted data
+        self.fmap = None
+        
+    def write(self, data):
+        """Process the next chunk of the archive's data."""
+        if self.state in ("done", "failed"):
+            return
+        self.buff += data
+        try:
+            while self.buff and self.state not in ("done", "failed"):
+                if self.state == "header":
+                    if not self.parse_header():
+                        break
+                elif self.state == "data":
+                    self.process_data()
+                elif self.state == "descriptor":
+                    if not self.parse_descriptor():
+                        break
+        except Exception, err:                              #IGNORE:W0703
+            self.fail(str(err))
+    
+    def close(self):
+        """
+        Finish the extraction. Must be called after the whole archive has
+        been passed to ``write``.
+        
+        Returns
+        -------
+        
+        bool
+            ``True`` if the map has been extracted and verified.
+        """
+        if self.state != "done":
+            self.fail("Archive ended before the map was extracted.")
+            return False
+        return True
+        
+    def abort(self):
+        """Stop the extraction, and remove the partially extracted map."""
+        self.fail("Aborted.")
+    
+    def fail(self, reason):
+        """Stop the extraction because of an error."""
+        if self.state in ("done", "failed"):
+            return
+        logging.debug("Streaming extraction failed: %s: %s", 
+                      self.map_path, reason)
+        self.state = "failed"
+        self.error = reason
+        self.buff = ""
+        if self.fmap is not None:
+            self.fmap.close_unfinished()
+            os.remove(self.fmap.name)
+            self.fmap = None
+    
+    def parse_header(self):
+        """
+        Parse the local file header of the next entry. Returns ``False``
+        if more data is needed.
+        """
+        hsize = self.header_struct.size
+        if len(self.buff) < 4:
+            return False
+        if not self.buff.startswith(self.header_sig):
+            #Central directory reached without finding the map
+            raise ValueError("No map found in archive.")
+        if len(self.buff) < hsize:
+            return False
+        (_, _, flags, method, _, _, crc, csize, size, name_len, 
+         extra_len) = self.header_struct.unpack(self.buff[:hsize])
+        if len(self.buff) < hsize + name_len + extra_len:
+            return False
+        name = self.buff[hsize:hsize + name_len]
+        #Decode the name like ``zipfile``
+        name = name.decode("utf-8") if flags & 0x800 else name
+        extra = self.buff[hsize + name_len:hsize + name_len + extra_len]
+        self.buff = self.buff[hsize + name_len + extra_len:]
+        
+        zip64 = False
+        if csize == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            size, csize = self.parse_zip64_extra(extra, size, csize)
+            zip64 = True
+        is_map = self.is_map_entry(name, self.entry_index)
+        self.entry = dict(name=name, method=method, flags=flags, crc=crc, 
+                          size=size, csize=csize, zip64=zip64, is_map=is_map)
+        has_descriptor = bool(flags & 0x08)
+        self.remaining = None if has_descriptor else csize
+        
+        if flags & 0x01:
+            raise ValueError("Encrypted archive.")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError("Unsupported compression method: {}"
+                             .format(method))
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            raise ValueError("Size of entry is unknown: " + name)
+        
+        self.decompressor = None
+        if method == zipfile.ZIP_DEFLATED and (is_map or has_descriptor):
+            #Entries of unknown size must be inflated to find their end.
+            self.decompressor = zlib.decompressobj(-15)
+        if is_map:
+            self.fmap = PartFile(self.map_path, "wb")
+        self.state = "data"
+        return True
+        
+    def parse_zip64_extra(self, extra, size, csize):
+        """Get the sizes of large entries from the Zip64 extra field."""
+        while len(extra) >= 4:
+            field_id, field_len = struct.unpack("<HH", extra[:4])
+            if field_id == 0x0001:
+                field = extra[4:4 + field_len]
+                if size == 0xFFFFFFFF:
+                    size, = struct.unpack("<Q", field[:8])
+                    field = field[8:]
+                if csize == 0xFFFFFFFF:
+                    csize, = struct.unpack("<Q", field[:8])
+                return size, csize
+            extra = extra[4 + field_len:]
+        raise ValueError("Zip64 extra field is missing.")
+        
+    def process_data(self):
+        """Process (part of) the compressed data of the current entry."""
+        if self.remaining is not None:
+            data = self.buff[:self.remaining]
+            self.buff = self.buff[len(data):]
+            self.remaining -= len(data)
+            finished = self.remaining == 0
+        else:
+            data, self.buff = self.buff, ""
+            finished = False
+        
+        if self.decompressor is not None:
+            out_data = self.decompressor.decompress(data)
+            if self.decompressor.unused_data:
+                #End of a deflate stream with unknown size
+                self.buff = self.decompressor.unused_data + self.buff
+                finished = True
+            if finished:
+                out_data += self.decompressor.flush()
+        else:
+            out_data = data
+        
+        if self.entry["is_map"] and out_data:
+            self.fmap.write(out_data)
+            self.crc = zlib.crc32(out_data, self.crc)
+            self.sha256.update(out_data)
+            self.size += len(out_data)
+        
+        if finished:
+            if self.entry["flags"] & 0x08:
+                self.state = "descriptor"
+            else:
+                self.finish_entry(self.entry["crc"], self.entry["size"])
+    
+    def parse_descriptor(self):
+        """
+        Parse the data descriptor, that follows entries whose size was not
+        known when the archive was created. Returns ``False`` if more data 
+        is needed.
+        """
+        if len(self.buff) < 4:
+            return False
+        #The signature of the data descriptor is optional
+        sig_len = 4 if self.buff.startswith(self.descriptor_sig) else 0
+        if self.entry["zip64"]:
+            desc_struct = struct.Struct("<IQQ")
+        else:
+            desc_struct = struct.Struct("<III")
+        if len(self.buff) < sig_len + desc_struct.size:
+            return False
+        crc, _, size = desc_struct.unpack(
+                            self.buff[sig_len:sig_len + desc_struct.size])
+        self.buff = self.buff[sig_len + desc_struct.size:]
+        self.finish_entry(crc, size)
+        return True
+    
+    def finish_entry(self, crc, size):
+        """
+        The current entry is complete. Verify and close the map, or go to 
+        the next entry.
+        """
+        if not self.entry["is_map"]:
+            self.entry_index += 1
+            self.state = "header"
+            return
+        if self.crc & 0xFFFFFFFF != crc or self.size != size:
+            raise ValueError("Bad CRC or size of extracted map: " + 
+                             self.entry["name"])
+        self.fmap.close()
+        self.fmap = None
+        self.state = "done"
+        self.buff = ""
+
+
 class OsmandManager(BaseManager):
     """
     Manage locally stored maps for Osmand.
@@ -270,6 +1171,13 @@ class OsmandManager(BaseManager):
         fzip = zip_container.open(zip_fname, "r")
         
         return fzip, size_total, mod_time
+    
+    def is_map_entry(self, entry_name, entry_index):
+        """
+        Return ``True`` if an entry of an archive is the map. 
+        The map is the first entry of the archive.
+        """
+        return entry_index == 0
 
 
 class OpenandromapsManager(BaseManager):
@@ -356,8 +1264,8 @@ class OpenandromapsManager(BaseManager):
 #        print zip_fnames
         zip_finfos = zip_container.infolist()
         
-        for map_info in zip_finfos:
-            if map_info.filename.endswith(".map"):
+        for i, map_info in enumerate(zip_finfos):
+            if self.is_map_entry(map_info.filename, i):
                 break
         else:
             raise ValueError("No *.map file found in archive.")
@@ -369,5 +1277,9 @@ class OpenandromapsManager(BaseManager):
         
         return fzip, size_total, mod_time
         
-
-        
\ No newline at end of file
+    def is_map_entry(self, entry_name, entry_index):
+        """
+        Return ``True`` if an entry of an archive is the map. 
+        The map is the first "*.map" file of the archive.
+        """
+        return entry_name.endswith(".map")
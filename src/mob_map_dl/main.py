@@ -30,24 +30,97 @@ from __future__ import absolute_import
 import time
 import argparse
 import sys
-import fnmatch
+import threading
 import os.path as path
 import os
 import platform
 import subprocess
+import re
+import json
+import datetime
 
-from mob_map_dl.common import items_sorted, VERSION
-from mob_map_dl.download import OsmandDownloader, OpenandromapsDownloader
+from mob_map_dl.common import (items_sorted, VERSION, TextProgressBar, 
+                               MultiProgressBar, run_parallel, PatternMatcher,
+                               WorkerPool)
+from mob_map_dl.ratelimit import parse_rate, parse_schedule
 from mob_map_dl.local import OsmandManager, OpenandromapsManager
 from mob_map_dl.install import OsmandInstaller, OruxmapsInstaller
 
 
-#Set up logging fore useful debug output, and time stamps in UTC.
-import logging
-logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
-                    level=logging.DEBUG)
-#Time stamps must be in UTC
-logging.Formatter.converter = time.gmtime
+def filter_maps(map_metas, matcher, min_size=None, max_size=None, 
+                newer_than=None, older_than=None):
+    """
+    Return the maps that match all conditions. ``matcher`` is a 
+    ``PatternMatcher``. See ``AppHighLevel.get_filtered_map_list``.
+    """
+    matches = []
+    for map_ in matcher.filter(map_metas):
+        if (min_size is not None and map_.size < min_size) or \
+           (max_size is not None and map_.size > max_size) or \
+           (newer_than is not None and map_.time <= newer_than) or \
+           (older_than is not None and map_.time >= older_than):
+            continue
+        matches.append(map_)
+    return matches
+
+
+def parse_rate_arg(rate_str):
+    """
+    Parse the argument of ``--limit-rate``. Errors are reported by 
+    ``argparse``. See: ``ratelimit.parse_rate``
+    """
+    try:
+        return parse_rate(rate_str)
+    except ValueError, err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def parse_schedule_arg(schedule_str):
+    """
+    Parse the argument of ``--limit-schedule``. Errors are reported by 
+    ``argparse``. See: ``ratelimit.parse_schedule``
+    """
+    try:
+        return parse_schedule(schedule_str)
+    except ValueError, err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+class SyncPlan(object):
+    """
+    The work, that transforms a list of destination files into a list of 
+    source files. Created by ``AppHighLevel.plan_sync``.
+    
+    Attributes
+    
+    adds: list[MapMeta]
+        Source files, that don't exist at the destination.
+        
+    updates: list[MapMeta]
+        Source files, whose destination files must be replaced.
+        
+    deletes: list[MapMeta]
+        Destination files, that don't exist at the source.
+        
+    unchanged: list[MapMeta]
+        Source files, whose destination files are up to date.
+        
+    work: list[MapMeta]
+        ``adds`` and ``updates`` in the order of the source list. The items 
+        are independent of each other, and can be processed in parallel, 
+        for example by ``AppHighLevel.download_files``.
+    """
+    def __init__(self):
+        self.adds = []
+        self.updates = []
+        self.deletes = []
+        self.unchanged = []
+        self.work = []
+        
+    def __repr__(self):
+        return "SyncPlan(adds={}, updates={}, deletes={}, unchanged={})" \
+               .format(len(self.adds), len(self.updates), len(self.deletes), 
+                       len(self.unchanged))
 
 
 class AppHighLevel(object):
@@ -57,9 +130,25 @@ class AppHighLevel(object):
     """
     app_directory_choices = ["~/Downloads/mobile-map-downloader", 
                              "~/mobile-map-downloader"]
+    mountinfo_path = "/proc/self/mountinfo"
+    #The mounted file systems, read by ``find_mobile_devices`` on Linux.
+    device_cache_name = "mobile-devices.json"
+    #File in the application directory, that stores the found devices.
+    time_tolerance = datetime.timedelta(seconds=2)
+    #Source files must be newer than destination files by more than this, 
+    #to be replaced. (FAT file systems store times with 2 s resolution.)
     def __init__(self):
         self.app_directory = None
         self.mobile_device = None
+        self.background_refresh = False
+        #Use outdated lists of maps, and refresh them in the background.
+        self.device_manifest = False
+        #Store the listing of the mobile device on the device, so that the 
+        #next run does not need to scan it.
+        self.listings = None
+        #Snapshot of the listings of the local managers and installers, 
+        #while a command runs: ``{lister: [MapMeta]}``. See: ``get_listing``
+        self.listing_lock = threading.Lock()
         #Low level components
         self.downloaders = {}
         self.local_managers = {}
@@ -67,11 +156,20 @@ class AppHighLevel(object):
 
     #--- Initialization
     def create_low_level_components(self, app_directory = None, 
-                                    mobile_device = None):
+                                    mobile_device = None, find_devices=True,
+                                    find_servers=True):
         """
         Create low level components that do the real work. 
         Must be called before the application can do anything useful.
         
+        With ``find_devices=False`` no mobile devices are searched, for 
+        commands that don't need ``self.installers``. A device in 
+        ``self.mobile_device`` is still used.
+        
+        With ``find_servers=False`` no downloaders are created, for commands 
+        that don't need ``self.downloaders``. The module ``download``, and 
+        the libraries for HTTP and HTML, are then not loaded.
+        
         Some components need additional resources:
         
         * ``self.local_managers`` need a writable directory to store downloaded
@@ -92,7 +190,7 @@ class AppHighLevel(object):
         if not self.app_directory:
             self.app_directory = self.create_app_directory()
         
-        if not self.mobile_device:
+        if not self.mobile_device and find_devices:
             dev_list = self.find_mobile_devices()
             if len(dev_list) == 1:
                 self.mobile_device = dev_list[0]
@@ -102,8 +200,14 @@ class AppHighLevel(object):
                     print device
             
         #Create downloaders, they can function without ``app_directory``
-        self.downloaders = {"osmand": OsmandDownloader(self.app_directory),
-                            "oam": OpenandromapsDownloader(self.app_directory)}
+        if find_servers:
+            from mob_map_dl.download import (OsmandDownloader, 
+                                             OpenandromapsDownloader)
+            self.downloaders = {
+                        "osmand": OsmandDownloader(self.app_directory),
+                        "oam": OpenandromapsDownloader(self.app_directory)}
+            for downloader in self.downloaders.values():
+                downloader.background_refresh = self.background_refresh
         #Create local managers, they need a directory to store the maps
         if self.app_directory:
             self.local_managers = {
@@ -117,11 +221,13 @@ class AppHighLevel(object):
                 self.installers = {
                                 "osmand": OsmandInstaller(self.mobile_device),
                                 "oam": OruxmapsInstaller(self.mobile_device)}
+                for installer in self.installers.values():
+                    installer.use_manifest = self.device_manifest
             except OSError, err:
                 print "Error while connecting to mobile device:"
                 print err
                 self.installers = {}
-        else:
+        elif find_devices:
             print "No mobile device!"
             
     def find_app_directory(self):
@@ -174,26 +280,11 @@ class AppHighLevel(object):
             mobile_dirs.append(self.mobile_device)
             
         if platform.system() == "Linux":
-            #Parse the output of the "mount" program.
-            mount_run = subprocess.Popen('mount', shell=True, 
-                                         stdout=subprocess.PIPE)
-            mount_out, _err = mount_run.communicate()
-            
-            all_fsspecs = set()    #some block devices are mounted several times    
-            for line in mount_out.split("\n"): #IGNORE:E1103
-                try:
-                    fsspec, _, fsdir, _, fstype, _opts = line.split(" ")
-#                    print fsspec, fsdir, fstype
-                except ValueError:
-                    continue
-                if not fsspec.startswith("/") or fsspec in all_fsspecs:
-                    #ignore special devices and duplicates 
-                    continue
-                if not path.isdir(path.join(fsdir, "Android")):
-                    #Identify Android by a special directory 
-                    continue
-                all_fsspecs.add(fsspec)
-                mobile_dirs.append(fsdir)
+            try:
+                mounts = self.read_mountinfo()
+            except IOError:
+                mounts = self.read_mount_program()
+            mobile_dirs += self.find_android_mounts(mounts)
                  
         elif platform.system() == "Windows":
 #            drivelist = subprocess.Popen('wmic logicaldisk get name,description', shell=True, stdout=subprocess.PIPE)
@@ -205,11 +296,116 @@ class AppHighLevel(object):
         
         return mobile_dirs
         
+    def read_mountinfo(self):
+        """
+        Read the mounted file systems from ``self.mountinfo_path`` 
+        ("/proc/self/mountinfo"). Only file systems on block devices are 
+        returned.
+        
+        Returns
+        -------
+        
+        list[(int, str, str)]
+            ``(mount_id, fsspec, fsdir)`` for each mount. The kernel gives 
+            each new mount a new ID.
+        """
+        unescape = lambda text: re.sub(r"\\([0-7]{3})", 
+                                       lambda m: chr(int(m.group(1), 8)), 
+                                       text)
+        mounts = []
+        with open(self.mountinfo_path, "r") as fmounts:
+            for line in fmounts:
+                #Optional fields before "-" have variable number
+                fields = line.split()
+                try:
+                    sep = fields.index("-", 6)
+                    mount_id, fsdir = int(fields[0]), unescape(fields[4])
+                    fsspec = unescape(fields[sep + 2])
+                except (ValueError, IndexError):
+                    continue
+                if fsspec.startswith("/"):
+                    mounts.append((mount_id, fsspec, fsdir))
+        return mounts
+    
+    def read_mount_program(self):
+        """
+        Read the mounted file systems from the output of the "mount" 
+        program. For systems without "/proc". Returns the same values as 
+        ``read_mountinfo``, but the mount IDs are ``None``.
+        """
+        mount_run = subprocess.Popen('mount', shell=True, 
+                                     stdout=subprocess.PIPE)
+        mount_out, _err = mount_run.communicate()
+        mounts = []
+        for line in mount_out.split("\n"): #IGNORE:E1103
+            try:
+                fsspec, _, fsdir, _, _fstype, _opts = line.split(" ")
+            except ValueError:
+                continue
+            if fsspec.startswith("/"):
+                mounts.append((None, fsspec, fsdir))
+        return mounts
+    
+    def find_android_mounts(self, mounts):
+        """
+        Find the mounts, that are Android devices. Android is identified by
+        a special directory.
+        
+        The result is cached in the application directory. The cache is 
+        used while the mounts, identified by their mount IDs, are the same.
+        
+        Arguments
+        ---------
+        
+        mounts: list[(int | NoneType, str, str)]
+            See: ``read_mountinfo``
+        
+        Returns
+        -------
+        
+        list[str]
+            Mount points of the devices.
+        """
+        mount_key = [list(mount) for mount in sorted(mounts)]
+        use_cache = self.app_directory and \
+                    all(mount_id is not None for mount_id, _, _ in mounts)
+        cache_path = path.join(self.app_directory or "", 
+                               self.device_cache_name)
+        if use_cache:
+            try:
+                with open(cache_path, "r") as fcache:
+                    cache = json.load(fcache)
+                if cache["mounts"] == mount_key:
+                    return [str(fsdir) for fsdir in cache["devices"]]
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+        
+        devices = []
+        all_fsspecs = set()    #some block devices are mounted several times    
+        for _, fsspec, fsdir in mounts:
+            if fsspec in all_fsspecs:
+                continue
+            if not path.isdir(path.join(fsdir, "Android")):
+                continue
+            all_fsspecs.add(fsspec)
+            devices.append(fsdir)
+        
+        if use_cache:
+            try:
+                with open(cache_path, "w") as fcache:
+                    json.dump({"mounts": mount_key, "devices": devices}, 
+                              fcache)
+            except IOError:
+                pass
+        return devices
+        
     #--- Information Retrieval 
-    def get_filtered_map_list(self, lister_dict, patterns):
+    def get_filtered_map_list(self, lister_dict, patterns, min_size=None,
+                              max_size=None, newer_than=None, 
+                              older_than=None):
         """
-        Create a list of maps, that match certain patterns. Matching is
-        not case sensitive.
+        Create a list of maps, that match certain patterns, and optionally
+        have certain sizes and dates. Matching is not case sensitive.
         
         Usage::
             
@@ -223,30 +419,131 @@ class AppHighLevel(object):
         
         lister_dict: dict[str:object]
             Objects must have a method ``get_file_list() -> [MapMeta]``.
+            Objects with a method ``query_file_list`` (the downloaders) 
+            filter the maps themselves.
         
         patterns: list[str]
-            List of shell wildcard patterns.
+            List of shell wildcard patterns. Patterns that start with "!" 
+            exclude maps. See: ``PatternMatcher``
+            
+        min_size, max_size: float | NoneType
+            Limits for the size of the maps. [Byte]
+            
+        newer_than, older_than: datetime.datetime | NoneType
+            Limits for the dates of the maps.
             
         Retuns
         --------
         
         list[MapMeta]
+            Sorted by name. Maps that match several patterns are contained
+            only once.
         """
-        #Get listing of all maps of all servers.
-        all_maps = []
-        for _, downloader in items_sorted(lister_dict):
-            maps = downloader.get_file_list()
-            all_maps += maps
-        all_maps.sort(key=lambda m: m.disp_name.lower())
-        #Filter the names for the patterns. 
+        if not patterns:
+            return []
+        matcher = PatternMatcher(patterns)
+        includes = [pat for pat in patterns if not pat.startswith("!")]
         all_matches = []
-        for pattern in patterns:
-            pattern_low = pattern.lower()
-            for map_ in all_maps:
-                name_low = map_.disp_name.lower()
-                if fnmatch.fnmatchcase(name_low, pattern_low):
-                    all_matches.append(map_)
-        return all_matches
+        for _, lister in items_sorted(lister_dict):
+            if not hasattr(lister, "query_file_list"):
+                all_matches += filter_maps(self.get_listing(lister), matcher, 
+                                           min_size, max_size, newer_than, 
+                                           older_than)
+                continue
+            #Let the catalog's database do the filtering.
+            found = {}
+            for pattern in includes or [None]:
+                for map_ in lister.query_file_list(pattern, min_size, 
+                                            max_size, newer_than, older_than):
+                    found[map_.disp_name] = map_
+            all_matches += matcher.filter(found.values())
+        #Decorate-sort: lower each name only once
+        decorated = [(map_.disp_name.lower(), map_) for map_ in all_matches]
+        decorated.sort(key=lambda item: item[0])
+        return [map_ for _, map_ in decorated]
+
+    def start_snapshot(self):
+        """
+        Start a snapshot of the listings, for the duration of a command. 
+        Each directory is listed only once, later changes must be reported 
+        with ``update_listing`` and ``remove_from_listing``.
+        """
+        self.listings = {}
+        
+    def stop_snapshot(self):
+        """Discard the snapshot of the listings, at the end of a command."""
+        self.listings = None
+        
+    def get_listing(self, lister):
+        """
+        Return all maps of a local manager or installer. During a command
+        the listing is taken from the snapshot, or added to it.
+        
+        Returns
+        -------
+        
+        list[MapMeta]
+        """
+        if self.listings is None:
+            return lister.get_file_list()
+        with self.listing_lock:
+            if lister not in self.listings:
+                self.listings[lister] = lister.get_file_list()
+            return list(self.listings[lister])
+        
+    def update_listing(self, lister, file_name):
+        """
+        Add a file, that has been written, to the snapshot of the listings,
+        or update its entry.
+        """
+        with self.listing_lock:
+            if self.listings is None or lister not in self.listings:
+                return
+            map_meta = lister.get_map_meta(file_name)
+            self.listings[lister] = [
+                        map_ for map_ in self.listings[lister] 
+                        if map_.disp_name != map_meta.disp_name] + [map_meta]
+        
+    def remove_from_listing(self, lister, disp_name):
+        """Remove a deleted file from the snapshot of the listings."""
+        with self.listing_lock:
+            if self.listings is None or lister not in self.listings:
+                return
+            self.listings[lister] = [map_ for map_ in self.listings[lister]
+                                     if map_.disp_name != disp_name]
+        
+    def get_catalog_age(self):
+        """
+        Return the age of the oldest list of maps from the servers, and 
+        whether lists are currently refreshed in the background.
+        
+        Returns
+        -------
+        
+        age: float | NoneType
+            Age in seconds, ``None`` if no lists have been downloaded.
+            
+        is_refreshing: bool
+        """
+        ages = [downloader.get_catalog_age() 
+                for downloader in self.downloaders.values()
+                if hasattr(downloader, "get_catalog_age")]
+        ages = [age for age in ages if age is not None]
+        is_refreshing = any(downloader.is_refreshing() 
+                            for downloader in self.downloaders.values()
+                            if hasattr(downloader, "is_refreshing"))
+        return (max(ages) if ages else None), is_refreshing
+    
+    def wait_catalog_refresh(self):
+        """
+        Wait until the lists of maps, that are refreshed in the background,
+        are up to date. Returns ``True`` if any list has changed.
+        """
+        changed = False
+        for _, downloader in items_sorted(self.downloaders):
+            if hasattr(downloader, "wait_refresh"):
+                changed |= downloader.wait_refresh()
+        return changed
 
     #--- File manipulation
     def get_component(self, file_meta, component_dict):
@@ -271,41 +568,248 @@ class AppHighLevel(object):
         component = component_dict[comp_name]
         return component
     
-    def download_file(self, file_meta):
-        """Download a file from the Internet to the local file system."""
+    def download_file(self, file_meta, make_progress=TextProgressBar, 
+                      install=False):
+        """
+        Download a file from the Internet to the local file system.
+        
+        ``make_progress`` creates the progress bar, see: 
+        ``BaseDownloader.download_file``.
+        
+        The SHA-256 hash of the archive, that is computed during the 
+        download, is stored in the archive's manifest. See: 
+        ``BaseManager.record_archive_hash``
+        
+        With ``install=True`` the map is additionally installed on the mobile
+        device, while it is downloaded. The archive is extracted from the 
+        data stream, so that it is neither read back from the local file 
+        system, nor written and read in separate passes. If the map can't 
+        be extracted from the stream, it is installed from the downloaded 
+        archive afterwards.
+        """
         down_comp = self.get_component(file_meta, self.downloaders)
         loca_comp = self.get_component(file_meta, self.local_managers)
         loca_path = loca_comp.make_full_name(file_meta.disp_name)
-        down_comp.download_file(srv_url=file_meta.full_name, 
-                                loc_name=loca_path, 
-                                disp_name=file_meta.disp_name)
+        extractor = None
+        if install:
+            inst_comp = self.get_component(file_meta, self.installers)
+            inst_path = inst_comp.make_full_name(file_meta.disp_name)
+            extractor = loca_comp.make_stream_extractor(inst_path)
+        try:
+            sha256 = down_comp.download_file(srv_url=file_meta.full_name, 
+                                             loc_name=loca_path, 
+                                             disp_name=file_meta.disp_name,
+                                             make_progress=make_progress, 
+                                             tee=extractor)
+        except:
+            if extractor is not None:
+                extractor.abort()
+            raise
+        if sha256:
+            loca_comp.record_archive_hash(loca_path, sha256)
+        self.update_listing(loca_comp, loca_path)
+        
+        if extractor is None:
+            return
+        if extractor.close():
+            loca_comp.check_map_hash(loca_path, extractor.entry["name"], 
+                                     extractor.size, 
+                                     extractor.sha256.hexdigest())
+            loca_comp.write_map_hash(inst_path, extractor.sha256.hexdigest())
+        else:
+            print "Could not install {name} while downloading: {err}" \
+                  .format(name=file_meta.disp_name, err=extractor.error)
+            loca_comp.extract_map(arch_path=loca_path, map_path=inst_path, 
+                                  disp_name=file_meta.disp_name)
+        inst_comp.forget_listing()
+        self.update_listing(inst_comp, inst_path)
+    
+    def download_files(self, down_maps, jobs=1, install_names=frozenset(),
+                       on_done=None, progress=None):
+        """
+        Download several files from the Internet to the local file system.
+        
+        With ``jobs > 1`` the files are downloaded concurrently, by a pool of
+        ``jobs`` threads, and a single progress bar shows the progress of all
+        downloads. A failed download does not stop the other downloads.
+        
+        Arguments
+        ---------
+        
+        down_maps: list[MapMeta]
+            The files that should be downloaded.
+            
+        jobs: int
+            Number of concurrent downloads.
+            
+        install_names: set[str]
+            Canonical names of maps, that are installed on the mobile device 
+            while they are downloaded. See: ``download_file``
+            
+        on_done: callable(MapMeta) | NoneType
+            Called with each map that has been downloaded successfully, in 
+            the thread that has downloaded it.
+            
+        progress: MultiProgressBar | NoneType
+            Progress bar that is shared with other work, for example with 
+            installations. The downloads are shown in this bar, and it is 
+            not finished by this method.
+        
+        Returns
+        -------
+        
+        list[(MapMeta, Exception)]
+            The files whose download failed, and the error.
+        """
+        shared_progress = progress is not None
+        make_progress = TextProgressBar
+        if shared_progress:
+            make_progress = progress.make_bar
+        elif jobs > 1:
+            down_size = sum(map_.size for map_ in down_maps)
+            progress = MultiProgressBar("Downloading", val_max=down_size)
+            make_progress = progress.make_bar
+        def download(map_):
+            "Download one map, and report it."
+            self.download_file(map_, make_progress, 
+                               install=map_.disp_name in install_names)
+            if on_done is not None:
+                on_done(map_)
+        _, errors = run_parallel(download, down_maps, jobs)
+        if progress is not None and not shared_progress:
+            progress.update_final("Finished")
+        
+        for map_, err in errors:
+            msg = "Error while downloading {name}: {err}".format(
+                                                name=map_.disp_name, err=err)
+            if shared_progress:
+                progress.print_message(msg)
+            else:
+                print msg
+        return errors
 
-    def install_file(self, file_meta):
-        """Install a file from the local file system on the mobile device."""
+    def install_file(self, file_meta, make_progress=TextProgressBar, 
+                     write_limiter=None, differential=False):
+        """
+        Install a file from the local file system on the mobile device.
+        For the optional arguments see: ``BaseManager.extract_map``
+        """
         loca_comp = self.get_component(file_meta, self.local_managers)
         inst_comp = self.get_component(file_meta, self.installers)
         inst_path = inst_comp.make_full_name(file_meta.disp_name)
         loca_comp.extract_map(arch_path=file_meta.full_name, 
                                    map_path=inst_path, 
-                                   disp_name=file_meta.disp_name)
+                                   disp_name=file_meta.disp_name,
+                                   make_progress=make_progress,
+                                   write_limiter=write_limiter,
+                                   differential=differential)
+        inst_comp.forget_listing()
+        self.update_listing(inst_comp, inst_path)
+        
+    def install_files(self, inst_maps, jobs=1, write_jobs=1, 
+                      differential=False):
+        """
+        Install several files from the local file system on the mobile 
+        device.
+        
+        With ``jobs > 1`` the maps are extracted concurrently, by a pool of 
+        ``jobs`` threads, and a single progress bar shows the progress of all
+        installations. (Inflating the archives releases the GIL.) A failed 
+        installation does not stop the other installations.
+        
+        Arguments
+        ---------
+        
+        inst_maps: list[MapMeta]
+            The files that should be installed.
+            
+        jobs: int
+            Number of maps that are extracted concurrently. Limits the CPU 
+            usage.
+            
+        write_jobs: int
+            Number of maps that are written to the mobile device at the 
+            same time. A slow SD card should get only one writer, a fast 
+            SSD can get as many as ``jobs``.
+            
+        differential: bool
+            Don't write existing maps, that are unchanged. 
+            See: ``BaseManager.extract_map_differential``
+            
+        Returns
+        -------
+        
+        list[(MapMeta, Exception)]
+            The files whose installation failed, and the error.
+        """
+        if jobs <= 1:
+            install = lambda map_: self.install_file(
+                                map_, differential=differential)
+            _, errors = run_parallel(install, inst_maps, 1)
+        else:
+            write_limiter = threading.Semaphore(max(write_jobs, 1))
+            inst_size = sum(map_.size for map_ in inst_maps)
+            progress = MultiProgressBar("Installing", val_max=inst_size)
+            install = lambda map_: self.install_file(map_, progress.make_bar,
+                                                     write_limiter, 
+                                                     differential)
+            _, errors = run_parallel(install, inst_maps, jobs)
+            progress.update_final("Finished")
+        
+        for map_, err in errors:
+            print "Error while installing {name}: {err}".format(
+                                                name=map_.disp_name, err=err)
+        return errors
         
     def delete_file_mobile(self, file_meta):    
-        """Delete file on the mobile device."""
+        """
+        Delete file on the mobile device, and the files that belong to it.
+        See: ``BaseInstaller.get_auxiliary_paths``
+        """
         inst_component = self.get_component(file_meta, self.installers)
         inst_path = inst_component.make_full_name(file_meta.disp_name)
         os.remove(inst_path)
+        inst_component.forget_listing()
+        self.remove_from_listing(inst_component, file_meta.disp_name)
+        for aux_path in inst_component.get_auxiliary_paths(inst_path):
+            if path.exists(aux_path):
+                os.remove(aux_path)
         
     def delete_file_local(self, file_meta):
-        """Delete file on the local file system."""
+        """Delete file on the local file system, and its manifest."""
         loca_component = self.get_component(file_meta, self.local_managers)
         loca_path = loca_component.make_full_name(file_meta.disp_name)
         os.remove(loca_path)
+        manifest_path = loca_component.get_manifest_path(loca_path)
+        if path.exists(manifest_path):
+            os.remove(manifest_path)
+        self.remove_from_listing(loca_component, file_meta.disp_name)
         
     #--- High level file operations
-    def plan_work(self, source_files, dest_files, mode):
+    def plan_work(self, source_files, dest_files, mode, 
+                  compare_size=False):
         """
         Plan work, that transforms `source_files` into `dest_files`. For 
-        example downloading or installing files.
+        example downloading or installing files. 
+        
+        Returns the work of the plan from ``plan_sync``, see there for the 
+        arguments.
+        
+        Returns
+        -------
+        
+        list[MapMeta]
+            Records from ``source_files``. The work should be done with them.
+        """
+        return self.plan_sync(source_files, dest_files, mode, 
+                              compare_size).work
+    
+    def plan_sync(self, source_files, dest_files, mode, compare_size=False):
+        """
+        Compare two lists of files, and plan the work, that transforms 
+        `source_files` into `dest_files`. Files are identified by their 
+        canonical names. The lists are compared in a single pass, with a 
+        dictionary of the destination files.
         
         Arguments
         ---------
@@ -323,39 +827,56 @@ class AppHighLevel(object):
                 
             "replace_newer"
                 Do the work when the source file is newer than the destination
-                file. Also do the work, if the destination file does not exist.
+                file (by more than ``self.time_tolerance``), or when the sizes
+                differ and ``compare_size`` is ``True``. Also do the work, if
+                the destination file does not exist.
                 
             "replace_all"
                 Do the work for each source file. Possibly existing destination
                 files are always overwritten.
                 
+        compare_size: bool
+            Compare the sizes of the files. Only useful if both lists contain
+            sizes of the same kind, for example the size of the maps in the 
+            local archives and on the mobile device. (The servers list the 
+            rounded sizes of the archives.)
+                
         Returns
         -------
         
-        list[MapMeta]
-            Records from ``source_files``. The work should be done with them.
+        SyncPlan
         """
         supported_modes = ["only_missing", "replace_newer", "replace_all"]
         if mode not in supported_modes:
             raise ValueError("Unsupported mode: {}".format(mode))
         
-        if mode == "replace_all":
-            return source_files[:]
-        
+        plan = SyncPlan()
         dest_dict = {file_.disp_name: file_ for file_ in dest_files}
-        work_files = []
+        replace_all = mode == "replace_all"
+        replace_newer = mode == "replace_newer"
+        time_tolerance = self.time_tolerance
+        #Bind the methods to local names, they are called for each file.
+        add, update = plan.adds.append, plan.updates.append
+        keep, work = plan.unchanged.append, plan.work.append
         for source_file in source_files:
-            #If there **is no** local map with this name, download it.
-            if source_file.disp_name not in dest_dict:
-                work_files.append(source_file)
-            elif mode == "replace_newer":
-                #If there is a local map with this name, 
-                #download it if map on server **is newer**.
-                dest_file = dest_dict[source_file.disp_name]
-                if source_file.time.date() > dest_file.time.date():
-                    work_files.append(source_file)
-        
-        return work_files
+            dest_file = dest_dict.get(source_file.disp_name)
+            if dest_file is None:
+                add(source_file)
+                work(source_file)
+            elif replace_all or (replace_newer and (
+                    (compare_size and source_file.size != dest_file.size) or
+                    (source_file.time is not None and 
+                     dest_file.time is not None and
+                     source_file.time - dest_file.time > time_tolerance))):
+                update(source_file)
+                work(source_file)
+            else:
+                keep(source_file)
+        
+        source_names = set(file_.disp_name for file_ in source_files)
+        plan.deletes = [file_ for file_ in dest_files 
+                        if file_.disp_name not in source_names]
+        return plan
     
     def filter_possible_work(self, work_files, component_dict):
         """Remove files that can't be handled by any component."""
@@ -370,7 +891,10 @@ class AppHighLevel(object):
             good_work.append(file_)
         return good_work
         
-    def download_install(self, patterns, mode):
+    def download_install(self, patterns, mode, jobs=1, segments=1, 
+                         pipeline=False, limit_rate=None, limit_schedule=None,
+                         install_jobs=1, write_jobs=1, differential=False,
+                         delta=False, overlap=False, verify=False):
         """
         Download and install maps that match certain patterns. 
         
@@ -384,33 +908,283 @@ class AppHighLevel(object):
         mode: str
             Control the conditions to download or install a file.
             For details see: `AppHighLevel.plan_work`
+            
+        jobs: int
+            Number of concurrent downloads.
+            
+        segments: int
+            Number of segments, that are downloaded in parallel, for each 
+            large file.
+            
+        pipeline: bool
+            Install the maps, that need to be downloaded, while they are 
+            downloaded. (Maps are written to the device in the same pass, 
+            that writes the archive to the local file system.) Maps, that 
+            are already downloaded, are installed afterwards.
+            
+        limit_rate: float | NoneType
+            Maximum bandwidth of all downloads together in Byte/s. ``None``
+            means unlimited.
+            
+        limit_schedule: list[(datetime.time, float | NoneType)] | NoneType
+            Different bandwidth limits by time of day. Overrides 
+            ``limit_rate``. See: ``ratelimit.parse_schedule``
+            
+        install_jobs, write_jobs: int
+            Number of maps that are extracted concurrently, and number of 
+            maps that are written to the device at the same time. 
+            See: ``install_files``
+            
+        differential: bool
+            Don't write maps on the device, that are unchanged. 
+            See: ``BaseManager.extract_map_differential``
+            
+        delta: bool
+            Update downloaded archives by downloading only the blocks that
+            have changed, if the server publishes block checksums. 
+            See: ``BaseDownloader.download_delta``
+            
+        overlap: bool
+            Install maps while the next maps are downloaded, instead of 
+            installing all maps after all downloads. Ignored with 
+            ``pipeline``. See: ``download_install_overlapped``
+            
+        verify: bool
+            Compare downloaded archives with the hash, that was computed 
+            during their download, before they are installed. Reads each 
+            archive once more. See: ``BaseManager.check_archive_hash``
+        """
+        from mob_map_dl.download import RATE_LIMITER
+        self.start_snapshot()
+        try:
+            for downloader in self.downloaders.values():
+                downloader.segments = segments
+                downloader.delta = delta
+            for manager in self.local_managers.values():
+                manager.verify_archives = verify
+            RATE_LIMITER.set_limit(limit_rate, limit_schedule)
+            if overlap and not pipeline:
+                self.download_install_overlapped(patterns, mode, jobs, 
+                                                 install_jobs, write_jobs, 
+                                                 differential)
+                return
+        
+            #Download maps
+            pipe_names, down_maps = self.download_planned(patterns, mode, 
+                                                          jobs, pipeline)
+            #With ``background_refresh`` the plan was made with outdated lists
+            #of maps. Download the maps that the new lists add to the plan.
+            if self.wait_catalog_refresh():
+                print "Lists of maps have changed on the servers, " \
+                      "planning again."
+                more_pipe, _ = self.download_planned(patterns, mode, jobs, 
+                                                     pipeline, down_maps)
+                pipe_names |= more_pipe
+        
+            #Install maps
+            loc_maps = self.get_filtered_map_list(self.local_managers, 
+                                                  patterns)
+            dev_maps = self.get_filtered_map_list(self.installers, patterns)
+            work_maps = self.plan_work(loc_maps, dev_maps, mode, 
+                                       compare_size=True)
+            inst_maps = self.filter_possible_work(work_maps, self.installers)
+            inst_maps = [map_ for map_ in inst_maps 
+                         if map_.disp_name not in pipe_names]
+            inst_size = 0
+            for map_ in inst_maps:
+                inst_size += map_.size
+            print "Installing: {n} files, {s:5.3f} GiB".format(
+                                    n=len(inst_maps), s=inst_size / 1024**3)
+            self.install_files(inst_maps, install_jobs, write_jobs, 
+                               differential)
+        finally:
+            self.stop_snapshot()
+
+    def download_install_overlapped(self, patterns, mode, jobs, install_jobs,
+                                    write_jobs, differential):
+        """
+        Download and install maps, with downloads and installations running
+        at the same time. Arguments as in ``download_install``.
+        
+        Maps whose archives are already downloaded are installed right from 
+        the start. Each map, that is downloaded and should be installed, is
+        queued for installation as soon as its download is complete, while 
+        the next maps are downloaded. ``jobs`` maps are downloaded and 
+        ``install_jobs`` maps are extracted concurrently; at most 
+        ``write_jobs`` maps are written to the device at the same time.
+        """
+        write_limiter = threading.Semaphore(max(write_jobs, 1))
+        progress = MultiProgressBar("Downloading and installing", val_max=0)
+        #Downloads and installations share one line on the terminal.
+        submitted = {}
+        #Installations that have been queued, and whether they are finished:
+        #{(disp_name, archive size, archive mtime): threading.Event}
+        done_events = {}
+        #The same events, keyed by the identity of the queued ``MapMeta``
+        submit_lock = threading.Lock()
+        
+        def install(loc_map):
+            "Install one map, and report that its archive is no longer used."
+            try:
+                self.install_file(loc_map, progress.make_bar, write_limiter, 
+                                  differential)
+            finally:
+                done_events[id(loc_map)].set()
+        pool = WorkerPool(install, install_jobs)
+        
+        def submit(loc_map):
+            """
+            Queue a downloaded map for installation. Each archive is 
+            installed once, but a newer archive of the same map is installed 
+            again.
+            """
+            key = self.archive_key(loc_map)
+            with submit_lock:
+                if key in submitted:
+                    return
+                submitted[key] = done_events[id(loc_map)] = threading.Event()
+            pool.submit(loc_map)
+        
+        def wait_installed(down_maps):
+            """
+            Wait until the queued installations of ``down_maps`` are 
+            finished. Otherwise the download could overwrite an archive, 
+            while it is extracted.
+            """
+            down_names = set(map_.disp_name for map_ in down_maps)
+            with submit_lock:
+                pending = [done for key, done in submitted.items() 
+                           if key[0] in down_names]
+            for done in pending:
+                #Waiting with timeout keeps the main thread responsive to 
+                #Ctrl-C
+                while not done.is_set():
+                    done.wait(0.1)
+        
+        down_maps = []
+        errors = []
+        try:
+            while True:
+                srv_maps = self.get_filtered_map_list(self.downloaders, 
+                                                      patterns)
+                loc_maps = self.get_filtered_map_list(self.local_managers, 
+                                                      patterns)
+                dev_maps = self.get_filtered_map_list(self.installers, 
+                                                      patterns)
+                work_maps = self.plan_work(srv_maps, loc_maps, mode)
+                new_down = self.filter_possible_work(work_maps, 
+                                                     self.local_managers)
+                done_maps = set(down_maps)
+                new_down = [map_ for map_ in new_down 
+                            if map_ not in done_maps]
+                down_names = set(map_.disp_name for map_ in new_down)
+                after_down = self.plan_work(new_down, dev_maps, mode)
+                after_down = self.filter_possible_work(after_down, 
+                                                       self.installers)
+                after_names = set(map_.disp_name for map_ in after_down)
+                inst_now = self.plan_work(loc_maps, dev_maps, mode, 
+                                          compare_size=True)
+                inst_now = self.filter_possible_work(inst_now, self.installers)
+                inst_now = [map_ for map_ in inst_now 
+                            if map_.disp_name not in down_names]
+                progress.print_message(
+                      "Downloading: {n} files, {s:5.3f} GiB; installing: "
+                      "{m} files".format(n=len(new_down), 
+                                         s=sum(map_.size for map_ in new_down)
+                                           / 1024**3, 
+                                         m=len(inst_now) + len(after_down)))
+                
+                for map_ in inst_now:
+                    submit(map_)
+                def on_done(srv_map):
+                    "Queue the installation of a downloaded map."
+                    if srv_map.disp_name not in after_names:
+                        return
+                    loca_comp = self.get_component(srv_map, 
+                                                   self.local_managers)
+                    loca_path = loca_comp.make_full_name(srv_map.disp_name)
+                    submit(loca_comp.get_map_meta(loca_path))
+                wait_installed(new_down)
+                errors += self.download_files(new_down, jobs, on_done=on_done,
+                                              progress=progress)
+                down_maps += new_down
+                
+                #With ``background_refresh`` the plan was made with outdated 
+                #lists of maps. Download the maps that the new lists add.
+                if not self.wait_catalog_refresh():
+                    break
+                progress.print_message("Lists of maps have changed on the "
+                                       "servers, planning again.")
+        except KeyboardInterrupt:
+            #Don't start the queued installations, only wait for the 
+            #running ones.
+            cancelled = pool.cancel()
+            progress.print_message("Interrupted, {n} installations "
+                                   "cancelled.".format(n=len(cancelled)))
+            raise
+        finally:
+            inst_errors = pool.join()
+            progress.update_final("Finished")
+        for map_, err in inst_errors:
+            print "Error while installing {name}: {err}".format(
+                                                name=map_.disp_name, err=err)
+        return errors, inst_errors
+    
+    @staticmethod
+    def archive_key(loc_map):
+        """
+        Identity of a downloaded archive: name, size and modification time 
+        of the archive file. A new download of the same map gets a 
+        different key.
+        """
+        arch_stat = os.stat(loc_map.full_name)
+        return (loc_map.disp_name, arch_stat.st_size, arch_stat.st_mtime)
+        
+    def download_planned(self, patterns, mode, jobs, pipeline, 
+                         done_maps=()):
+        """
+        Plan the downloads, and download the maps. See ``download_install``.
+        
+        Arguments
+        ---------
+        
+        done_maps: list[MapMeta]
+            Maps that have already been downloaded in this run. They are 
+            not downloaded again, unless they have changed on the server.
+        
+        Returns
+        -------
+        
+        pipe_names: set[str]
+            Names of the maps, that have been installed while they were 
+            downloaded.
+            
+        down_maps: list[MapMeta]
+            The maps that were planned to be downloaded.
         """
-        #Download maps
         srv_maps = self.get_filtered_map_list(self.downloaders, patterns)
         loc_maps = self.get_filtered_map_list(self.local_managers, patterns)
         work_maps = self.plan_work(srv_maps, loc_maps, mode)
         down_maps = self.filter_possible_work(work_maps, self.local_managers)
+        done_maps = set(done_maps)
+        down_maps = [map_ for map_ in down_maps if map_ not in done_maps]
         down_size = 0
         for map_ in down_maps:
             down_size += map_.size
         print "Downloading: {n} files, {s:5.3f} GiB".format(n=len(down_maps), 
                                                        s=down_size / 1024**3)
-        for map_ in down_maps:
-            self.download_file(map_)
-        
-        #Install maps
-        loc_maps = self.get_filtered_map_list(self.local_managers, patterns)
-        dev_maps = self.get_filtered_map_list(self.installers, patterns)
-        work_maps = self.plan_work(loc_maps, dev_maps, mode)
-        inst_maps = self.filter_possible_work(work_maps, self.installers)
-        inst_size = 0
-        for map_ in inst_maps:
-            inst_size += map_.size
-        print "Installing: {n} files, {s:5.3f} GiB".format(n=len(inst_maps), 
-                                                      s=inst_size / 1024**3)
-        for map_ in inst_maps:
-            self.install_file(map_)
-        
+        pipe_names = set()
+        if pipeline:
+            #Maps that would be installed after they are downloaded
+            dev_maps = self.get_filtered_map_list(self.installers, patterns)
+            pipe_maps = self.plan_work(down_maps, dev_maps, mode)
+            pipe_maps = self.filter_possible_work(pipe_maps, self.installers)
+            pipe_names = set(map_.disp_name for map_ in pipe_maps)
+        errors = self.download_files(down_maps, jobs, pipe_names)
+        #Maps that have been installed while they were downloaded
+        pipe_names -= set(map_.disp_name for map_, _ in errors)
+        return pipe_names, down_maps
+    
     def uninstall(self, patterns, delete_local):
         """
         Delete maps on a mobile device, and optionally locally.
@@ -428,30 +1202,44 @@ class AppHighLevel(object):
             If ``False``:
                 Delete files only on the mobile device.
         """
-        del_maps = self.get_filtered_map_list(self.installers, patterns)
-        del_size = 0
-        for map_ in del_maps:
-            del_size += map_.size
-        print "Deleting: {n} files, {s:5.3f} GiB on mobile device".format(
-                                    n=len(del_maps), s=del_size / 1024**3)
-        for map_ in del_maps:
-            self.delete_file_mobile(map_)
-        
-        if delete_local:
-            del_maps = self.get_filtered_map_list(self.local_managers, patterns)
+        self.start_snapshot()
+        try:
+            del_maps = self.get_filtered_map_list(self.installers, patterns)
             del_size = 0
             for map_ in del_maps:
                 del_size += map_.size
-            print "Deleting: {n} files, {s:5.3f} GiB on local disk".format(
+            print "Deleting: {n} files, {s:5.3f} GiB on mobile device".format(
                                         n=len(del_maps), s=del_size / 1024**3)
             for map_ in del_maps:
-                self.delete_file_local(map_)
-    
+                self.delete_file_mobile(map_)
+        
+            if delete_local:
+                del_maps = self.get_filtered_map_list(self.local_managers, 
+                                                      patterns)
+                del_size = 0
+                for map_ in del_maps:
+                    del_size += map_.size
+                print "Deleting: {n} files, {s:5.3f} GiB on local disk" \
+                      .format(n=len(del_maps), s=del_size / 1024**3)
+                for map_ in del_maps:
+                    self.delete_file_local(map_)
+        finally:
+            self.stop_snapshot()
 
+    
 class ConsoleAppMain(object):
     """Us being good Java citizens. :-)"""
     def __init__(self):
         self.app = AppHighLevel()
+        self.needs_device = True
+        #``False`` if the command does not access the mobile device, which 
+        #therefore needs not be searched.
+        self.needs_servers = True
+        #``False`` if the command does not access the servers. The 
+        #downloaders are then not created.
+        self.wait_refresh = True
+        #``False`` if the command only lists maps. It then exits without 
+        #waiting for the refresh of the lists of maps in the background.
          
     def print_summary_list(self, lister_dict, long_form):
         """
@@ -507,6 +1295,26 @@ class ConsoleAppMain(object):
             self.print_summary_list(self.app.downloaders, long_form)
         else:
             self.print_regular_list(self.app.downloaders, patterns)
+        self.print_catalog_age()
+    
+    def print_catalog_age(self):
+        """
+        Print how old the lists of maps from the servers are, if they are
+        outdated or are currently refreshed.
+        """
+        age, is_refreshing = self.app.get_catalog_age()
+        if age is None:
+            return
+        if age > 3600 * 1.5:
+            age_str = "{:.1f} hours".format(age / 3600)
+        else:
+            age_str = "{:.0f} minutes".format(age / 60)
+        if is_refreshing:
+            print "Lists of maps are {age} old. They are updated by " \
+                  "commands that download maps, or by running without " \
+                  "-b.".format(age=age_str)
+        elif age > 3600:
+            print "Lists of maps are {age} old.".format(age=age_str)
             
     def list_downloaded_maps(self, patterns, long_form=False):
         """
@@ -528,14 +1336,31 @@ class ConsoleAppMain(object):
         else:
             self.print_regular_list(self.app.installers, patterns)
             
-    def download_install(self, patterns, mode):
+    def download_install(self, patterns, mode, jobs=1, segments=1, 
+                         pipeline=False, limit_rate=None, limit_schedule=None,
+                         install_jobs=1, write_jobs=1, differential=False,
+                         delta=False, overlap=False, verify=False):
         """
         Download maps from the Internet and install them on a mobile device.
         
         * patterns: list[str]
         * mode: str
+        * jobs: int
+        * segments: int
+        * pipeline: bool
+        * limit_rate: float | NoneType
+        * limit_schedule: list[(datetime.time, float | NoneType)] | NoneType
+        * install_jobs: int
+        * write_jobs: int
+        * differential: bool
+        * delta: bool
+        * overlap: bool
+        * verify: bool
         """
-        self.app.download_install(patterns, mode)
+        self.app.download_install(patterns, mode, jobs, segments, pipeline,
+                                  limit_rate, limit_schedule, install_jobs,
+                                  write_jobs, differential, delta, overlap, 
+                                  verify)
         
     def uninstall(self, patterns, delete_local=False):
         """
@@ -551,6 +1376,14 @@ class ConsoleAppMain(object):
                             help="directory that represents the mobile device")
         parser.add_argument("--version", action="version", 
                             version="Version: " + VERSION)
+        parser.add_argument("-b", "--background-refresh", action="store_true",
+                            help="use outdated lists of maps from the "
+                                 "servers immediately, and update them in "
+                                 "the background")
+        parser.add_argument("--device-manifest", action="store_true",
+                            help="store the list of installed maps on the "
+                                 "mobile device, so that it is not scanned "
+                                 "again in the next run")
 #        parser.add_argument("-v", "--verbose", action="store_true",
 #                            help="output additional information for "
 #                                 "troubleshooting.")
@@ -565,7 +1398,8 @@ class ConsoleAppMain(object):
                                 help="display additional information")
         lss_parser.add_argument("patterns", type=str, nargs="*", metavar="PAT", 
                                 help="pattern that selects maps, for example:"
-                                     '"osmand/France*", must be quoted')
+                                     '"osmand/France*", must be quoted; '
+                                     '"!PAT" excludes maps')
 
         lss_parser = subparsers.add_parser(
             "lsd", help="list maps that have been downloaded",
@@ -574,7 +1408,8 @@ class ConsoleAppMain(object):
                                 help="display additional information")
         lss_parser.add_argument("patterns", type=str, nargs="*", metavar="PAT", 
                                 help="pattern that selects maps, for example:"
-                                     '"osmand/France*", must be quoted')
+                                     '"osmand/France*", must be quoted; '
+                                     '"!PAT" excludes maps')
 
         lss_parser = subparsers.add_parser(
             "lsm", help="list maps on mobile devices",
@@ -583,7 +1418,8 @@ class ConsoleAppMain(object):
                                 help="display additional information")
         lss_parser.add_argument("patterns", type=str, nargs="*", metavar="PAT", 
                                 help="pattern that selects maps, for example:"
-                                     '"osmand/France*", must be quoted')
+                                     '"osmand/France*", must be quoted; '
+                                     '"!PAT" excludes maps')
         
         install_prs = subparsers.add_parser(
             "install", help="download maps and install them",
@@ -596,11 +1432,58 @@ class ConsoleAppMain(object):
                                       "available")
         install_prs.add_argument("-f", "--force_update", action="store_true",
                                  help="update all maps that match the pattern")
+        install_prs.add_argument("-j", "--jobs", type=int, default=1, 
+                                 metavar="N",
+                                 help="download N maps concurrently "
+                                      "(default: 1)")
+        install_prs.add_argument("-s", "--segments", type=int, default=1, 
+                                 metavar="N",
+                                 help="download large maps in N segments "
+                                      "in parallel (default: 1)")
+        install_prs.add_argument("-p", "--pipeline", action="store_true",
+                                 help="install maps while they are "
+                                      "downloaded")
+        install_prs.add_argument("--limit-rate", type=parse_rate_arg, 
+                                 default=None, metavar="RATE",
+                                 help="limit the bandwidth of all downloads "
+                                      'together, for example: "20M", "500k"')
+        install_prs.add_argument("--limit-schedule", 
+                                 type=parse_schedule_arg, 
+                                 default=None, metavar="SCHED",
+                                 help="limit the bandwidth depending on the "
+                                      "time of day, for example: "
+                                      '"08:00=2M,18:00=off" '
+                                      "(overrides --limit-rate)")
+        install_prs.add_argument("--install-jobs", type=int, default=1, 
+                                 metavar="N",
+                                 help="extract N maps concurrently "
+                                      "(default: 1)")
+        install_prs.add_argument("--write-jobs", type=int, default=1, 
+                                 metavar="N",
+                                 help="write at most N maps to the device at "
+                                      "the same time (default: 1)")
+        install_prs.add_argument("-d", "--differential", action="store_true",
+                                 help="don't rewrite maps on the device, "
+                                      "that are unchanged")
+        install_prs.add_argument("--delta", action="store_true",
+                                 help="update downloaded maps by downloading "
+                                      "only the parts that have changed, "
+                                      "from servers that publish block "
+                                      "checksums (Osmand and Openandromaps "
+                                      "don't)")
+        install_prs.add_argument("-o", "--overlap", action="store_true",
+                                 help="install maps while the next maps are "
+                                      "downloaded")
+        install_prs.add_argument("--verify", action="store_true",
+                                 help="check downloaded maps for damage "
+                                      "before they are installed (reads "
+                                      "them once more)")
 #        install_prs.add_argument("-l", "--long_form", action="store_true",
 #                                help="display additional information")
         install_prs.add_argument("patterns", type=str, nargs="+", metavar="PAT", 
                                  help="pattern that selects maps, for example:"
-                                      '"osmand/France*", must be quoted')
+                                      '"osmand/France*", must be quoted; '
+                                      '"!PAT" excludes maps')
  
         uninst_prs = subparsers.add_parser(
             "uninst", help="remove maps from the mobile device",
@@ -611,12 +1494,18 @@ class ConsoleAppMain(object):
                                      "maps from the local file system")
         uninst_prs.add_argument("patterns", type=str, nargs="+", metavar="PAT", 
                                  help="pattern that selects maps, for example:"
-                                      '"osmand/France*", must be quoted')
+                                      '"osmand/France*", must be quoted; '
+                                      '"!PAT" excludes maps')
        
         args = parser.parse_args(cmd_args)
 #        print args
         
         self.app.mobile_device = args.mobile_device
+        self.app.background_refresh = args.background_refresh
+        self.app.device_manifest = args.device_manifest
+        self.needs_device = args.subcommand in ("lsm", "install", "uninst")
+        self.needs_servers = args.subcommand in ("lss", "install")
+        self.wait_refresh = args.subcommand not in ("lss", "lsd", "lsm")
         
         if args.subcommand == "lss":
             func = self.list_server_maps
@@ -638,6 +1527,17 @@ class ConsoleAppMain(object):
             if args.force_update:
                 mode = "replace_all"
             arg_dict = {"mode":mode,                 # str
+                        "jobs": max(args.jobs, 1),   # int
+                        "segments": max(args.segments, 1), # int
+                        "pipeline": args.pipeline,   # bool
+                        "limit_rate": args.limit_rate, # float | None
+                        "limit_schedule": args.limit_schedule, # list | None
+                        "install_jobs": max(args.install_jobs, 1), # int
+                        "write_jobs": max(args.write_jobs, 1), # int
+                        "differential": args.differential, # bool
+                        "delta": args.delta,         # bool
+                        "overlap": args.overlap,     # bool
+                        "verify": args.verify,       # bool
                         "patterns": args.patterns}   # list[str]
         elif args.subcommand == "uninst":
             func = self.uninstall
@@ -655,6 +1555,12 @@ class ConsoleAppMain(object):
         """
         consoleApp = ConsoleAppMain()
         func, arg_dict = consoleApp.parse_aguments(sys.argv[1:])
-        consoleApp.app.create_low_level_components()
+        consoleApp.app.create_low_level_components(
+                                    find_devices=consoleApp.needs_device,
+                                    find_servers=consoleApp.needs_servers)
         func(**arg_dict) #IGNORE:W0142
+        #Let background refreshes finish, so that the next run profits. 
+        #Listing commands should be fast, and don't wait.
+        if consoleApp.wait_refresh:
+            consoleApp.app.wait_catalog_refresh()
 
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Limit the bandwidth, that is used by all downloads together.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+import datetime
+import threading
+import re
+
+
+def parse_rate(rate_str, allow_pause=False):
+    """
+    Parse a transfer rate, for example "20M", "500k" or "1.5M". The suffixes
+    "k", "M", "G" are multiples of 1024, as with ``wget --limit-rate``.
+
+    The special values "off" and "none" mean: unlimited. The rate "0"
+    pauses the downloads; it is only accepted with ``allow_pause=True`` 
+    (in schedules), because otherwise the downloads would never continue.
+
+    Returns
+    -------
+
+    float | NoneType
+        Rate in Byte/s, ``None`` for unlimited.
+    """
+    rate_str = rate_str.strip()
+    if rate_str.lower() in ("off", "none"):
+        return None
+    match = re.match(r"(\d+(?:\.\d*)?)\s*([kKmMgG]?)[bB]?$", rate_str)
+    if match is None:
+        raise ValueError("Illegal rate: " + rate_str)
+    number, suffix = match.groups()
+    factor = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}[suffix.lower()]
+    rate = float(number) * factor
+    if rate == 0 and not allow_pause:
+        raise ValueError("Rate 0 would pause the downloads forever; "
+                         "pauses are only possible in schedules.")
+    return rate
+
+
+def parse_schedule(schedule_str):
+    """
+    Parse a schedule for different rates at different times of day.
+
+    The schedule has the form "08:00=2M,18:00=off,23:30=20M". At each time
+    the limit changes to the specified rate. The rate of the latest time
+    is in effect until the earliest time of the next day. See
+    ``parse_rate`` for the format of the rates. The rate "0" pauses the 
+    downloads, but not for the whole day.
+
+    Returns
+    -------
+
+    list[(datetime.time, float | NoneType)]
+        Start times and rates, sorted by start time.
+    """
+    schedule = []
+    for entry in schedule_str.split(","):
+        if not entry.strip():
+            continue
+        try:
+            time_str, rate_str = entry.split("=")
+            hour, minute = time_str.strip().split(":")
+            start = datetime.time(int(hour), int(minute))
+        except ValueError:
+            raise ValueError("Illegal schedule entry: " + entry)
+        schedule.append((start, parse_rate(rate_str, allow_pause=True)))
+    if not schedule:
+        raise ValueError("Empty schedule.")
+    if all(rate == 0 for _, rate in schedule):
+        raise ValueError("Schedule pauses the downloads all day.")
+    schedule.sort(key=lambda e: e[0])
+    return schedule
+
+
+class RateLimiter(object):
+    """
+    Token bucket, that limits the bandwidth of all downloads together.
+
+    The download loops call ``consume`` after each read, with the number of
+    bytes that they have received. ``consume`` blocks as long as necessary
+    to keep the sum of all downloads below the limit.
+
+    The limit can depend on the time of day (local time), see
+    ``parse_schedule``.
+
+    Usage::
+
+        limiter = RateLimiter(rate=parse_rate("20M"))
+        while True:
+            buf = fsrv.read(buff_size)
+            if not buf:
+                break
+            limiter.consume(len(buf))
+            ...
+
+    All methods are thread safe.
+    """
+    pause_interval = 10
+    #While the downloads are paused (rate 0), the schedule is checked
+    #in this interval. [s]
+
+    def __init__(self, rate=None, schedule=None, burst_time=0.5):
+        """
+        rate: float | NoneType
+            Maximum rate in Byte/s. ``None`` means unlimited.
+
+        schedule: list[(datetime.time, float | NoneType)] | NoneType
+            Rates by time of day. Overrides ``rate``. See: ``parse_schedule``
+
+        burst_time: float
+            Unused bandwidth is saved for at most this time. Downloads can
+            briefly exceed the limit, to use the saved bandwidth. [s]
+        """
+        self.lock = threading.Lock()
+        self.burst_time = burst_time
+        self.rate = None
+        self.schedule = []
+        self.tokens = 0
+        #Available bandwidth in Byte. Negative values are a debt, that must
+        #be paid by waiting.
+        self.last_time = None
+        #Time when ``tokens`` was last updated. ``None`` if no limit was in
+        #effect.
+        self.clock = time.time
+        self.sleep = time.sleep
+        #Functions for time, can be replaced for testing.
+        self.set_limit(rate, schedule)
+
+    def set_limit(self, rate=None, schedule=None):
+        """
+        Change the limit. Arguments as in the constructor. 
+        
+        Raises ``ValueError`` if the limit would pause the downloads forever.
+        """
+        if (not schedule and rate == 0) or \
+           (schedule and all(e_rate == 0 for _, e_rate in schedule)):
+            raise ValueError("Limit pauses the downloads forever.")
+        with self.lock:
+            self.rate = rate
+            self.schedule = sorted(schedule or [], key=lambda e: e[0])
+            self.tokens = 0
+            self.last_time = None
+
+    def current_rate(self, now=None):
+        """
+        Return the rate, that is in effect at time ``now`` (seconds since
+        the epoch). ``None`` means unlimited, 0 means paused.
+        """
+        if not self.schedule:
+            return self.rate
+        if now is None:
+            now = self.clock()
+        time_of_day = datetime.datetime.fromtimestamp(now).time()
+        #Before the first entry, the last entry of the previous day applies.
+        rate = self.schedule[-1][1]
+        for start, entry_rate in self.schedule:
+            if start <= time_of_day:
+                rate = entry_rate
+        return rate
+
+    def consume(self, num_bytes):
+        """
+        Account for ``num_bytes`` received bytes. Blocks until the average
+        rate is below the limit.
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                rate = self.current_rate(now)
+                if rate is None:
+                    self.last_time = None
+                    return
+                if rate > 0:
+                    if self.last_time is not None:
+                        self.tokens = min(self.tokens +
+                                          (now - self.last_time) * rate,
+                                          rate * self.burst_time)
+                    self.last_time = now
+                    self.tokens -= num_bytes
+                    wait_time = max(-self.tokens / rate, 0)
+                    break
+                self.last_time = None
+            #Paused by the schedule
+            self.sleep(self.pause_interval)
+        if wait_time > 0:
+            self.sleep(wait_time)
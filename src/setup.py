@@ -41,7 +41,9 @@ setup(name="mobile-map-downloader",
       license="GNU General Public License v3 (GPLv3)",
       packages=["mob_map_dl"],
       scripts = ["dlmap"],
-      install_requires=["lxml", "python-dateutil"],
+      install_requires=["lxml", "python-dateutil", 
+                        #Fast listing of the device, see: install.get_scandir
+                        "scandir; python_version < '3.5'"],
 #      zip_safe=False,
 #      entry_points={},
 #      include_package_data=True,
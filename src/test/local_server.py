@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+A local HTTP server, that stands in for the map servers in tests.
+
+The server runs in a background thread, and serves files from memory. It
+understands ``Range``, ``If-Range`` and conditional requests, and can simulate
+some misbehavior of real servers.
+
+Usage::
+
+    server = LocalHTTPServer()
+    server.add_file("/maps/Monaco.zip", data)
+    server.start()
+    url = server.url("/maps/Monaco.zip")
+    ...
+    server.stop()
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+import threading
+import re
+import hashlib
+import email.utils
+import BaseHTTPServer
+import SocketServer
+
+
+class StandInFile(object):
+    """A file that is served by ``LocalHTTPServer``."""
+    def __init__(self, data, etag, last_modified, content_type):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """HTTP server that handles each connection in its own thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        "Clients close connections early on purpose, don't print errors."
+        pass
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle the requests for ``LocalHTTPServer``."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):                           #IGNORE:W0221
+        "Don't clutter the test output."
+        pass
+
+    def setup(self):
+        "Count the connections."
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.stand_in.lock:
+            self.server.stand_in.connections += 1
+
+    def do_HEAD(self):
+        "Handle HEAD request."
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        "Handle GET request."
+        self.respond(send_body=True)
+
+    def send_status(self, code, headers, body=""):
+        "Send a complete response, that is not a file."
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, send_body):
+        "Send the file, or a part of the file. Count active requests."
+        stand_in = self.server.stand_in
+        stand_in.log_request(self.command, self.path, self.headers)
+        stand_in.change_active(+1)
+        try:
+            self.respond_file(send_body)
+        finally:
+            stand_in.change_active(-1)
+
+    def respond_file(self, send_body):
+        "Send the file, or a part of the file."
+        stand_in = self.server.stand_in
+        sfile = stand_in.files.get(self.path)
+        if sfile is None:
+            self.send_status(404, [], "Not found: " + self.path)
+            return
+
+        if_none_match = self.headers.getheader("If-None-Match")
+        if_mod_since = self.headers.getheader("If-Modified-Since")
+        if (if_none_match is not None and if_none_match == sfile.etag) or \
+           (if_none_match is None and if_mod_since is not None and
+            if_mod_since == sfile.last_modified):
+            self.send_status(304, [("ETag", sfile.etag)])
+            return
+
+        data = sfile.data
+        start, end = 0, len(data)
+        code = 200
+        range_hdr = self.headers.getheader("Range")
+        if_range = self.headers.getheader("If-Range")
+        if range_hdr and not stand_in.ignore_range and \
+           (if_range is None or if_range in (sfile.etag, sfile.last_modified)):
+            match = re.match(r"bytes=(\d+)-(\d*)$", range_hdr)
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, len(data))
+            if start >= len(data):
+                self.send_status(416, [("Content-Range",
+                                        "bytes */{}".format(len(data)))])
+                return
+            code = 206
+
+        self.send_response(code)
+        self.send_header("Content-Type", sfile.content_type)
+        self.send_header("Content-Length", str(end - start))
+        if not stand_in.ignore_range:
+            self.send_header("Accept-Ranges", "bytes")
+        if code == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                                                    start, end - 1, len(data)))
+        if sfile.etag:
+            self.send_header("ETag", sfile.etag)
+        if sfile.last_modified:
+            self.send_header("Last-Modified", sfile.last_modified)
+        self.end_headers()
+        if not send_body:
+            return
+
+        body = data[start:end]
+        if stand_in.abort_after is not None:
+            #Simulate a broken connection.
+            self.wfile.write(body[:stand_in.abort_after])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        pos = 0
+        while pos < len(body):
+            chunk = body[pos:pos + stand_in.chunk_size]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if stand_in.delay_per_chunk:
+                time.sleep(stand_in.delay_per_chunk)
+
+
+class LocalHTTPServer(object):
+    """
+    Local HTTP server for tests. Serves files from memory.
+
+    Attributes that change the server's behavior
+
+    ignore_range: bool
+        Ignore ``Range`` headers, and always send the complete file.
+
+    abort_after: int | NoneType
+        Close the connection after this many bytes of the body have been sent.
+
+    chunk_size, delay_per_chunk: int, float
+        Send the body in chunks, and wait after each chunk. Simulates a slow
+        connection.
+
+    Attribute with information about the requests
+
+    requests: list[(str, str, dict[str:str])]
+        Method, path and headers of each request.
+
+    max_active: int
+        Maximum number of requests, that were handled at the same time.
+
+    connections: int
+        Number of TCP connections, that were opened by clients.
+    """
+    def __init__(self):
+        self.files = {}
+        self.ignore_range = False
+        self.abort_after = None
+        self.chunk_size = 1024 * 64
+        self.delay_per_chunk = 0
+        self.requests = []
+        self.num_active = 0
+        self.max_active = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self.server.stand_in = self
+        self.thread = None
+
+    def add_file(self, url_path, data, etag=None, last_modified=None,
+                 content_type="application/zip"):
+        """
+        Serve ``data`` under ``url_path``. The validators ``etag`` and
+        ``last_modified`` are computed from ``data``, if they are not given.
+        Conditional requests for unchanged files are answered with status
+        304 "Not Modified".
+        """
+        if etag is None:
+            etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if last_modified is None:
+            last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        self.files[url_path] = StandInFile(data, etag, last_modified,
+                                           content_type)
+
+    def url(self, url_path):
+        "Return the complete URL for ``url_path``."
+        host, port = self.server.server_address
+        return "http://{}:{}{}".format(host, port, url_path)
+
+    def log_request(self, method, url_path, headers):
+        "Record a request. Called by the request handler."
+        with self.lock:
+            self.requests.append((method, url_path, dict(headers.items())))
+
+    def change_active(self, change):
+        "Count the requests that are currently handled."
+        with self.lock:
+            self.num_active += change
+            self.max_active = max(self.max_active, self.num_active)
+
+    def start(self):
+        "Start the server in a background thread."
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        "Stop the server and close its socket."
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
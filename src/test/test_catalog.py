@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2015 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Test the ``catalog`` module.
+"""
+
+from __future__ import division
+from __future__ import absolute_import              
+
+#For test modules: ----------------------------------------------------------
+import pytest #contains `skip`, `fail`, `raises`, `config`
+
+import time
+import datetime
+import os
+import os.path as path
+
+
+#Set up logging fore useful debug output, and time stamps in UTC.
+import logging
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
+                    level=logging.DEBUG)
+#Time stamps must be in UTC
+logging.Formatter.converter = time.gmtime
+
+
+def relative_path(*path_comps):
+    "Create file paths that are relative to the location of this file."
+    return path.abspath(path.join(path.dirname(__file__), *path_comps))
+
+
+def make_map_metas(num_maps, prefix="osmand/Map", size=1024**2):
+    "Create a list of synthetic ``MapMeta`` objects."
+    from mob_map_dl.common import MapMeta
+    
+    regions = ["europe", "asia", "africa", "america"]
+    return [MapMeta(disp_name="{}{:06d}_{}.obf".format(
+                                        prefix, i, regions[i % len(regions)]),
+                    full_name="http://example.com/{}.zip".format(i),
+                    size=float(size * (1 + i % 100)), 
+                    time=datetime.datetime(2015, 1, 1 + i % 28),
+                    description="Map {}".format(i), map_type="osmand")
+            for i in range(num_maps)]
+
+
+def test_MapCatalog_update_query():
+    "Test storing pages, incremental updates, and queries."
+    from mob_map_dl.catalog import MapCatalog
+    
+    print "Start"
+    catalog = MapCatalog(":memory:")
+    maps = make_map_metas(10)
+    catalog.update_page("src", "http://a", 0, '"e1"', None, maps[5:])
+    catalog.update_page("src", "http://b", 1, None, "Mon", maps[:5])
+    catalog.update_page("other", "http://a", 0, None, None, 
+                        make_map_metas(3, prefix="oam/Other"))
+    
+    #Maps are returned in the order of the pages, with all attributes
+    assert catalog.query("src") == maps[5:] + maps[:5]
+    pages = catalog.get_pages("src")
+    assert pages["http://a"]["etag"] == '"e1"'
+    assert pages["http://b"]["last_modified"] == "Mon"
+    assert pages["http://a"]["fetched"] > time.time() - 10
+    
+    #Queries with patterns are sorted by name, and are not case sensitive
+    assert catalog.query("src", "*EUROPE*") == [maps[0], maps[4], maps[8]]
+    assert catalog.query("src", "*map00000[!0-3]*") == maps[4:10]
+    assert catalog.query("src", "*", min_size=5 * 1024**2, 
+                         max_size=7 * 1024**2) == maps[4:7]
+    assert catalog.query("src", "*", 
+                         newer_than=datetime.datetime(2015, 1, 3),
+                         older_than=datetime.datetime(2015, 1, 6)) == \
+           maps[3:5]
+    
+    #Change one map, remove one map; the other rows are not written again
+    changed = maps[7]._replace(size=1.0)
+    catalog.update_page("src", "http://a", 0, '"e2"', None, 
+                        maps[5:7] + [changed] + maps[8:9])
+    assert catalog.query("src") == maps[5:7] + [changed, maps[8]] + maps[:5]
+    #Written rows: 3 pages and 13 maps, then 1 page and 2 maps
+    assert catalog.conn.total_changes == 16 + 3
+    
+    catalog.touch_page("src", "http://b", fetched=0)
+    assert catalog.get_pages("src")["http://b"]["fetched"] == 0
+    
+    #Pages that the server doesn't list anymore are removed
+    catalog.remove_other_pages("src", ["http://b"])
+    assert catalog.query("src") == maps[:5]
+    assert len(catalog.query("other")) == 3
+    catalog.close()
+    
+    
+def test_MapCatalog_query_speed():
+    """
+    Test the speed of queries on a big catalog, that has to be opened from
+    the disk first (cold ``lss``).
+    """
+    from mob_map_dl.catalog import MapCatalog
+    
+    print "Start"
+    db_path = relative_path("../../test_tmp/test_catalog.sqlite")
+    if path.exists(db_path):
+        os.remove(db_path)
+    catalog = MapCatalog(db_path)
+    maps = make_map_metas(100000)
+    for page in range(10):
+        catalog.update_page("src", "http://a/" + str(page), page, None, None,
+                            maps[page::10])
+    catalog.close()
+    
+    t0 = time.time()
+    catalog = MapCatalog(db_path)
+    matches = catalog.query("src", "osmand/map01234*")
+    t1 = time.time()
+    print "Cold query of 100000 maps:", (t1 - t0) * 1000, "ms"
+    assert [m.disp_name for m in matches] == \
+           [m.disp_name for m in maps[1234 * 10:1235 * 10]]
+    assert t1 - t0 < 0.1
+    
+    #Updating a page, where nothing changed, is faster than inserting it
+    t0 = time.time()
+    catalog.update_page("src", "http://a/0", 0, None, None, maps[0::10])
+    t1 = time.time()
+    print "Update of 10000 unchanged maps:", (t1 - t0) * 1000, "ms"
+    assert catalog.conn.total_changes == 1
+    catalog.close()
+    os.remove(db_path)
+    
+    
+if __name__ == "__main__":
+#    test_MapCatalog_update_query()
+    test_MapCatalog_query_speed()
+    
+    pass #IGNORE:W0107
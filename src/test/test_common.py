@@ -63,6 +63,101 @@ def test_TextProgressBar():
     pb.update_final(42, "Finished")
 
 
+def test_MultiProgressBar():
+    """
+    Test class MultiProgressBar
+    """
+    from mob_map_dl.common import MultiProgressBar
+    
+    print "Start"
+    pb = MultiProgressBar("Foo: total", 84)
+    b1 = pb.make_bar("Foo: 42 bar", 42)
+    b2 = pb.make_bar("Foo: 42 baz", 42)
+    for v in range(0, 42, 10):
+        b1.update_val(v)
+        b2.update_val(v)
+    assert pb.bar_values == {id(b1): 40, id(b2): 40}
+    b1.update_final(42, "Finished")
+    b2.update_val(42)
+    b2.update_final(42, "Finished")
+    pb.update_final("Finished")
+    
+    assert pb.bar_values == {}
+    assert pb.val_finished == 84
+    assert pb.num_finished == 2
+
+
+def test_run_parallel():
+    """Test function run_parallel"""
+    from mob_map_dl.common import run_parallel
+    
+    def square(x):
+        if x == 3:
+            raise ValueError("Three is bad.")
+        time.sleep(0.1)
+        return x**2
+    
+    print "Start"
+    #Sequential execution
+    results, errors = run_parallel(square, [1, 2, 3, 4], 1)
+    assert results == [1, 4, None, 16]
+    assert len(errors) == 1
+    assert errors[0][0] == 3
+    assert isinstance(errors[0][1], ValueError)
+    
+    #Parallel execution must be faster
+    t0 = time.time()
+    results, errors = run_parallel(square, range(10), 10)
+    t1 = time.time()
+    print "Parallel execution:", t1 - t0, "s"
+    assert results == [0, 1, 4, None, 16, 25, 36, 49, 64, 81]
+    assert [arg for arg, _ in errors] == [3]
+    assert t1 - t0 < 0.5
+    
+    
+def test_WorkerPool():
+    """Test class WorkerPool"""
+    from mob_map_dl.common import WorkerPool
+    
+    results = []
+    def square(x):
+        if x == 3:
+            raise ValueError("Three is bad.")
+        time.sleep(0.1)
+        results.append(x**2)
+    
+    print "Start"
+    #Work can be submitted while the pool is working
+    t0 = time.time()
+    pool = WorkerPool(square, 5)
+    for x in range(5):
+        pool.submit(x)
+    time.sleep(0.05)
+    for x in range(5, 10):
+        pool.submit(x)
+    errors = pool.join()
+    t1 = time.time()
+    print "Parallel execution:", t1 - t0, "s"
+    assert sorted(results) == [0, 1, 4, 16, 25, 36, 49, 64, 81]
+    assert [arg for arg, _ in errors] == [3]
+    assert isinstance(errors[0][1], ValueError)
+    assert t1 - t0 < 0.5
+    assert not any(thread.is_alive() for thread in pool.threads)
+    
+    #Work that has not started can be cancelled
+    del results[:]
+    pool = WorkerPool(square, 2)
+    for x in range(10):
+        pool.submit(x)
+    time.sleep(0.05)
+    cancelled = pool.cancel()
+    errors = pool.join()
+    assert sorted(results) == [0, 1]
+    assert cancelled == range(2, 10)
+    assert errors == []
+    assert not any(thread.is_alive() for thread in pool.threads)
+    
+    
 def test_items_sorted():
     """Test function items_sorted"""
     from mob_map_dl.common import items_sorted
@@ -78,6 +173,57 @@ def test_items_sorted():
     assert ds[3] == ("d", 4)
 
 
+def test_PatternMatcher():
+    """Test class PatternMatcher: several patterns, exclusions, speed."""
+    from mob_map_dl.common import PatternMatcher, MapMeta
+    import fnmatch
+    import random
+    
+    print "Start"
+    m = PatternMatcher(["osmand/France*", "*monaco*", "!*_2.obf", "OAM/*"])
+    assert m.match("osmand/France_europe.obf")
+    assert m.match("osmand/Monaco_europe.obf")
+    assert not m.match("osmand/Monaco_europe_2.obf")
+    assert m.match("oam/europe_France_North")
+    assert not m.match("osmand/Germany_europe.obf")
+    assert not m.match("Germany")
+    m = PatternMatcher(["!oam/*"])
+    assert m.match("osmand/Germany_europe.obf")
+    assert not m.match("oam/europe_France_North")
+    m = PatternMatcher(["[!o]*", "Mona?o"])
+    assert m.match("monaco")
+    assert m.match("abc/def")
+    assert not m.match("osmand/x")
+    
+    #Each map is returned only once.
+    maps = [MapMeta(name, "", 0, None, "", None) for name in 
+            ["osmand/France_europe.obf", "osmand/Monaco_europe.obf"]]
+    assert PatternMatcher(["osmand/*", "*France*"]).filter(maps) == maps
+    
+    #Same results as ``fnmatch``; faster than matching each pattern.
+    rand = random.Random(1)
+    countries = ["Country{:04d}".format(i) for i in range(2000)]
+    names = ["{}/{}_{}.obf".format(comp, country, region) 
+             for comp in ["osmand", "oam", "orux"]
+             for country in countries for region in ["europe", "asia"]]
+    patterns = ["osmand/" + rand.choice(countries) + "*" for _ in range(150)]
+    patterns += ["*" + rand.choice(countries) + "_asia*" for _ in range(50)]
+    
+    t0 = time.time()
+    matches_fnmatch = set()
+    for pattern in patterns:
+        for name in names:
+            if fnmatch.fnmatchcase(name.lower(), pattern.lower()):
+                matches_fnmatch.add(name)
+    t1 = time.time()
+    m = PatternMatcher(patterns)
+    matches = set(name for name in names if m.match(name))
+    t2 = time.time()
+    print "fnmatch:", t1 - t0, "s, PatternMatcher:", t2 - t1, "s"
+    assert matches == matches_fnmatch
+    assert t2 - t1 < (t1 - t0) / 5
+    
+    
 def test_PartFile():
     from mob_map_dl.common import PartFile
     
@@ -113,7 +259,11 @@ def test_PartFile():
     
 if __name__ == "__main__":
 #    test_TextProgressBar()
+#    test_MultiProgressBar()
+#    test_run_parallel()
+#    test_WorkerPool()
 #    test_items_sorted()
+#    test_PatternMatcher()
     test_PartFile()
     
     pass #IGNORE:W0107
@@ -28,12 +28,13 @@ from __future__ import division
 from __future__ import absolute_import              
 
 #For test modules: ----------------------------------------------------------
-#import pytest #contains `skip`, `fail`, `raises`, `config`
+import pytest #contains `skip`, `fail`, `raises`, `config`
 
 import time
 import os
 import os.path as path
 import shutil
+import hashlib
 from pprint import pprint
 import urllib2
 
@@ -94,6 +95,42 @@ def create_writable_test_dirs(idx):
     return test_app_dir, test_dev_dir
 
 
+def make_osmand_list_html(num_maps, prefix="Map"):
+    """
+    Create a synthetic HTML page, with the structure of Osmand's list of maps.
+    Contains ``num_maps`` maps.
+    """
+    rows = ['<tr><th>File</th><th>Date</th><th>Size</th><th>Description</th>'
+            '</tr>\n', 
+            '<tr><td><A HREF="/download.php?file=.gitignore">.gitignore</A>'
+            '</td><td>01.01.2014</td><td>0.0</td><td></td></tr>\n']
+    for i in range(num_maps):
+        name = "{}{:06d}_europe_2.obf.zip".format(prefix, i)
+        rows.append('<tr><td><A HREF="/download.php?standard=yes&file={n}">'
+                    '{n}</A></td><td>03.08.2014</td><td>8.2</td>'
+                    '<td>Map, Roads, POI for {n}</td></tr>\n'.format(n=name))
+    return ("<html><head><title>Index</title></head><body><h1>Maps</h1>"
+            "<table>\n" + "".join(rows) + "</table></body></html>")
+    
+    
+def make_oam_list_html(num_maps, region="europe"):
+    """
+    Create a synthetic HTML page, with the structure of Openandromaps' lists 
+    of maps. Contains ``num_maps`` maps.
+    """
+    rows = []
+    for i in range(num_maps):
+        url = "http://www.openandromaps.org/maps/{r}/Map{i:06d}.zip".format(
+                                                                r=region, i=i)
+        rows.append('<tr><td>Map {i}</td><td>2014-08-03</td><td>12.5</td>'
+                    '<td><a href="{u}">Download</a></td></tr>\n'.format(
+                                                                i=i, u=url))
+    return ("<html><head><title>Downloads</title></head><body><table>"
+            "<thead><tr><th>Name</th><th>Date</th><th>Size</th><th></th></tr>"
+            "</thead><tbody>\n" + "".join(rows) + "</tbody></table>"
+            "</body></html>")
+
+
 def test_find_index():
     "Test internal helper function ``find_index``."
     
@@ -134,6 +171,427 @@ def test_BaseDownloader_download_file():
     assert 0.2 < file_size < 0.5
     
     
+def test_BaseDownloader_download_file_resume():
+    """
+    Test class BaseDownloader: Continue interrupted downloads with ``Range`` 
+    requests. Uses a local HTTP server.
+    """
+    from mob_map_dl.download import BaseDownloader
+    from .local_server import LocalHTTPServer
+    
+    def interrupted_download():
+        "Create a '*.part' file with the first bytes of the file."
+        server.abort_after = 300 * 1024
+        with pytest.raises(IOError):
+            d.download_file(url, test_map_name, "test-file-name.foo")
+        server.abort_after = None
+        assert path.isfile(test_map_name + ".part")
+        return path.getsize(test_map_name + ".part")
+    
+    print "Start"
+    test_map_name = relative_path("../../test_tmp/test_resume.obf.zip")
+    for name in [test_map_name, test_map_name + ".part"]:
+        try: os.remove(name)
+        except OSError: pass
+    data1 = os.urandom(1024**2)
+    data2 = os.urandom(1024**2)
+    server = LocalHTTPServer()
+    server.add_file("/maps/test.zip", data1)
+    server.start()
+    url = server.url("/maps/test.zip")
+    d = BaseDownloader()
+    
+    try:
+        #Continue the download where it was interrupted
+        part_size = interrupted_download()
+        print "Size of '*.part' file:", part_size
+        assert 0 < part_size < len(data1)
+        del server.requests[:]
+        sha256 = d.download_file(url, test_map_name, "test-file-name.foo")
+        assert open(test_map_name, "rb").read() == data1
+        #The hash includes the data from the '*.part' file
+        assert sha256 == hashlib.sha256(data1).hexdigest()
+        assert not path.exists(test_map_name + ".part")
+        assert not path.exists(test_map_name + ".part.json")
+        assert len(server.requests) == 1
+        assert server.requests[0][2]["range"] == "bytes={}-".format(part_size)
+        
+        #The file has changed on the server: download it completely
+        interrupted_download()
+        server.add_file("/maps/test.zip", data2)
+        del server.requests[:]
+        d.download_file(url, test_map_name, "test-file-name.foo")
+        assert open(test_map_name, "rb").read() == data2
+        assert server.requests[0][2]["if-range"] is not None
+        
+        #The server does not support ``Range``: download completely
+        interrupted_download()
+        server.ignore_range = True
+        d.download_file(url, test_map_name, "test-file-name.foo")
+        assert open(test_map_name, "rb").read() == data2
+    finally:
+        server.stop()
+    
+    
+def test_BaseDownloader_download_segments():
+    """
+    Test class BaseDownloader: Download a file in several segments in 
+    parallel. Uses a local HTTP server.
+    """
+    from mob_map_dl import download
+    from mob_map_dl.download import BaseDownloader
+    from mob_map_dl.httppool import HostLimiter
+    from .local_server import LocalHTTPServer
+    
+    class CountingLimiter(HostLimiter):
+        "Record the maximum number of connections that are open at once."
+        num_active = 0
+        max_active = 0
+        def acquire(self, host):
+            HostLimiter.acquire(self, host)
+            with self.lock:
+                self.num_active += 1
+                self.max_active = max(self.max_active, self.num_active)
+        def release(self, host):
+            with self.lock:
+                self.num_active -= 1
+            HostLimiter.release(self, host)
+    
+    print "Start"
+    test_map_name = relative_path("../../test_tmp/test_segments.obf.zip")
+    data = os.urandom(1024**2 * 4 + 123)
+    server = LocalHTTPServer()
+    server.add_file("/maps/test.zip", data)
+    server.chunk_size = 1024 * 16
+    server.delay_per_chunk = 0.001
+    server.start()
+    url = server.url("/maps/test.zip")
+    old_limiter = download.SEGMENT_LIMITER
+    limiter = CountingLimiter(max_per_host=3)
+    download.SEGMENT_LIMITER = limiter
+    
+    d = BaseDownloader()
+    d.segments = 8
+    d.min_segment_size = 1024**2 // 2
+    try:
+        sha256 = d.download_file(url, test_map_name, "test-file-name.foo")
+    finally:
+        server.stop()
+        download.SEGMENT_LIMITER = old_limiter
+    
+    assert open(test_map_name, "rb").read() == data
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert not path.exists(test_map_name + ".part")
+    assert not path.exists(test_map_name + ".part.json")
+    #One "HEAD" request, and one "GET" request for each segment
+    assert len(server.requests) == 9
+    assert server.requests[0][0] == "HEAD"
+    ranges = [req[2]["range"] for req in server.requests[1:]]
+    print ranges
+    assert "bytes=0-524303" in ranges
+    #Not more than the allowed number of segments per host.
+    print "Maximum number of concurrent segments:", limiter.max_active
+    assert limiter.max_active == 3
+    assert 1 < server.max_active
+    
+    
+def test_BaseDownloader_download_delta():
+    """
+    Test class BaseDownloader: Update a local file, by downloading only the
+    changed blocks. Uses a local HTTP server.
+    """
+    from mob_map_dl.download import BaseDownloader, OsmandDownloader
+    from mob_map_dl.delta import (CONTROL_SUFFIX, write_control_file, 
+                                  match_seed, make_control)
+    from .local_server import LocalHTTPServer
+    import json
+    
+    print "Start"
+    test_map_name = relative_path("../../test_tmp/test_delta.obf.zip")
+    test_new_name = relative_path("../../test_tmp/test_delta_new.obf.zip")
+    old_data = os.urandom(1024 * 300)
+    #Insertion shifts the remaining data, one changed byte, new end
+    new_data = old_data[:50000] + "inserted" * 13 + \
+               old_data[50000:200000] + "x" + old_data[200001:290000] + \
+               "new end" * 100
+    open(test_new_name, "wb").write(new_data)
+    ctrl_path = write_control_file(test_new_name, block_size=1024 * 4)
+    control = make_control(test_new_name, block_size=1024 * 4)
+    
+    #The indexer finds shifted blocks in the seed.
+    open(test_map_name, "wb").write(old_data)
+    found = match_seed(test_map_name, control)
+    assert found[0] == 0
+    assert found[15] == 15 * 4096 - 8 * 13
+    assert len(found) > len(control["blocks"]) - 6
+    
+    server = LocalHTTPServer()
+    server.add_file("/maps/test.zip", new_data)
+    server.add_file("/maps/test.zip" + CONTROL_SUFFIX, 
+                    open(ctrl_path, "rb").read())
+    server.start()
+    url = server.url("/maps/test.zip")
+    d = BaseDownloader()
+    d.delta = True
+    try:
+        sha256 = d.download_file(url, test_map_name, "test-file-name.foo")
+        requests_delta = server.requests
+        
+        #Server without control file: normal download
+        open(test_map_name, "wb").write(old_data)
+        del server.files["/maps/test.zip" + CONTROL_SUFFIX]
+        server.requests = []
+        sha256_full = d.download_file(url, test_map_name, 
+                                      "test-file-name.foo")
+        requests_full = server.requests
+        
+        #Wrong control file: the result is checked, normal download
+        open(test_map_name, "wb").write(old_data)
+        control["sha256"] = "bad"
+        server.add_file("/maps/test.zip" + CONTROL_SUFFIX, 
+                        json.dumps(control))
+        server.requests = []
+        sha256_bad = d.download_file(url, test_map_name, 
+                                     "test-file-name.foo")
+        requests_bad = server.requests
+        
+        #Sources without control files are not asked for them
+        open(test_map_name, "wb").write(old_data)
+        osm = OsmandDownloader()
+        osm.delta = True
+        server.requests = []
+        osm.download_file(url, test_map_name, "test-file-name.foo")
+        requests_osm = server.requests
+    finally:
+        server.stop()
+    
+    assert open(test_map_name, "rb").read() == new_data
+    assert sha256 == sha256_full == sha256_bad == \
+           hashlib.sha256(new_data).hexdigest()
+    assert not path.exists(test_map_name + ".part")
+    
+    #Control file, "HEAD", only a few small ranges
+    print [(req[0], req[1], req[2].get("range")) for req in requests_delta]
+    assert requests_delta[0][1].endswith(CONTROL_SUFFIX)
+    assert requests_delta[1][0] == "HEAD"
+    ranges = [req[2]["range"] for req in requests_delta[2:]]
+    assert 1 <= len(ranges) <= 5
+    size_fetched = 0
+    for range_ in ranges:
+        start, end = range_[len("bytes="):].split("-")
+        size_fetched += int(end) - int(start) + 1
+    print "Fetched:", size_fetched, "of", len(new_data)
+    assert size_fetched < len(new_data) * 0.1
+    
+    assert "range" not in requests_full[-1][2]
+    assert requests_full[-1][0] == "GET"
+    assert "range" not in requests_bad[-1][2]
+    assert [req[:2] for req in requests_osm] == [("GET", "/maps/test.zip")]
+    
+    
+def test_match_seed_runtime():
+    """
+    Test function match_seed: the search time is bounded for large seeds,
+    that don't match (like compressed archives). Blocks at the block 
+    boundaries are still found.
+    """
+    from mob_map_dl.delta import match_seed, weak_checksum, SCAN_BUDGET
+    
+    print "Start"
+    seed_name = relative_path("../../test_tmp/test_delta_seed.obf.zip")
+    block_size = 1024 * 64
+    seed_size = 1024**2 * 64
+    fseed = open(seed_name, "wb")
+    for _ in range(seed_size // 1024**2):
+        fseed.write(os.urandom(1024**2))
+    fseed.close()
+    #The new file: 2 blocks from the seed at block boundaries, 1 shifted 
+    #block in the budget, the other blocks are not in the seed.
+    new_blocks = [os.urandom(block_size) for _ in range(8)]
+    fseed = open(seed_name, "rb")
+    for index, seed_pos in [(1, 0), (5, block_size * 700), 
+                           (6, block_size * 3 + 100)]:
+        fseed.seek(seed_pos)
+        new_blocks[index] = fseed.read(block_size)
+    fseed.close()
+    blocks = []
+    for buf in new_blocks:
+        sum_a, sum_b = weak_checksum(buf)
+        blocks.append([sum_a | sum_b << 16, hashlib.md5(buf).hexdigest()])
+    control = {"version": 1, "size": block_size * len(blocks), 
+               "block_size": block_size, "sha256": "", "blocks": blocks}
+    
+    t0 = time.time()
+    found = match_seed(seed_name, control)
+    t1 = time.time()
+    print "match_seed, {} MiB seed: {:.2f} s".format(seed_size // 1024**2, 
+                                                     t1 - t0)
+    assert found == {1: 0, 5: block_size * 700, 6: block_size * 3 + 100}
+    assert t1 - t0 < 10
+    
+    #Without budget only the block boundaries are searched.
+    t0 = time.time()
+    found = match_seed(seed_name, control, scan_budget=0)
+    t1 = time.time()
+    print "match_seed, block boundaries only: {:.2f} s".format(t1 - t0)
+    assert found == {1: 0, 5: block_size * 700}
+    assert t1 - t0 < SCAN_BUDGET / 1024**2
+    os.remove(seed_name)
+    
+    
+def test_BaseDownloader_connection_pool():
+    """
+    Test class BaseDownloader: Consecutive downloads reuse the same 
+    connection. Uses a local HTTP server.
+    """
+    import urllib2
+    from mob_map_dl import download
+    from mob_map_dl.download import BaseDownloader
+    from mob_map_dl.httppool import ConnectionPool
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    test_map_name = relative_path("../../test_tmp/test_pool.obf.zip")
+    data = os.urandom(1024 * 300)
+    server = LocalHTTPServer()
+    server.add_file("/maps/test.zip", data)
+    server.start()
+    url = server.url("/maps/test.zip")
+    old_pool = download.CONNECTION_POOL
+    download.CONNECTION_POOL = ConnectionPool(max_per_host=2)
+    
+    d = BaseDownloader()
+    try:
+        for _ in range(3):
+            d.download_file(url, test_map_name, "test-file-name.foo")
+            assert open(test_map_name, "rb").read() == data
+        #Errors are reported like ``urllib2`` does
+        with pytest.raises(urllib2.HTTPError):
+            d.open_url(server.url("/maps/missing.zip"))
+        resp = d.open_url(url, method="HEAD")
+        resp.close()
+        assert resp.info().getheader("Content-Length") == str(len(data))
+    finally:
+        server.stop()
+        download.CONNECTION_POOL = old_pool
+    
+    print "Number of connections:", server.connections
+    assert len(server.requests) == 5
+    assert server.connections == 1
+    
+    
+def test_BaseDownloader_limit_rate():
+    """
+    Test class BaseDownloader: Concurrent downloads share the bandwidth 
+    of ``RATE_LIMITER``. Uses a local HTTP server.
+    """
+    from mob_map_dl import download
+    from mob_map_dl.download import BaseDownloader
+    from mob_map_dl.common import run_parallel
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    data = os.urandom(1024 * 256)
+    server = LocalHTTPServer()
+    server.add_file("/maps/test.zip", data)
+    server.start()
+    url = server.url("/maps/test.zip")
+    download.RATE_LIMITER.set_limit(512 * 1024)
+    
+    def download_one(i):
+        d = BaseDownloader()
+        loc_name = relative_path("../../test_tmp/test_rate_{}.obf.zip"
+                                 .format(i))
+        d.download_file(url, loc_name, "test-file-name.foo")
+        assert open(loc_name, "rb").read() == data
+    
+    try:
+        t0 = time.time()
+        _, errors = run_parallel(download_one, range(3), 3)
+        t1 = time.time()
+    finally:
+        server.stop()
+        download.RATE_LIMITER.set_limit(None)
+    
+    print "Time for 768 KiB at 512 KiB/s:", t1 - t0, "s"
+    assert errors == []
+    assert 1.3 < t1 - t0 < 2.5
+    
+    
+def test_BaseDownloader_iter_list_stream():
+    """
+    Benchmark the streaming parser for lists of maps, with synthetic lists of
+    10k and 100k maps. Compare with parsing the whole document.
+    """
+    from mob_map_dl.download import (OsmandDownloader, 
+                                     OpenandromapsDownloader)
+    from cStringIO import StringIO
+    import lxml.html
+    
+    print "Start"
+    for num_maps in [10000, 100000]:
+        for dl, list_html in [(OsmandDownloader(), 
+                               make_osmand_list_html(num_maps)), 
+                              (OpenandromapsDownloader(), 
+                               make_oam_list_html(num_maps))]:
+            #Parse the whole document, like the old implementation
+            t0 = time.time()
+            root = lxml.html.document_fromstring(list_html)
+            container = root.find(".//" + dl.list_container_tag)
+            maps_dom = [dl.parse_list_row(row, i) 
+                        for i, row in enumerate(container)]
+            maps_dom = [m for m in maps_dom if m is not None]
+            t_dom = time.time() - t0
+            num_rows = len(container)
+            del root, container
+            
+            #Record the number of rows, that exist in the tree at the same time
+            max_rows = [0]
+            orig_parse_row = dl.parse_list_row
+            def parse_list_row(row, row_index):
+                max_rows[0] = max(max_rows[0], len(row.getparent()))
+                return orig_parse_row(row, row_index)
+            dl.parse_list_row = parse_list_row
+            
+            t0 = time.time()
+            map_iter = dl.iter_list_stream(StringIO(list_html))
+            first_map = next(map_iter)
+            t_first = time.time() - t0
+            maps = [first_map] + list(map_iter)
+            t_stream = time.time() - t0
+            
+            print "{} rows, {:.1f} MB, {}:".format(
+                        num_rows, len(list_html) / 1e6, type(dl).__name__)
+            print "    whole document:  {:.3f} s".format(t_dom)
+            print "    streaming:       {:.3f} s, first map after {:.4f} s, "\
+                  "max. {} rows in memory".format(t_stream, t_first, 
+                                                   max_rows[0])
+            
+            assert len(maps) == num_maps
+            assert maps == maps_dom
+            assert maps[0].disp_name.endswith("Map000000_europe_2.obf") or \
+                   maps[0].disp_name == "oam/europe_Map000000"
+            assert maps[-1].size == maps[0].size
+            #Processed rows are removed from the tree
+            assert max_rows[0] < 1000
+            #First map is available long before the whole list is parsed
+            assert t_first < t_stream / 10
+    
+    #Parsing a complete page gives the same result
+    dl = OsmandDownloader()
+    list_html = make_osmand_list_html(3)
+    maps = dl.parse_list_page(list_html)
+    assert maps == list(dl.iter_list_stream(StringIO(list_html)))
+    assert [m.disp_name for m in maps] == ["osmand/Map000000_europe_2.obf", 
+                                           "osmand/Map000001_europe_2.obf", 
+                                           "osmand/Map000002_europe_2.obf"]
+    assert maps[0].full_name == "http://download.osmand.net/download.php?"\
+                                "standard=yes&file=Map000000_europe_2.obf.zip"
+    assert maps[0].time.month == 8 and maps[0].time.day == 3
+    assert maps[0].description == "Map, Roads, POI for " \
+                                  "Map000000_europe_2.obf.zip"
+    
+
 def test_OsmandDownloader_get_file_list():
     "Test class OsmandDownloader: Listing of files that can be downloaded."
     from mob_map_dl.download import OsmandDownloader
@@ -181,8 +639,8 @@ def test_OsmandDownloader_chaching_mechanism():
     
     We use ``OsmandDownloader`` for the test because it is fairly fast.
     Actually downloading the and parsing the HTML is nearly as fast (0.3 s) 
-    than un-pickling the cached list (0.05 s). The test may fail on a computer 
-    with a really fast Internet connection. 
+    than reading the list from the catalog (0.05 s). The test may fail on a 
+    computer with a really fast Internet connection. 
     
     The caching mechanism is intended for ``OpenandromapsDownloader``, which
     needs several seconds to download and parse the HTML, because the server 
@@ -224,6 +682,143 @@ def test_OsmandDownloader_chaching_mechanism():
     assert abs(delta1 - delta4) < 0.15
     
 
+def test_OsmandDownloader_conditional_get():
+    """
+    Test the revalidation of the cached list of maps with conditional 
+    requests. Uses a local HTTP server.
+    """
+    from mob_map_dl.download import OsmandDownloader
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    app_dir, _ = create_writable_test_dirs("d2")
+    server = LocalHTTPServer()
+    server.add_file("/list.php", make_osmand_list_html(3), 
+                    content_type="text/html")
+    server.start()
+    
+    dl = OsmandDownloader(app_dir, cache_time=0)
+    dl.list_url = server.url("/list.php")
+    try:
+        #Download list, parse HTML, write catalog
+        l1 = dl.get_file_list()
+        assert len(l1) == 3
+        assert l1[0].disp_name == "osmand/Map000000_europe_2.obf"
+        assert "if-none-match" not in server.requests[-1][2]
+        assert path.exists(dl.get_cache_path())
+        dl.catalog.touch_page(dl.source, dl.list_url, fetched=0)
+        
+        #Page did not change: server answers "304 Not Modified", 
+        #and the page is marked as fresh.
+        l2 = dl.get_file_list()
+        assert l2 == l1
+        assert server.requests[-1][2]["if-none-match"] == \
+               server.files["/list.php"].etag
+        assert dl.catalog.get_pages(dl.source)[dl.list_url]["fetched"] > 0
+        
+        #Page has changed, it must be parsed again.
+        server.add_file("/list.php", make_osmand_list_html(5), 
+                        content_type="text/html")
+        l3 = dl.get_file_list()
+        assert len(l3) == 5
+    finally:
+        server.stop()
+    
+
+def test_OsmandDownloader_background_refresh():
+    """
+    Test returning the outdated list of maps immediately, while it is 
+    refreshed in a background thread. Uses a local HTTP server.
+    """
+    from mob_map_dl.download import OsmandDownloader
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    server = LocalHTTPServer()
+    server.add_file("/list.php", make_osmand_list_html(3), 
+                    content_type="text/html")
+    server.start()
+    
+    dl = OsmandDownloader(cache_time=3600)
+    dl.list_url = server.url("/list.php")
+    dl.background_refresh = True
+    try:
+        #Without stored list the first download can't be in the background
+        l1 = dl.get_file_list()
+        assert len(l1) == 3
+        assert not dl.is_refreshing()
+        assert dl.get_catalog_age() < 10
+        
+        #Outdated list is returned immediately, while the new list is slow
+        server.add_file("/list.php", make_osmand_list_html(5), 
+                        content_type="text/html")
+        server.chunk_size = 100
+        server.delay_per_chunk = 0.05
+        dl.catalog.touch_page(dl.source, dl.list_url, fetched=0)
+        t0 = time.time()
+        l2 = dl.get_file_list()
+        t1 = time.time()
+        print "Time for outdated list:", t1 - t0, "s"
+        assert l2 == l1
+        assert t1 - t0 < 0.1
+        assert dl.is_refreshing()
+        assert dl.get_catalog_age() > 3600
+        
+        #The refreshed list has changed
+        assert dl.wait_refresh() == True
+        assert len(dl.get_file_list()) == 5
+        assert dl.get_catalog_age() < 10
+        
+        #Refresh without changes
+        dl.catalog.touch_page(dl.source, dl.list_url, fetched=0)
+        assert len(dl.get_file_list()) == 5
+        assert dl.wait_refresh() == False
+        assert dl.get_catalog_age() < 10
+    finally:
+        server.stop()
+    
+    
+def test_OpenandromapsDownloader_parallel_pages():
+    """
+    Test downloading and parsing the region pages of Openandromaps in 
+    parallel. Uses a local HTTP server.
+    """
+    from mob_map_dl.download import OpenandromapsDownloader
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    regions = ["europe", "germany", "usa", "canada", "asia", "africa"]
+    server = LocalHTTPServer()
+    for region in regions:
+        server.add_file("/downloads/" + region, 
+                        make_oam_list_html(20, region), 
+                        content_type="text/html")
+    server.chunk_size = 1024
+    server.delay_per_chunk = 0.05
+    server.start()
+    
+    dl = OpenandromapsDownloader()
+    dl.list_urls = [server.url("/downloads/" + region) 
+                    for region in regions + ["missing"]]
+    dl.list_jobs = 7
+    try:
+        t0 = time.time()
+        l = dl.get_file_list()
+        t1 = time.time()
+    finally:
+        server.stop()
+    
+    print "Time for parallel download:", t1 - t0, "s"
+    #The missing page is reported, the other pages are returned 
+    #in the order of ``list_urls``
+    assert len(l) == 6 * 20
+    assert l[0].disp_name == "oam/europe_Map000000"
+    assert l[20].disp_name == "oam/germany_Map000000"
+    assert l[-1].disp_name == "oam/africa_Map000019"
+    #Each page needs about 0.2 s
+    assert t1 - t0 < 0.2 * len(regions) / 2
+    
+
 def test_OpenandromapsDownloader_make_disp_name():
     from mob_map_dl.download import OpenandromapsDownloader
     
@@ -289,8 +884,18 @@ def test_OpenandromapsDownloader_get_file_list():
 
 if __name__ == "__main__":
 #    test_BaseDownloader_download_file()
+#    test_BaseDownloader_download_file_resume()
+#    test_BaseDownloader_download_segments()
+#    test_BaseDownloader_download_delta()
+#    test_match_seed_runtime()
+#    test_BaseDownloader_connection_pool()
+#    test_BaseDownloader_limit_rate()
+#    test_BaseDownloader_iter_list_stream()
 #    test_OsmandDownloader_get_file_list()
     test_OsmandDownloader_chaching_mechanism()
+#    test_OsmandDownloader_conditional_get()
+#    test_OsmandDownloader_background_refresh()
+#    test_OpenandromapsDownloader_parallel_pages()
 #    test_OpenandromapsDownloader_make_disp_name()
 #    test_OpenandromapsDownloader_get_file_list()
     
@@ -124,10 +124,88 @@ def test_OruxmapsInstaller_get_file_list():
     assert l[0].size == 447481
     
 
+def test_BaseInstaller_get_listing():
+    "BaseInstaller: Cache the listing of the device, in memory and on device."
+    from mob_map_dl import install
+    from mob_map_dl.install import OsmandInstaller
+    import os
+    import shutil
+    
+    def count_scans(installer):
+        "Count the calls to ``scan_install_dir``."
+        installer.num_scans = 0
+        scan_install_dir = installer.scan_install_dir
+        def counting_scan(filter_pattern):
+            installer.num_scans += 1
+            return scan_install_dir(filter_pattern)
+        installer.scan_install_dir = counting_scan
+        installer.mtime_resolution = 0
+    
+    print "Start."
+    device_path = relative_path("../../test_tmp/TEST-DEVICE-i1")
+    shutil.rmtree(device_path, ignore_errors=True)
+    os.makedirs(path.join(device_path, "osmand"))
+    for name, size in [("a.obf", 10), ("b.obf", 20), ("other.txt", 5)]:
+        open(path.join(device_path, "osmand", name), "wb").write("x" * size)
+    
+    i = OsmandInstaller(device_path)
+    count_scans(i)
+    l = i.get_file_list()
+    l = i.get_file_list()
+    pprint(l)
+    assert [(m.disp_name, m.size) for m in l] == [("osmand/a.obf", 10), 
+                                                  ("osmand/b.obf", 20)]
+    assert i.num_scans == 1
+    
+    #New file changes the directory.
+    open(path.join(device_path, "osmand/c.obf"), "wb").write("x" * 30)
+    l = i.get_file_list()
+    assert len(l) == 3
+    assert i.num_scans == 2
+    #Map changed in place must be reported.
+    open(path.join(device_path, "osmand/a.obf"), "ab").write("x" * 5)
+    i.forget_listing()
+    l = i.get_file_list()
+    assert l[0].size == 15
+    assert i.num_scans == 3
+    
+    #Without ``scandir`` the results are the same.
+    old_get_scandir = install.get_scandir
+    install.get_scandir = lambda: None
+    try:
+        i.forget_listing()
+        l_fallback = i.get_file_list()
+    finally:
+        install.get_scandir = old_get_scandir
+    assert l_fallback == l
+    
+    #The manifest on the device is used by the next run.
+    i = OsmandInstaller(device_path)
+    i.use_manifest = True
+    count_scans(i)
+    l = i.get_file_list()
+    assert i.num_scans == 1
+    assert path.exists(path.join(device_path, "osmand", i.manifest_name))
+    i = OsmandInstaller(device_path)
+    i.use_manifest = True
+    count_scans(i)
+    l_manifest = i.get_file_list()
+    assert l_manifest == l
+    assert i.num_scans == 0
+    #Changes in the same time step as the scan can't be detected.
+    i = OsmandInstaller(device_path)
+    i.use_manifest = True
+    count_scans(i)
+    i.mtime_resolution = 3600
+    i.get_file_list()
+    assert i.num_scans == 1
+    
+
 if __name__ == "__main__":
 #    test_OsmandInstaller_name_conversion()
 #    test_OsmandInstaller_get_file_list()
     test_OruxmapsInstaller_name_conversion()
 #    test_OruxmapsInstaller_get_file_list()
+#    test_BaseInstaller_get_listing()
     
     pass #IGNORE:W0107
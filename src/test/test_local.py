@@ -109,7 +109,8 @@ def test_OsmandManager_get_file_list():
     "Test class OsmandManager: Extracting maps from downloaded archives."
 
     from mob_map_dl.local import OsmandManager
-    download_dir = relative_path("../../test_data/maps/")
+    #The index of the archives is written into the download directory.
+    download_dir, _ = create_writable_test_dirs("l8")
     
     m = OsmandManager(download_dir)
     l = m.get_file_list()
@@ -162,6 +163,386 @@ def test_OsmandManager_extract_map():
     assert file_size == 4518034
 
 
+def test_BaseManager_extract_map_parallel():
+    """
+    Test extracting several maps concurrently, with a limit for the number
+    of concurrent writes.
+    """
+    from mob_map_dl.local import OsmandManager, OpenandromapsManager
+    from mob_map_dl.common import MultiProgressBar, run_parallel
+    import threading
+    
+    class WriteRecorder(object):
+        "Semaphore that records the number of concurrent writers."
+        def __init__(self, num_writers):
+            self.semaphore = threading.Semaphore(num_writers)
+            self.lock = threading.Lock()
+            self.active = 0
+            self.max_active = 0
+            self.writes = 0
+        def __enter__(self):
+            self.semaphore.acquire()
+            with self.lock:
+                self.active += 1
+                self.writes += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(0.05)
+        def __exit__(self, *_):
+            with self.lock:
+                self.active -= 1
+            self.semaphore.release()
+    
+    print "Start"
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l10")
+    osm = OsmandManager(test_app_dir)
+    oam = OpenandromapsManager(test_app_dir)
+    jobs = [(osm, "osmand/Jamaica_centralamerica_2.obf.zip", 4518034), 
+            (osm, "osmand/Monaco_europe_2.obf.zip", None),
+            (oam, "oam/SouthAmerica_bermuda.zip", None)]
+    recorder = WriteRecorder(1)
+    progress = MultiProgressBar("Installing", val_max=0)
+    def extract(job):
+        mgr, arch_name, _ = job
+        out_name = path.join(test_dev_dir, path.basename(arch_name) + ".out")
+        mgr.extract_map(path.join(test_app_dir, arch_name), out_name, 
+                        arch_name, progress.make_bar, recorder)
+    _, errors = run_parallel(extract, jobs, len(jobs))
+    progress.update_final("Finished")
+    
+    assert errors == []
+    assert recorder.writes >= len(jobs)
+    assert recorder.max_active == 1
+    for mgr, arch_name, size in jobs:
+        out_name = path.join(test_dev_dir, path.basename(arch_name) + ".out")
+        fzip, size_total, _ = mgr.get_map_extractor(
+                                        path.join(test_app_dir, arch_name))
+        assert open(out_name, "rb").read() == fzip.read()
+        assert size in (None, size_total)
+    
+    
+def test_BaseManager_extract_map_stored():
+    """
+    Test extracting maps, that are stored uncompressed in their archives.
+    They are checked with their CRC-32, and copied with ``sendfile`` once 
+    they have been checked.
+    """
+    from mob_map_dl.local import OsmandManager, get_sendfile
+    from mob_map_dl import local
+    import zipfile
+    import errno
+    
+    print "Start"
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l11")
+    mgr = OsmandManager(test_app_dir)
+    fzip, _, _ = mgr.get_map_extractor(path.join(
+                        test_app_dir, "osmand/Monaco_europe_2.obf.zip"))
+    map_data = fzip.read()
+    arch_path = path.join(test_app_dir, "osmand/Stored_europe_2.obf.zip")
+    zip_out = zipfile.ZipFile(arch_path, "w", zipfile.ZIP_STORED)
+    zip_out.writestr("Stored_europe_2.obf", map_data)
+    zip_out.close()
+    out_name = path.join(test_dev_dir, "osmand/Stored_europe_2.obf")
+    
+    stored = mgr.find_stored_map(arch_path)
+    assert stored.entry_name == "Stored_europe_2.obf"
+    assert stored.size == len(map_data)
+    arch_data = open(arch_path, "rb").read()
+    assert arch_data[stored.offset:stored.offset + stored.size] == map_data
+    assert mgr.find_stored_map(path.join(
+                test_app_dir, "osmand/Monaco_europe_2.obf.zip")) is None
+    
+    #The first extraction reads the map in Python, and checks it.
+    mgr.record_archive_hash(arch_path, "")
+    mgr.extract_map(arch_path, out_name, "osmand/Stored_europe_2.obf")
+    assert open(out_name, "rb").read() == map_data
+    assert mgr.read_manifest(arch_path)["map_size"] == len(map_data)
+    
+    #Later zero-copy installations don't use ``zipfile``, don't read the 
+    #archive in Python, and don't read the copy on the device.
+    opened = []
+    def recording_open(name, *args):
+        opened.append(name)
+        return open(name, *args)
+    get_map_extractor = mgr.get_map_extractor
+    if get_sendfile() is not None:
+        mgr.get_map_extractor = None
+    local.open = recording_open
+    try:
+        t0 = time.time()
+        mgr.extract_map(arch_path, out_name, "osmand/Stored_europe_2.obf")
+        t1 = time.time()
+    finally:
+        del local.open
+        mgr.get_map_extractor = get_map_extractor
+    print "Time for copying stored map:", t1 - t0, "s"
+    assert out_name not in opened and out_name + ".part" not in opened
+    assert opened.count(arch_path) <= 1
+    assert open(out_name, "rb").read() == map_data
+    
+    #File systems without ``sendfile``: the map is copied in Python. 
+    #Other errors are not hidden.
+    def make_failing(err_num):
+        def failing_sendfile(*_):
+            raise OSError(err_num, os.strerror(err_num))
+        return failing_sendfile
+    sendfile_cache = local._sendfile_cache[:]
+    try:
+        local._sendfile_cache[:] = [make_failing(errno.EINVAL)]
+        mgr.extract_map(arch_path, out_name, "osmand/Stored_europe_2.obf")
+        assert open(out_name, "rb").read() == map_data
+        os.remove(out_name)
+        local._sendfile_cache[:] = [make_failing(errno.ENOSPC)]
+        try:
+            mgr.extract_map(arch_path, out_name, "osmand/Stored_europe_2.obf")
+        except OSError, err:
+            assert err.errno == errno.ENOSPC
+        else:
+            assert False, "OSError expected"
+        assert not path.exists(out_name)
+        assert not path.exists(out_name + ".part")
+    finally:
+        local._sendfile_cache[:] = sendfile_cache
+    
+    #Corrupted map is detected with the CRC
+    corrupt_pos = stored.offset + stored.size // 2
+    arch_data = arch_data[:corrupt_pos] + chr(ord(arch_data[corrupt_pos]) ^ 1) \
+                + arch_data[corrupt_pos + 1:]
+    open(arch_path, "wb").write(arch_data)
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Stored_europe_2.obf")
+    except (IOError, zipfile.BadZipfile):
+        pass
+    else:
+        assert False, "Error expected"
+    assert not path.exists(out_name)
+    
+    
+class ThrottledDevice(object):
+    """
+    Write limiter for ``extract_map``, that simulates a slow device (SD card).
+    Each write takes as long as it would take with a transfer rate of 
+    ``rate`` [Byte/s]. Writing fails after ``fail_after`` writes, with 
+    the exception ``error``.
+    """
+    def __init__(self, rate, chunk_size, fail_after=None, 
+                 error=IOError("No space left on device")):
+        self.write_time = chunk_size / rate
+        self.fail_after = fail_after
+        self.error = error
+        self.writes = 0
+        
+    def __enter__(self):
+        self.writes += 1
+        if self.fail_after is not None and self.writes > self.fail_after:
+            raise self.error
+            
+    def __exit__(self, *_):
+        time.sleep(self.write_time)
+        
+        
+def test_BaseManager_extract_map_pipelined():
+    """
+    Test extracting a map with separate threads for inflating and writing.
+    Benchmark on a throttled device.
+    """
+    from mob_map_dl.local import OsmandManager
+    import zipfile
+    import random
+    import errno
+    
+    print "Start"
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l12")
+    mgr = OsmandManager(test_app_dir)
+    mgr.extract_chunk_size = 1024**2
+    #Compressible map of 16 MiB
+    rand = random.Random(1)
+    words = ["".join(rand.choice("abcdefghij") for _ in range(12)) 
+             for _ in range(2000)]
+    map_data = " ".join(rand.choice(words) for _ in range(1400000))
+    map_data = map_data[:16 * 1024**2]
+    arch_path = path.join(test_app_dir, "osmand/Big_europe_2.obf.zip")
+    zip_out = zipfile.ZipFile(arch_path, "w", zipfile.ZIP_DEFLATED)
+    zip_out.writestr("Big_europe_2.obf", map_data)
+    zip_out.close()
+    out_name = path.join(test_dev_dir, "osmand/Big_europe_2.obf")
+    
+    #Measure inflating alone, and throttle the device to the same speed
+    t0 = time.time()
+    mgr.extract_map(arch_path, out_name, "osmand/Big_europe_2.obf")
+    t_inflate = time.time() - t0
+    device_rate = len(map_data) / t_inflate
+    
+    #One buffer: reading and writing alternate
+    mgr.extract_buffers = 1
+    t0 = time.time()
+    mgr.extract_map(arch_path, out_name, "osmand/Big_europe_2.obf", 
+                    write_limiter=ThrottledDevice(device_rate, 1024**2))
+    t_serial = time.time() - t0
+    assert open(out_name, "rb").read() == map_data
+    
+    #Several buffers: reading and writing at the same time
+    mgr.extract_buffers = 4
+    t0 = time.time()
+    mgr.extract_map(arch_path, out_name, "osmand/Big_europe_2.obf", 
+                    write_limiter=ThrottledDevice(device_rate, 1024**2))
+    t_pipelined = time.time() - t0
+    assert open(out_name, "rb").read() == map_data
+    print "Inflating:", t_inflate, "s, alternating:", t_serial, \
+          "s, pipelined:", t_pipelined, "s"
+    assert t_pipelined < t_serial * 0.85
+    
+    #Errors while writing stop the extraction
+    os.remove(out_name)
+    device = ThrottledDevice(device_rate, 1024**2, fail_after=2)
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Big_europe_2.obf", 
+                        write_limiter=device)
+    except IOError:
+        pass
+    else:
+        assert False, "IOError expected"
+    assert device.writes < 2 + mgr.extract_buffers + 2
+    assert not path.exists(out_name)
+    assert not path.exists(out_name + ".part")
+    
+    #Errors of the operating system remove the partial map too
+    device = ThrottledDevice(device_rate, 1024**2, fail_after=2, 
+                    error=OSError(errno.ENOSPC, "No space left on device"))
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Big_europe_2.obf", 
+                        write_limiter=device)
+    except OSError:
+        pass
+    else:
+        assert False, "OSError expected"
+    assert not path.exists(out_name)
+    assert not path.exists(out_name + ".part")
+    
+    
+def test_BaseManager_extract_map_differential():
+    """
+    Test updating an installed map, that is not written if it is unchanged.
+    Test that interrupted installations leave the old map intact.
+    """
+    from mob_map_dl import local
+    from mob_map_dl.local import OsmandManager
+    import zipfile
+    import json
+    import random
+    import hashlib
+    
+    class WriteCounter(object):
+        "Write limiter that counts the writes, and can crash."
+        def __init__(self, crash_after=None):
+            self.writes = 0
+            self.crash_after = crash_after
+        def __enter__(self):
+            self.writes += 1
+            if self.writes == self.crash_after:
+                raise KeyboardInterrupt()
+        def __exit__(self, *_):
+            pass
+    
+    print "Start"
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l13")
+    mgr = OsmandManager(test_app_dir)
+    mgr.extract_chunk_size = 1024 * 64
+    block = mgr.extract_chunk_size
+    rand = random.Random(2)
+    map_v1 = "".join(chr(rand.randint(0, 255)) for _ in range(block * 20))
+    map_v2 = map_v1[:block * 3] + "x" + map_v1[block * 3 + 1:]
+    arch_path = path.join(test_app_dir, "osmand/Diff_europe_2.obf.zip")
+    map_path = path.join(test_dev_dir, "osmand/Diff_europe_2.obf")
+    def download(map_data):
+        "Create archive with ``map_data``, and its manifest."
+        zip_out = zipfile.ZipFile(arch_path, "w", zipfile.ZIP_DEFLATED)
+        zip_out.writestr("Diff_europe_2.obf", map_data)
+        zip_out.close()
+        mgr.record_archive_hash(arch_path, hashlib.sha256(
+                                    open(arch_path, "rb").read()).hexdigest())
+    def install(differential=True, crash_after=None):
+        "Install the map from the archive, count the writes."
+        counter = WriteCounter(crash_after)
+        mgr.extract_map(arch_path, map_path, "osmand/Diff_europe_2.obf", 
+                        write_limiter=counter, differential=differential)
+        return counter.writes
+    
+    #Without installed map, differential installation writes everything.
+    download(map_v1)
+    assert install() == 20
+    assert open(map_path, "rb").read() == map_v1
+    hash_path = mgr.get_map_hash_path(map_path)
+    assert mgr.read_map_hash(map_path) == hashlib.sha256(map_v1).hexdigest()
+    
+    #Unchanged map: nothing is written, and the installed map is not read.
+    inode_v1 = os.stat(map_path).st_ino
+    opened = []
+    def recording_open(name, *args):
+        opened.append(name)
+        return open(name, *args)
+    local.open = recording_open
+    try:
+        assert install() == 0
+    finally:
+        del local.open
+    assert map_path not in opened
+    assert os.stat(map_path).st_ino == inode_v1
+    
+    #Changed map: the whole map is written, and replaces the old map by 
+    #renaming.
+    download(map_v2)
+    assert install() == 20
+    assert open(map_path, "rb").read() == map_v2
+    assert not path.exists(map_path + ".part")
+    assert os.stat(map_path).st_ino != inode_v1
+    assert install() == 0
+    
+    #Without the hash of the installed map, the map is written.
+    record = json.load(open(hash_path))
+    record["map_sha256"] = "0" * 64
+    json.dump(record, open(hash_path, "w"))
+    assert install() == 20
+    assert install() == 0
+    #Map that was changed on the device is written.
+    open(map_path, "ab").write("garbage")
+    assert install() == 20
+    assert open(map_path, "rb").read() == map_v2
+    
+    #Interrupted while the new map is written: the old map is intact.
+    download(map_v1)
+    for crash_after in [1, 4, 15]:
+        try:
+            install(crash_after=crash_after)
+        except KeyboardInterrupt:
+            pass
+        else:
+            assert False, "KeyboardInterrupt expected"
+        assert open(map_path, "rb").read() == map_v2
+        assert not path.exists(map_path + ".part")
+    
+    #A "*.part" file, left over by a crash, is overwritten.
+    open(map_path + ".part", "wb").write("garbage")
+    install()
+    assert open(map_path, "rb").read() == map_v1
+    assert not path.exists(map_path + ".part")
+    
+    #Map is different from the manifest: nothing is changed.
+    download(map_v2)
+    mgr.write_manifest(arch_path, {"archive_sha256": "", 
+                                   "map_name": "Diff_europe_2.obf", 
+                                   "map_size": len(map_v2), 
+                                   "map_sha256": "bad"})
+    try:
+        mgr.extract_map(arch_path, map_path, "osmand/Diff_europe_2.obf", 
+                        differential=True)
+    except IOError:
+        pass
+    else:
+        assert False, "IOError expected"
+    assert open(map_path, "rb").read() == map_v1
+    assert not path.exists(map_path + ".part")
+    
+    
 def test_OpenandromapManager_name_conversion():
     """OpenandromapsManager: Test the name conversion functions."""
     from mob_map_dl.local import OpenandromapsManager
@@ -200,12 +581,194 @@ def test_OpenandromapManager_get_map_extractor():
     assert size_total == len(map_content)
 
 
+def test_ZipStreamExtractor():
+    """
+    ZipStreamExtractor: Extract maps from archives, that are passed in 
+    small chunks, like during a download.
+    """
+    from mob_map_dl.local import OsmandManager, OpenandromapsManager
+    
+    print "Start."
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l6")
+    out_name = path.join(test_dev_dir, "extracted.map")
+    #Osmand archives contain data descriptors, the Openandromaps archive 
+    #contains additional files after the map.
+    for mgr, arch_name in [(OsmandManager(test_app_dir), 
+                            "osmand/Jamaica_centralamerica_2.obf.zip"), 
+                           (OpenandromapsManager(test_app_dir), 
+                            "oam/SouthAmerica_bermuda.zip")]:
+        arch_path = path.join(test_app_dir, arch_name)
+        arch_data = open(arch_path, "rb").read()
+        fzip, _, _ = mgr.get_map_extractor(arch_path)
+        map_data = fzip.read()
+        
+        for chunk_size in [1000, 100 * 1024, len(arch_data)]:
+            extractor = mgr.make_stream_extractor(out_name)
+            for i in range(0, len(arch_data), chunk_size):
+                extractor.write(arch_data[i:i + chunk_size])
+            assert extractor.close()
+            assert open(out_name, "rb").read() == map_data
+            os.remove(out_name)
+        
+        #Corrupted data is detected, and the partial map is removed.
+        bad_data = arch_data[:5000] + "x" * 10 + arch_data[5010:]
+        extractor = mgr.make_stream_extractor(out_name)
+        extractor.write(bad_data)
+        assert not extractor.close()
+        print extractor.error
+        assert not path.exists(out_name)
+        assert not path.exists(out_name + ".part")
+    
+    #Incomplete archive
+    mgr = OsmandManager(test_app_dir)
+    arch_path = path.join(test_app_dir, "osmand/Monaco_europe_2.obf.zip")
+    extractor = mgr.make_stream_extractor(out_name)
+    extractor.write(open(arch_path, "rb").read()[:5000])
+    assert not extractor.close()
+    assert not path.exists(out_name + ".part")
+    
+    
+def test_BaseManager_manifest():
+    """
+    OsmandManager: Hashes of archives and maps are stored in manifests,
+    and are checked when a map is extracted again.
+    """
+    from mob_map_dl.local import OsmandManager
+    import json
+    import hashlib
+    
+    print "Start."
+    test_app_dir, test_dev_dir = create_writable_test_dirs("l7")
+    arch_path = path.join(test_app_dir, "osmand/Monaco_europe_2.obf.zip")
+    out_name = path.join(test_dev_dir, "osmand/Monaco_europe_2.obf")
+    mgr = OsmandManager(test_app_dir)
+    man_path = mgr.get_manifest_path(arch_path)
+    
+    #Archives without manifest are extracted without checks
+    mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    assert mgr.read_manifest(arch_path) is None
+    
+    #The first extraction records the map's hash
+    arch_sha256 = hashlib.sha256(open(arch_path, "rb").read()).hexdigest()
+    mgr.record_archive_hash(arch_path, arch_sha256)
+    mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    manifest = mgr.read_manifest(arch_path)
+    map_data = open(out_name, "rb").read()
+    assert manifest["archive_sha256"] == arch_sha256
+    assert manifest["map_name"] == "Monaco_europe_2.obf"
+    assert manifest["map_size"] == len(map_data)
+    assert manifest["map_sha256"] == hashlib.sha256(map_data).hexdigest()
+    
+    #Later extractions are checked
+    mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    manifest["map_sha256"] = "0" * 64
+    mgr.write_manifest(arch_path, manifest)
+    os.remove(out_name)
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    except IOError, err:
+        print err
+    else:
+        assert False, "IOError expected"
+    assert not path.exists(out_name)
+    assert not path.exists(out_name + ".part")
+    
+    #A damaged archive is detected before the map is written, if archives 
+    #are verified. The manifest is written again, as if size and time had 
+    #not changed.
+    arch_data = bytearray(open(arch_path, "rb").read())
+    arch_data[len(arch_data) // 2] ^= 0xff
+    open(arch_path, "wb").write(arch_data)
+    mgr.write_manifest(arch_path, {"archive_sha256": arch_sha256})
+    checked = []
+    check_archive_hash = mgr.check_archive_hash
+    def recording_check(arch_path):
+        checked.append(arch_path)
+        check_archive_hash(arch_path)
+    mgr.check_archive_hash = recording_check
+    mgr.verify_archives = True
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    except IOError, err:
+        print err
+    else:
+        assert False, "IOError expected"
+    assert checked == [arch_path]
+    assert not path.exists(out_name)
+    assert not path.exists(out_name + ".part")
+    #Without verification the archive is not read an additional time.
+    mgr.verify_archives = False
+    try:
+        mgr.extract_map(arch_path, out_name, "osmand/Monaco_europe_2")
+    except Exception, err:                              #IGNORE:W0703
+        print err
+    assert checked == [arch_path]
+    
+    #Manifest of a changed archive is ignored
+    man_data = json.load(open(man_path))
+    os.utime(arch_path, (0, man_data["archive_mtime"] + 10))
+    assert mgr.read_manifest(arch_path) is None
+    
+    
+def test_BaseManager_archive_index():
+    """
+    Test the index of the archives: only new and changed archives are 
+    scanned.
+    """
+    from mob_map_dl.local import OsmandManager
+    
+    print "Start"
+    test_app_dir, _ = create_writable_test_dirs("l9")
+    mgr = OsmandManager(test_app_dir)
+    scanned = []
+    read_map_info = mgr.read_map_info
+    def record_read_map_info(archive_path):
+        scanned.append(path.basename(archive_path))
+        return read_map_info(archive_path)
+    mgr.read_map_info = record_read_map_info
+    
+    #First listing scans all archives, and creates the index
+    l1 = mgr.get_file_list()
+    assert len(l1) == 2
+    assert scanned == ["Jamaica_centralamerica_2.obf.zip", 
+                       "Monaco_europe_2.obf.zip"]
+    assert l1[0].size == 4518034
+    assert l1[0].time == datetime.datetime(2014, 8, 3, 15, 10, 2)
+    index = mgr.read_index()
+    assert index["Monaco_europe_2.obf.zip"]["entry_name"] == \
+           "Monaco_europe_2.obf"
+    
+    #Second listing uses the index, also in a new manager object
+    del scanned[:]
+    assert mgr.get_file_list() == l1
+    assert scanned == []
+    mgr2 = OsmandManager(test_app_dir)
+    mgr2.read_map_info = None
+    assert mgr2.get_file_list() == l1
+    
+    #Changed archives are scanned again, removed archives leave the index
+    arch_path = path.join(mgr.download_dir, "Monaco_europe_2.obf.zip")
+    os.utime(arch_path, (0, path.getmtime(arch_path) + 10))
+    os.remove(path.join(mgr.download_dir, "Jamaica_centralamerica_2.obf.zip"))
+    l3 = mgr.get_file_list()
+    assert l3 == l1[1:]
+    assert scanned == ["Monaco_europe_2.obf.zip"]
+    assert mgr.read_index().keys() == ["Monaco_europe_2.obf.zip"]
+    
+    
 if __name__ == "__main__":
     test_OsmandManager_name_conversion()
 #    test_OsmandManager_get_file_list()
 #    test_OsmandManager_get_map_extractor()
 #    test_OsmandManager_extract_map()
+#    test_BaseManager_extract_map_parallel()
+#    test_BaseManager_extract_map_stored()
+#    test_BaseManager_extract_map_pipelined()
+#    test_BaseManager_extract_map_differential()
 #    test_OpenandromapManager_name_conversion()
 #    test_OpenandromapManager_get_map_extractor()
+#    test_ZipStreamExtractor()
+#    test_BaseManager_manifest()
+#    test_BaseManager_archive_index()
     
     pass #IGNORE:W0107
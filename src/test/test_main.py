@@ -28,7 +28,7 @@ from __future__ import division
 from __future__ import absolute_import              
 
 #For test modules: ----------------------------------------------------------
-#import pytest #contains `skip`, `fail`, `raises`, `config`
+import pytest #contains `skip`, `fail`, `raises`, `config`
 
 import time
 import os
@@ -88,6 +88,60 @@ def test_AppHighLevel_find_mobile_devices():
     print d
     
 
+def test_AppHighLevel_find_mobile_devices_mountinfo():
+    """
+    AppHighLevel: find devices in "/proc/self/mountinfo", cache the result.
+    """
+    from mob_map_dl.main import AppHighLevel
+    import os
+    import shutil
+    
+    print "Start"
+    app_directory, _ = create_writable_test_dirs("m14")
+    mount_dir = relative_path("../../test_tmp/TEST-DEVICE-MOUNTS")
+    shutil.rmtree(mount_dir, ignore_errors=True)
+    os.makedirs(path.join(mount_dir, "phone card/Android"))
+    os.makedirs(path.join(mount_dir, "usb stick"))
+    mountinfo_path = path.join(mount_dir, "mountinfo")
+    def write_mountinfo(phone_id):
+        "Mount the phone with ID ``phone_id``."
+        esc = lambda name: name.replace(" ", "\\040")
+        lines = [
+          "23 28 0:22 / /proc rw,relatime - proc proc rw",
+          "{i} 28 8:17 / {d} rw,nosuid shared:42 - vfat /dev/sdb1 rw".format(
+                        i=phone_id, d=esc(path.join(mount_dir, "phone card"))),
+          "31 28 8:33 / {d} rw master:1 - vfat /dev/sdc1 rw".format(
+                        d=esc(path.join(mount_dir, "usb stick"))),
+          "32 28 8:17 / {d} rw - vfat /dev/sdb1 rw".format(
+                        d=esc(path.join(mount_dir, "phone card")))]
+        open(mountinfo_path, "w").write("\n".join(lines) + "\n")
+    
+    app = AppHighLevel()
+    app.app_directory = app_directory
+    app.mountinfo_path = mountinfo_path
+    write_mountinfo(30)
+    mounts = app.read_mountinfo()
+    print mounts
+    assert mounts[0] == (30, "/dev/sdb1", path.join(mount_dir, "phone card"))
+    assert len(mounts) == 3
+    devices = app.find_mobile_devices()
+    print devices
+    assert devices == [path.join(mount_dir, "phone card")]
+    assert path.exists(path.join(app_directory, app.device_cache_name))
+    
+    #Same mounts: the cached result is used, directories are not checked
+    os.rmdir(path.join(mount_dir, "phone card/Android"))
+    assert app.find_mobile_devices() == [path.join(mount_dir, "phone card")]
+    #Phone was mounted again: new mount ID
+    write_mountinfo(33)
+    assert app.find_mobile_devices() == []
+    
+    #No search for devices when they are not needed.
+    app.find_mobile_devices = None
+    app.create_low_level_components(app_directory, find_devices=False)
+    assert app.installers == {}
+    
+
 def test_AppHighLevel_get_filtered_map_list():
     "AppHighLevel: test get_filtered_map_list()"
     from mob_map_dl.main import AppHighLevel
@@ -124,6 +178,35 @@ def test_AppHighLevel_get_filtered_map_list():
     assert maps[0].full_name.find("test_tmp/TEST-DEVICE") > 0
     
 
+def test_AppHighLevel_get_filtered_map_list_patterns():
+    """
+    AppHighLevel: get_filtered_map_list() with several patterns, and 
+    exclusion patterns.
+    """
+    from mob_map_dl.main import AppHighLevel
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m15")
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory=app_directory, 
+                                    mobile_device=mobile_device)
+    
+    #Maps that match several patterns are returned once, sorted by name.
+    maps = app.get_filtered_map_list(app.local_managers, 
+                                     ["*Monaco*", "osmand/*", "OAM/*"])
+    pprint(maps)
+    assert [m.disp_name for m in maps] == ["oam/SouthAmerica_bermuda", 
+                                           "osmand/Jamaica_centralamerica_2.obf",
+                                           "osmand/Monaco_europe_2.obf"]
+    maps = app.get_filtered_map_list(app.local_managers, 
+                                     ["osmand/*", "!*monaco*"])
+    assert [m.disp_name for m in maps] == [
+                                        "osmand/Jamaica_centralamerica_2.obf"]
+    maps = app.get_filtered_map_list(app.local_managers, ["!osmand/*"])
+    assert [m.disp_name for m in maps] == ["oam/SouthAmerica_bermuda"]
+    assert app.get_filtered_map_list(app.local_managers, []) == []
+    
+    
 def test_AppHighLevel_plan_work():
     "AppHighLevel: test plan_work"
     from datetime import datetime
@@ -154,6 +237,114 @@ def test_AppHighLevel_plan_work():
     work = app.plan_work(src, dst, "replace_all")
     pprint(work)
     assert len(work) == 3
+    
+    
+def test_AppHighLevel_plan_sync():
+    "AppHighLevel: test plan_sync"
+    from datetime import datetime
+    from mob_map_dl.common import MapMeta
+    from mob_map_dl.main import AppHighLevel
+    
+    print "Start"
+    #Create source and destination lists
+    src = [MapMeta("map1", "f/map1", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map2", "f/map2", 1, datetime(2000, 1, 1, 12), "foo", 
+                   "bar"),
+           MapMeta("map3", "f/map3", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map4", "f/map4", 2, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map5", "f/map5", 1, datetime(2000, 1, 1, 0, 0, 1), 
+                   "foo", "bar"),
+           MapMeta("map6", "f/map6", 1, None, "foo", "bar")]
+    dst = [MapMeta("map1", "f/map1", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map2", "f/map2", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map4", "f/map4", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map5", "f/map5", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map6", "f/map6", 1, datetime(2000, 1, 1), "foo", "bar"),
+           MapMeta("map7", "f/map7", 1, datetime(2000, 1, 1), "foo", "bar")]
+    names = lambda maps: [m.disp_name for m in maps]
+    
+    app = AppHighLevel()
+    
+    plan = app.plan_sync(src, dst, "only_missing")
+    print plan
+    assert names(plan.adds) == ["map3"]
+    assert names(plan.updates) == []
+    assert names(plan.unchanged) == ["map1", "map2", "map4", "map5", "map6"]
+    assert names(plan.deletes) == ["map7"]
+    assert names(plan.work) == ["map3"]
+    
+    #Times are compared, not only dates. Differences within the tolerance
+    #of the file system's time stamps, and unknown times are ignored.
+    plan = app.plan_sync(src, dst, "replace_newer")
+    assert names(plan.adds) == ["map3"]
+    assert names(plan.updates) == ["map2"]
+    assert names(plan.unchanged) == ["map1", "map4", "map5", "map6"]
+    assert names(plan.work) == ["map2", "map3"]
+    
+    #Sizes are compared on request
+    plan = app.plan_sync(src, dst, "replace_newer", compare_size=True)
+    assert names(plan.updates) == ["map2", "map4"]
+    assert names(plan.work) == ["map2", "map3", "map4"]
+    assert app.plan_work(src, dst, "replace_newer", compare_size=True) == \
+           plan.work
+    
+    plan = app.plan_sync(src, dst, "replace_all")
+    assert names(plan.work) == names(src)
+    assert names(plan.deletes) == ["map7"]
+    
+    try:
+        app.plan_sync(src, dst, "foo")
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+    
+    
+def test_AppHighLevel_plan_sync_benchmark():
+    "AppHighLevel: plan_sync must be fast for lists of 100000 maps."
+    from datetime import datetime
+    from mob_map_dl.common import MapMeta
+    from mob_map_dl.main import AppHighLevel
+    
+    print "Start"
+    num_maps = 100000
+    old_time, new_time = datetime(2014, 1, 1), datetime(2014, 2, 1)
+    src, dst = [], []
+    for i in range(num_maps):
+        name = "osmand/Map{:06d}_europe_2.obf".format(i)
+        src.append(MapMeta(name, name, 1000 + i % 7, 
+                           new_time if i % 4 == 0 else old_time, "", ""))
+        #Every 10th map is missing at the destination, and the destination
+        #contains 1000 maps that are not in the source.
+        if i % 10 != 0:
+            dst.append(MapMeta(name, name, 1000 + i % 7, old_time, "", ""))
+    for i in range(1000):
+        name = "osmand/Gone{:06d}_europe_2.obf".format(i)
+        dst.append(MapMeta(name, name, 1000, old_time, "", ""))
+    
+    app = AppHighLevel()
+    for mode in ["only_missing", "replace_newer", "replace_all"]:
+        t0 = time.time()
+        plan = app.plan_sync(src, dst, mode, compare_size=True)
+        t1 = time.time()
+        print "plan_sync, {} maps, {}: {:.3f} s, {}".format(num_maps, mode, 
+                                                          t1 - t0, plan)
+        assert len(plan.adds) == num_maps // 10
+        assert len(plan.deletes) == 1000
+        assert len(plan.adds) + len(plan.updates) + len(plan.unchanged) == \
+               num_maps
+        assert t1 - t0 < 2
+    assert len(app.plan_sync(src, dst, "replace_newer").updates) == \
+           len([i for i in range(num_maps) if i % 4 == 0 and i % 10 != 0])
+    
+    #Plans with equal lists are fast too
+    t0 = time.time()
+    plan = app.plan_sync(src, src, "replace_newer", compare_size=True)
+    t1 = time.time()
+    print "plan_sync, equal lists: {:.3f} s".format(t1 - t0)
+    assert len(plan.unchanged) == num_maps
+    assert plan.work == [] and plan.deletes == []
+    assert t1 - t0 < 2
 
 
 def test_AppHighLevel_filter_possible_work():
@@ -198,6 +389,50 @@ def test_AppHighLevel_download_file():
                                  "osmand/Cape-verde_africa_2.obf.zip"))
     
     
+def test_AppHighLevel_download_files():
+    "AppHighLevel: test download_files(), concurrent downloads."
+    from mob_map_dl.main import AppHighLevel
+    from mob_map_dl.common import MapMeta
+    
+    class FakeDownloader(object):
+        "Downloader that copies files, and fails for one file."
+        def download_file(self, srv_url, loc_name, disp_name, make_progress, 
+                          tee=None):
+            if "Bad" in srv_url:
+                raise IOError("Can't download: " + srv_url)
+            progress = make_progress(disp_name, 100)
+            time.sleep(0.2)
+            shutil.copy(srv_url, loc_name)
+            progress.update_final(100, "Downloaded")
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m10")
+    src_file = path.join(app_directory, "osmand/Monaco_europe_2.obf.zip")
+    down_maps = [MapMeta(disp_name="osmand/Map{}_europe_2.obf".format(i), 
+                         full_name=src_file, size=100, time=None, 
+                         description=None, map_type=None) 
+                 for i in range(4)]
+    down_maps.append(MapMeta(disp_name="osmand/Bad_europe_2.obf", 
+                             full_name="Bad", size=100, time=None, 
+                             description=None, map_type=None))
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders["osmand"] = FakeDownloader()
+    
+    t0 = time.time()
+    errors = app.download_files(down_maps, jobs=4)
+    t1 = time.time()
+    print "Concurrent download:", t1 - t0, "s"
+    
+    assert t1 - t0 < 0.6
+    assert len(errors) == 1
+    assert errors[0][0].disp_name == "osmand/Bad_europe_2.obf"
+    for i in range(4):
+        assert path.isfile(path.join(app_directory, 
+                                     "osmand/Map{}_europe_2.obf.zip".format(i)))
+    
+    
 def test_AppHighLevel_install_file():
     "AppHighLevel: test install_file()"
     from mob_map_dl.main import AppHighLevel
@@ -220,6 +455,32 @@ def test_AppHighLevel_install_file():
     assert path.isfile(path.join(mobile_device, "osmand/Monaco_europe_2.obf"))  
     
     
+def test_AppHighLevel_install_files():
+    "AppHighLevel: test install_files(), extract maps concurrently."
+    from mob_map_dl.main import AppHighLevel
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m13")
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    inst_maps = app.get_filtered_map_list(app.local_managers, ["*"])
+    assert len(inst_maps) == 3
+    for map_ in inst_maps:
+        inst_path = app.get_component(map_, app.installers).make_full_name(
+                                                            map_.disp_name)
+        if path.exists(inst_path):
+            os.remove(inst_path)
+    missing = inst_maps[0]._replace(full_name=app_directory + "/missing.zip")
+    
+    errors = app.install_files(inst_maps + [missing], jobs=3, write_jobs=1)
+    
+    #The missing archive does not stop the other installations
+    assert [map_ for map_, _ in errors] == [missing]
+    dev_maps = app.get_filtered_map_list(app.installers, ["*"])
+    assert [(m.disp_name, m.size) for m in dev_maps] == \
+           [(m.disp_name, m.size) for m in inst_maps]
+    
+    
 def test_AppHighLevel_delete_file_mobile():
     "AppHighLevel: test install_file()"
     from mob_map_dl.main import AppHighLevel
@@ -234,13 +495,22 @@ def test_AppHighLevel_delete_file_mobile():
     #Test that directory that we are going to delete really exists
     assert path.exists(delete_path)
     
+    #Hash of the map, and the rest of an interrupted installation
+    aux_paths = [delete_path + ".sha256.json", delete_path + ".part"]
+    for aux_path in aux_paths:
+        open(aux_path, "wb").write("foo")
+    
     app = AppHighLevel()
     app.create_low_level_components(app_directory, mobile_device)
+    assert app.installers["osmand"].get_auxiliary_paths(delete_path) == \
+           aux_paths
     
     app.delete_file_mobile(file_meta)
     
     #test that file has really been deleted
     assert not path.exists(delete_path)
+    for aux_path in aux_paths:
+        assert not path.exists(aux_path)
     
     
 def test_AppHighLevel_delete_file_local():
@@ -284,6 +554,395 @@ def test_AppHighLevel_download_install():
                                  "Faroe-islands_europe_2.obf"))
     
     
+def test_AppHighLevel_download_install_pipeline():
+    """
+    AppHighLevel: test download_install(), install maps while they are 
+    downloaded. Uses a local HTTP server.
+    """
+    from mob_map_dl.main import AppHighLevel
+    from .local_server import LocalHTTPServer
+    import hashlib
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m11")
+    names = ["Monaco_europe_2.obf", "Jamaica_centralamerica_2.obf"]
+    server = LocalHTTPServer()
+    rows = ""
+    for name in names:
+        arch_path = path.join(app_directory, "osmand", name + ".zip")
+        server.add_file("/download.php?file=" + name + ".zip", 
+                        open(arch_path, "rb").read())
+        os.remove(arch_path)
+        rows += ('<tr><td><a href="/download.php?file={n}.zip">{n}.zip</a>'
+                 '</td><td>03.08.2014</td><td>1.0</td><td>Map</td></tr>'
+                 .format(n=name))
+    server.add_file("/list.php", 
+                    "<html><body><table><tr><th>File</th></tr><tr></tr>" + 
+                    rows + "</table></body></html>", content_type="text/html")
+    os.remove(path.join(mobile_device, "osmand", names[0]))
+    server.start()
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {"osmand": app.downloaders["osmand"]}
+    app.downloaders["osmand"].list_url = server.url("/list.php")
+    #Record installations from the downloaded archives
+    extracted = []
+    loca_comp = app.local_managers["osmand"]
+    loca_comp.extract_map = lambda *args: extracted.append(args)
+    try:
+        app.download_install(["osmand/*"], mode="only_missing", 
+                             pipeline=True)
+    finally:
+        server.stop()
+    
+    #The archives are stored, and the maps are installed in the same pass
+    assert extracted == []
+    for name in names:
+        arch_path = path.join(app_directory, "osmand", name + ".zip")
+        map_path = path.join(mobile_device, "osmand", name)
+        assert open(arch_path, "rb").read() == \
+               server.files["/download.php?file=" + name + ".zip"].data
+        fzip, _, _ = loca_comp.get_map_extractor(arch_path)
+        map_data = fzip.read()
+        assert open(map_path, "rb").read() == map_data
+        assert not path.exists(map_path + ".part")
+        #Hashes are stored in the manifest
+        manifest = loca_comp.read_manifest(arch_path)
+        assert manifest["archive_sha256"] == \
+               hashlib.sha256(open(arch_path, "rb").read()).hexdigest()
+        assert manifest["map_sha256"] == hashlib.sha256(map_data).hexdigest()
+    
+    
+def test_AppHighLevel_download_install_replan():
+    """
+    AppHighLevel: test download_install(), with a list of maps that is 
+    refreshed in the background. The maps, that are only in the refreshed 
+    list, are downloaded too. Uses a local HTTP server.
+    """
+    from mob_map_dl.main import AppHighLevel
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m12")
+    names = ["Monaco_europe_2.obf", "Jamaica_centralamerica_2.obf"]
+    server = LocalHTTPServer()
+    rows = []
+    for name in names:
+        arch_path = path.join(app_directory, "osmand", name + ".zip")
+        server.add_file("/download.php?file=" + name + ".zip", 
+                        open(arch_path, "rb").read())
+        os.remove(arch_path)
+        rows.append('<tr><td><a href="/download.php?file={n}.zip">{n}.zip</a>'
+                    '</td><td>03.08.2014</td><td>1.0</td><td>Map</td></tr>'
+                    .format(n=name))
+    make_list = lambda rows: ("<html><body><table><tr><th>File</th></tr>"
+                              "<tr></tr>" + "".join(rows) + 
+                              "</table></body></html>")
+    server.add_file("/list.php", make_list(rows[:1]), content_type="text/html")
+    server.start()
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {"osmand": app.downloaders["osmand"]}
+    downloader = app.downloaders["osmand"]
+    downloader.list_url = server.url("/list.php")
+    try:
+        #Store an outdated list, that contains only the first map.
+        assert len(downloader.get_file_list()) == 1
+        downloader.catalog.touch_page(downloader.source, downloader.list_url,
+                                      fetched=0)
+        server.add_file("/list.php", make_list(rows), 
+                        content_type="text/html")
+        downloader.background_refresh = True
+        app.download_install(["osmand/*"], mode="only_missing")
+    finally:
+        server.stop()
+    
+    #Each map is downloaded once, and installed
+    for name in names:
+        arch_path = path.join(app_directory, "osmand", name + ".zip")
+        assert path.isfile(arch_path)
+        assert path.isfile(path.join(mobile_device, "osmand", name))
+        url_path = "/download.php?file=" + name + ".zip"
+        assert len([r for r in server.requests if r[1] == url_path]) == 1
+    
+    
+def test_AppHighLevel_download_install_overlapped():
+    """
+    AppHighLevel: test download_install(overlap=True). Maps are installed 
+    while the next maps are downloaded. Uses a local HTTP server.
+    """
+    from mob_map_dl.main import AppHighLevel
+    from .local_server import LocalHTTPServer
+    import zipfile
+    import StringIO
+    import threading
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m17")
+    names = ["Test{}_europe_2.obf".format(i) for i in range(3)]
+    server = LocalHTTPServer()
+    server.chunk_size = 1024 * 16
+    server.delay_per_chunk = 0.02
+    rows = ""
+    map_datas = {}
+    for name in names:
+        map_datas[name] = os.urandom(1024 * 200)
+        farch = StringIO.StringIO()
+        zip_container = zipfile.ZipFile(farch, "w", zipfile.ZIP_STORED)
+        zip_container.writestr(name, map_datas[name])
+        zip_container.close()
+        server.add_file("/download.php?file=" + name + ".zip", 
+                        farch.getvalue())
+        rows += ('<tr><td><a href="/download.php?file={n}.zip">{n}.zip</a>'
+                 '</td><td>03.08.2014</td><td>1.0</td><td>Map</td></tr>'
+                 .format(n=name))
+    server.add_file("/list.php", 
+                    "<html><body><table><tr><th>File</th></tr><tr></tr>" + 
+                    rows + "</table></body></html>", content_type="text/html")
+    server.start()
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {"osmand": app.downloaders["osmand"]}
+    app.downloaders["osmand"].list_url = server.url("/list.php")
+    #Record start and end of each download and installation
+    events = []
+    events_lock = threading.Lock()
+    def recording(kind, func):
+        def record(file_meta, *args, **kwargs):
+            with events_lock:
+                events.append((kind, "start", file_meta.disp_name))
+            func(file_meta, *args, **kwargs)
+            with events_lock:
+                events.append((kind, "end", file_meta.disp_name))
+        return record
+    app.download_file = recording("down", app.download_file)
+    app.install_file = recording("inst", app.install_file)
+    try:
+        app.download_install(["osmand/*"], mode="only_missing", overlap=True)
+    finally:
+        server.stop()
+    
+    pprint(events)
+    #The local archive, that is missing on the device, is installed while 
+    #the first map is downloaded. Each downloaded map is installed before 
+    #the last download ends.
+    last_down_end = events.index(("down", "end", "osmand/" + names[-1]))
+    for name in ["Jamaica_centralamerica_2.obf"] + names[:-1]:
+        assert events.index(("inst", "end", "osmand/" + name)) < last_down_end
+    assert events.index(("inst", "start", "osmand/" + names[0])) > \
+           events.index(("down", "end", "osmand/" + names[0]))
+    #All maps are installed, each one once.
+    assert len([e for e in events if e[:2] == ("inst", "start")]) == 4
+    for name in names:
+        map_path = path.join(mobile_device, "osmand", name)
+        assert open(map_path, "rb").read() == map_datas[name]
+    assert path.isfile(path.join(mobile_device, "osmand", 
+                                 "Jamaica_centralamerica_2.obf"))
+    
+    
+def test_AppHighLevel_download_install_overlapped_refresh():
+    """
+    AppHighLevel: test download_install(overlap=True), when the lists of 
+    maps change during the downloads. A map that is downloaded again is 
+    installed again, after the installation of the old archive has ended.
+    Uses a local HTTP server.
+    """
+    from mob_map_dl.main import AppHighLevel
+    from .local_server import LocalHTTPServer
+    import zipfile
+    import StringIO
+    import threading
+    from datetime import datetime
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m18")
+    name = "Test0_europe_2.obf"
+    server = LocalHTTPServer()
+    server.chunk_size = 1024 * 16
+    server.delay_per_chunk = 0.01
+    def serve_map(map_data, date):
+        "Put a version of the map, and the list of maps, onto the server."
+        farch = StringIO.StringIO()
+        zip_container = zipfile.ZipFile(farch, "w", zipfile.ZIP_STORED)
+        zip_info = zipfile.ZipInfo(name, date.timetuple()[:6])
+        zip_container.writestr(zip_info, map_data)
+        zip_container.close()
+        server.add_file("/download.php?file=" + name + ".zip", 
+                        farch.getvalue())
+        server.add_file("/list.php", 
+            '<html><body><table><tr><th>File</th></tr><tr></tr>'
+            '<tr><td><a href="/download.php?file={n}.zip">{n}.zip</a>'
+            '</td><td>{d}</td><td>1.0</td><td>Map</td></tr>'
+            '</table></body></html>'.format(n=name, 
+                                            d=date.strftime("%d.%m.%Y")), 
+            content_type="text/html")
+    old_data = os.urandom(1024 * 300)
+    new_data = os.urandom(1024 * 200)
+    serve_map(old_data, datetime(2014, 8, 3))
+    server.start()
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {"osmand": app.downloaders["osmand"]}
+    app.downloaders["osmand"].list_url = server.url("/list.php")
+    app.downloaders["osmand"].cache_time = 0
+    #The list of maps changes once, while the old map is installed.
+    def refresh():
+        "Stand-in for ``wait_catalog_refresh``."
+        if server.files["/list.php"].data.find("2099") >= 0:
+            return False
+        serve_map(new_data, datetime(2099, 8, 3))
+        return True
+    app.wait_catalog_refresh = refresh
+    events = []
+    events_lock = threading.Lock()
+    def recording(kind, func):
+        def record(file_meta, *args, **kwargs):
+            with events_lock:
+                events.append((kind, "start", file_meta.disp_name))
+            func(file_meta, *args, **kwargs)
+            with events_lock:
+                events.append((kind, "end", file_meta.disp_name))
+        return record
+    app.download_file = recording("down", app.download_file)
+    app.install_file = recording("inst", app.install_file)
+    try:
+        errors = app.download_install(["osmand/Test*"], mode="replace_newer", 
+                                      overlap=True)
+    finally:
+        server.stop()
+    
+    pprint(events)
+    print errors
+    #Both versions are downloaded and installed. The old archive is not 
+    #overwritten, while it is installed.
+    disp_name = "osmand/" + name
+    assert events == [("down", "start", disp_name), 
+                      ("down", "end", disp_name),
+                      ("inst", "start", disp_name), 
+                      ("inst", "end", disp_name),
+                      ("down", "start", disp_name), 
+                      ("down", "end", disp_name),
+                      ("inst", "start", disp_name), 
+                      ("inst", "end", disp_name)]
+    map_path = path.join(mobile_device, "osmand", name)
+    assert open(map_path, "rb").read() == new_data
+    
+    
+def test_AppHighLevel_download_install_overlapped_interrupt():
+    """
+    AppHighLevel: test download_install(overlap=True), interrupted with 
+    Ctrl-C. The queued installations are cancelled, only the running 
+    installation is finished.
+    """
+    from mob_map_dl.main import AppHighLevel
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m19")
+    os.remove(path.join(mobile_device, "osmand", "Monaco_europe_2.obf"))
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {}
+    started = []
+    install_file = app.install_file
+    def slow_install(file_meta, *args, **kwargs):
+        started.append(file_meta.disp_name)
+        time.sleep(0.5)
+        install_file(file_meta, *args, **kwargs)
+    app.install_file = slow_install
+    def interrupt():
+        "Ctrl-C after the installations have been queued."
+        raise KeyboardInterrupt()
+    app.wait_catalog_refresh = interrupt
+    
+    t0 = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        app.download_install(["osmand/*", "oam/*"], mode="only_missing", 
+                             overlap=True)
+    t1 = time.time()
+    print started, t1 - t0, "s"
+    assert len(started) <= 1
+    assert t1 - t0 < 1
+    
+    
+def test_AppHighLevel_listing_snapshot():
+    """
+    AppHighLevel: each directory is listed only once per command. The 
+    snapshot of the listings is updated when files are written or deleted.
+    Uses a local HTTP server.
+    """
+    from mob_map_dl.main import AppHighLevel
+    from .local_server import LocalHTTPServer
+    
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m16")
+    names = ["Monaco_europe_2.obf", "Jamaica_centralamerica_2.obf"]
+    server = LocalHTTPServer()
+    rows = ""
+    for name in names:
+        arch_path = path.join(app_directory, "osmand", name + ".zip")
+        server.add_file("/download.php?file=" + name + ".zip", 
+                        open(arch_path, "rb").read())
+        rows += ('<tr><td><a href="/download.php?file={n}.zip">{n}.zip</a>'
+                 '</td><td>03.08.2014</td><td>1.0</td><td>Map</td></tr>'
+                 .format(n=name))
+    server.add_file("/list.php", 
+                    "<html><body><table><tr><th>File</th></tr><tr></tr>" + 
+                    rows + "</table></body></html>", content_type="text/html")
+    os.remove(path.join(app_directory, "osmand", names[0] + ".zip"))
+    os.remove(path.join(mobile_device, "osmand", names[0]))
+    server.start()
+    
+    app = AppHighLevel()
+    app.create_low_level_components(app_directory, mobile_device)
+    app.downloaders = {"osmand": app.downloaders["osmand"]}
+    app.downloaders["osmand"].list_url = server.url("/list.php")
+    num_listings = {}
+    for kind, lister in [("local", app.local_managers["osmand"]), 
+                         ("device", app.installers["osmand"])]:
+        def counting_list(lister=lister, kind=kind, 
+                          get_file_list=lister.get_file_list):
+            num_listings[kind] = num_listings.get(kind, 0) + 1
+            return get_file_list()
+        lister.get_file_list = counting_list
+    try:
+        app.download_install(["osmand/*"], mode="only_missing")
+    finally:
+        server.stop()
+    
+    #Downloaded archive is installed, although it was not in the listing.
+    print num_listings
+    assert num_listings == {"local": 1, "device": 1}
+    for name in names:
+        assert path.isfile(path.join(mobile_device, "osmand", name))
+    assert app.listings is None
+    
+    num_listings.clear()
+    app.uninstall(["osmand/Monaco*"], delete_local=True)
+    assert num_listings == {"local": 1, "device": 1}
+    assert not path.exists(path.join(mobile_device, "osmand", names[0]))
+    assert not path.exists(path.join(app_directory, "osmand", 
+                                     names[0] + ".zip"))
+    
+    #The snapshot is updated incrementally.
+    app.start_snapshot()
+    maps = app.get_filtered_map_list(app.installers, ["osmand/*"])
+    assert [m.disp_name for m in maps] == ["osmand/" + names[1]]
+    app.delete_file_mobile(maps[0])
+    assert app.get_filtered_map_list(app.installers, ["osmand/*"]) == []
+    app.install_file(app.get_filtered_map_list(app.local_managers, 
+                                               ["osmand/*"])[0])
+    maps = app.get_filtered_map_list(app.installers, ["osmand/*"])
+    assert [m.disp_name for m in maps] == ["osmand/" + names[1]]
+    assert maps[0].size == path.getsize(path.join(mobile_device, "osmand", 
+                                                  names[1]))
+    app.stop_snapshot()
+    assert num_listings == {"local": 2, "device": 2}
+    
+    
 def test_AppHighLevel_uninstall():
     "AppHighLevel: test get_filtered_map_list()"
     from mob_map_dl.main import AppHighLevel
@@ -325,6 +984,7 @@ def test_ConsoleAppMain_list_server_maps():
 def test_ConsoleAppMain_parse_aguments():
     "ConsoleAppMain: test parsing command line arguments"
     from mob_map_dl.main import ConsoleAppMain
+    import datetime
     
     print "Start testing: ConsoleAppMain.parse_aguments"
     m = ConsoleAppMain()
@@ -334,6 +994,9 @@ def test_ConsoleAppMain_parse_aguments():
     assert func == m.list_server_maps
     assert arg_dict["long_form"] == True
     assert arg_dict["patterns"] == []
+    assert m.needs_device == False
+    assert m.needs_servers == True
+    assert m.wait_refresh == False
     
     func, arg_dict = m.parse_aguments(["lss", "osmand/France*"])
     assert func == m.list_server_maps
@@ -352,18 +1015,87 @@ def test_ConsoleAppMain_parse_aguments():
     # install ---------------------------------------------
     func, arg_dict = m.parse_aguments(["install", "osmand/France*"])
     assert func == m.download_install
+    assert m.needs_device == True
+    assert m.needs_servers == True
     assert arg_dict["patterns"] == ["osmand/France*"]
     assert arg_dict["mode"] == "only_missing"
+    assert arg_dict["jobs"] == 1
+    assert arg_dict["segments"] == 1
+    assert arg_dict["pipeline"] == False
+    assert arg_dict["limit_rate"] is None
+    assert arg_dict["limit_schedule"] is None
+    assert m.app.background_refresh == False
+    assert arg_dict["install_jobs"] == 1
+    assert arg_dict["write_jobs"] == 1
+    assert arg_dict["differential"] == False
+    assert arg_dict["delta"] == False
+    assert arg_dict["overlap"] == False
+    assert arg_dict["verify"] == False
+    assert m.wait_refresh == True
     
     func, arg_dict = m.parse_aguments(["install", "osmand/France*", "-u"])
     assert arg_dict["mode"] == "replace_newer"
     
+    func, arg_dict = m.parse_aguments(["-b", "install", "osmand/France*"])
+    assert m.app.background_refresh == True
+    assert m.app.device_manifest == False
+    
+    func, arg_dict = m.parse_aguments(["--device-manifest", "lsm"])
+    assert m.app.device_manifest == True
+    
+    func, arg_dict = m.parse_aguments(["install", "--install-jobs", "4", 
+                                       "--write-jobs", "2", "osmand/France*"])
+    assert arg_dict["install_jobs"] == 4
+    assert arg_dict["write_jobs"] == 2
+    
+    func, arg_dict = m.parse_aguments(["install", "-d", "osmand/France*"])
+    assert arg_dict["differential"] == True
+    
+    func, arg_dict = m.parse_aguments(["install", "--delta", "osmand/France*"])
+    assert arg_dict["delta"] == True
+    
+    func, arg_dict = m.parse_aguments(["install", "-o", "osmand/France*"])
+    assert arg_dict["overlap"] == True
+    
+    func, arg_dict = m.parse_aguments(["install", "--verify", 
+                                       "osmand/France*"])
+    assert arg_dict["verify"] == True
+    
     func, arg_dict = m.parse_aguments(["install", "osmand/France*", "-f"])
     assert arg_dict["mode"] == "replace_all"
     
+    func, arg_dict = m.parse_aguments(["install", "-j", "4", "osmand/France*"])
+    assert arg_dict["jobs"] == 4
+    
+    func, arg_dict = m.parse_aguments(["install", "-s", "3", "osmand/France*"])
+    assert arg_dict["segments"] == 3
+    
+    func, arg_dict = m.parse_aguments(["install", "-p", "osmand/France*"])
+    assert arg_dict["pipeline"] == True
+    
+    func, arg_dict = m.parse_aguments(["install", "--limit-rate", "20M", 
+                                       "--limit-schedule", "08:00=1M,18:00=off",
+                                       "osmand/France*"])
+    assert arg_dict["limit_rate"] == 20 * 1024**2
+    assert arg_dict["limit_schedule"] == [(datetime.time(8, 0), 1024**2), 
+                                          (datetime.time(18, 0), None)]
+    
+    #Rate 0 only pauses the downloads in a schedule
+    func, arg_dict = m.parse_aguments(["install", "--limit-schedule", 
+                                       "08:00=0,18:00=off", "osmand/France*"])
+    assert arg_dict["limit_schedule"][0] == (datetime.time(8, 0), 0)
+    for bad_args in [["--limit-rate", "0"], ["--limit-schedule", "08:00=0"]]:
+        try:
+            m.parse_aguments(["install"] + bad_args + ["osmand/France*"])
+        except SystemExit:
+            pass
+        else:
+            assert False, "SystemExit expected"
+    
     # uninst --------------------------------------------
     func, arg_dict = m.parse_aguments(["uninst", "osmand/France*"])
     assert func == m.uninstall
+    assert m.needs_servers == False
     assert arg_dict["patterns"] == ["osmand/France*"]
     assert arg_dict["delete_local"] == False
     
@@ -377,18 +1109,146 @@ def test_ConsoleAppMain_parse_aguments():
 #    m.parse_aguments(["lss", "-h"])
     
     
+IMPORT_TIMER = r"""
+import sys
+import time
+import json
+import __builtin__
+
+builtin_import = __builtin__.__import__
+timings = []
+#(depth, name, self time, cumulative time) of each imported module [us]
+stack = []
+#Time spent in the nested imports of the imports, that are running.
+
+def timed_import(name, *args, **kwargs):
+    "Measure the time of imports, that load new modules."
+    if name in sys.modules:
+        return builtin_import(name, *args, **kwargs)
+    entry = [len(stack), name, 0, 0]
+    timings.append(entry)
+    stack.append(0)
+    t_start = time.time()
+    try:
+        return builtin_import(name, *args, **kwargs)
+    finally:
+        cumulative = (time.time() - t_start) * 1e6
+        children = stack.pop()
+        entry[2:] = [cumulative - children, cumulative]
+        if stack:
+            stack[-1] += cumulative
+
+__builtin__.__import__ = timed_import
+t_start = time.time()
+{code}
+total = time.time() - t_start
+__builtin__.__import__ = builtin_import
+print "import time: self [us] | cumulative | imported package"
+for depth, name, self_us, cumulative_us in timings:
+    print "import time: {:9.0f} | {:10.0f} | {}{}".format(
+                            self_us, cumulative_us, "  " * depth, name)
+modules = sorted(name for name, module in sys.modules.items() 
+                 if module is not None)
+print json.dumps({"modules": modules, "total": total})
+"""
+
+
+def run_import_timer(code):
+    """
+    Run ``code`` in a new Python interpreter, and measure the imports.
+    Prints a report like ``python -X importtime``.
+    
+    Returns
+    -------
+    
+    modules: set[str]
+        The modules that were loaded.
+    
+    total: float
+        Time that ``code`` took. [s]
+    """
+    import sys
+    import subprocess
+    import json
+    
+    script = IMPORT_TIMER.replace("{code}", code)
+    output = subprocess.check_output([sys.executable, "-c", script], 
+                                     cwd=relative_path(".."))
+    lines = output.splitlines()
+    print "\n".join(lines[:-1])
+    result = json.loads(lines[-1])
+    return set(result["modules"]), result["total"]
+
+
+def test_ConsoleAppMain_import_time():
+    """
+    ConsoleAppMain: the libraries for HTTP and HTML are only loaded by 
+    commands that access the servers. Prints reports of the import times.
+    """
+    print "Start"
+    app_directory, mobile_device = create_writable_test_dirs("m18")
+    heavy_modules = set(["mob_map_dl.download", "lxml", "lxml.etree", 
+                         "dateutil", "dateutil.parser", "urllib2", "httplib",
+                         "ctypes"])
+    
+    modules, total = run_import_timer("import mob_map_dl.main")
+    print "Import of mob_map_dl.main: {:.3f} s".format(total)
+    assert "mob_map_dl.main" in modules
+    assert modules & heavy_modules == set()
+    
+    #Start of a command that does not access the servers ("lsm")
+    modules, total = run_import_timer(
+        "from mob_map_dl.main import ConsoleAppMain\n"
+        "m = ConsoleAppMain()\n"
+        "func, arg_dict = m.parse_aguments(['lsm'])\n"
+        "m.app.create_low_level_components({a!r}, {d!r}, \n"
+        "        find_devices=m.needs_device, find_servers=m.needs_servers)\n"
+        "assert m.app.downloaders == {{}}\n"
+        "func(**arg_dict)".format(a=app_directory, d=mobile_device))
+    print "Command lsm: {:.3f} s".format(total)
+    #The ``scandir`` backport, which scans the device, needs ``ctypes``.
+    assert modules & heavy_modules <= set(["ctypes"])
+    
+    #The downloaders are only created for commands, that need them. 
+    #Parsing libraries are loaded when lists of maps are parsed.
+    modules, total = run_import_timer(
+        "from mob_map_dl.main import ConsoleAppMain\n"
+        "m = ConsoleAppMain()\n"
+        "func, arg_dict = m.parse_aguments(['lss'])\n"
+        "m.app.create_low_level_components({a!r}, {d!r}, \n"
+        "        find_devices=m.needs_device, find_servers=m.needs_servers)\n"
+        "assert sorted(m.app.downloaders) == ['oam', 'osmand']"
+        .format(a=app_directory, d=mobile_device))
+    print "Start of command lss: {:.3f} s".format(total)
+    assert "mob_map_dl.download" in modules
+    assert "lxml.etree" not in modules and "dateutil" not in modules
+    
+    
 if __name__ == "__main__":
 #    test_AppHighLevel_find_mobile_devices()
+#    test_AppHighLevel_find_mobile_devices_mountinfo()
 #    test_AppHighLevel_get_filtered_map_list()
 #    test_AppHighLevel_download_file()
+#    test_AppHighLevel_download_files()
 #    test_AppHighLevel_install_file()
+#    test_AppHighLevel_install_files()
 #    test_AppHighLevel_delete_file_mobile()
 #    test_AppHighLevel_delete_file_local()
+#    test_AppHighLevel_get_filtered_map_list_patterns()
 #    test_AppHighLevel_plan_work()
+#    test_AppHighLevel_plan_sync()
+#    test_AppHighLevel_plan_sync_benchmark()
 #    test_AppHighLevel_filter_possible_work()
 #    test_AppHighLevel_download_install()
+#    test_AppHighLevel_download_install_pipeline()
+#    test_AppHighLevel_download_install_replan()
+#    test_AppHighLevel_download_install_overlapped()
+#    test_AppHighLevel_download_install_overlapped_refresh()
+#    test_AppHighLevel_download_install_overlapped_interrupt()
+#    test_AppHighLevel_listing_snapshot()
 #    test_AppHighLevel_uninstall()
 #    test_ConsoleAppMain_list_server_maps()
 #    test_ConsoleAppMain_parse_aguments()
+#    test_ConsoleAppMain_import_time()
     
     pass #IGNORE:W0107
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    Mobile Map Downloader - Download maps for your mobile phone.             #
+#                                                                             #
+#    Copyright (C) 2014 by Eike Welk                                          #
+#    eike.welk@gmx.net                                                        #
+#                                                                             #
+#    License: GPL Version 3                                                   #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+###############################################################################
+"""
+Test the ``ratelimit`` module.
+"""
+
+from __future__ import division
+from __future__ import absolute_import              
+
+#For test modules: ----------------------------------------------------------
+import pytest #contains `skip`, `fail`, `raises`, `config`
+
+import time
+import datetime
+
+
+#Set up logging fore useful debug output, and time stamps in UTC.
+import logging
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', 
+                    level=logging.DEBUG)
+#Time stamps must be in UTC
+logging.Formatter.converter = time.gmtime
+
+
+class FakeClock(object):
+    "Clock for ``RateLimiter``, time passes only when ``sleep`` is called."
+    def __init__(self, now):
+        self.now = now
+        self.slept = 0
+        
+    def clock(self):
+        return self.now
+    
+    def sleep(self, duration):
+        self.now += duration
+        self.slept += duration
+        
+        
+def local_timestamp(hour, minute):
+    "Seconds since the epoch, for a time of day (local time) on 2015-06-01."
+    return time.mktime(datetime.datetime(2015, 6, 1, hour, minute).timetuple())
+
+
+def test_parse_rate():
+    "Test parse_rate()"
+    from mob_map_dl.ratelimit import parse_rate
+    
+    print "Start"
+    assert parse_rate("20M") == 20 * 1024**2
+    assert parse_rate("500k") == 500 * 1024
+    assert parse_rate("1.5MB") == 1.5 * 1024**2
+    assert parse_rate("1G") == 1024**3
+    assert parse_rate("1000") == 1000
+    assert parse_rate("0", allow_pause=True) == 0
+    #Rate 0 would pause the downloads forever
+    with pytest.raises(ValueError):
+        parse_rate("0")
+    with pytest.raises(ValueError):
+        parse_rate("0.0k")
+    assert parse_rate("off") is None
+    assert parse_rate("None") is None
+    with pytest.raises(ValueError):
+        parse_rate("20X")
+    with pytest.raises(ValueError):
+        parse_rate("")
+        
+
+def test_parse_schedule():
+    "Test parse_schedule()"
+    from mob_map_dl.ratelimit import parse_schedule
+    
+    print "Start"
+    sched = parse_schedule("18:00=off, 08:00=2M,23:30=0")
+    assert sched == [(datetime.time(8, 0), 2 * 1024**2), 
+                     (datetime.time(18, 0), None), 
+                     (datetime.time(23, 30), 0)]
+    with pytest.raises(ValueError):
+        parse_schedule("8=2M")
+    with pytest.raises(ValueError):
+        parse_schedule("08:00-2M")
+    with pytest.raises(ValueError):
+        parse_schedule("")
+    with pytest.raises(ValueError):
+        parse_schedule("08:00=0,18:00=0")
+        
+        
+def test_RateLimiter_consume():
+    "Test RateLimiter.consume() with a fake clock."
+    from mob_map_dl.ratelimit import RateLimiter
+    
+    print "Start"
+    fake = FakeClock(1000)
+    limiter = RateLimiter(rate=1000, burst_time=0.5)
+    limiter.clock, limiter.sleep = fake.clock, fake.sleep
+    
+    #The average rate is limited
+    for _ in range(100):
+        limiter.consume(100)
+    print "Slept:", fake.slept
+    assert 9.8 < fake.slept < 10.1
+    
+    #Unused bandwidth is saved for ``burst_time`` only
+    fake.now += 100
+    fake.slept = 0
+    limiter.consume(500)
+    assert fake.slept == 0
+    limiter.consume(500)
+    assert fake.slept == 0.5
+    
+    #No limit
+    limiter.set_limit(None)
+    fake.slept = 0
+    for _ in range(100):
+        limiter.consume(10**6)
+    assert fake.slept == 0
+    
+    
+def test_RateLimiter_schedule():
+    "Test RateLimiter with different rates by time of day."
+    from mob_map_dl.ratelimit import RateLimiter, parse_schedule
+    
+    print "Start"
+    schedule = parse_schedule("08:00=1k,18:00=off,23:00=0")
+    limiter = RateLimiter(rate=5, schedule=schedule)
+    assert limiter.current_rate(local_timestamp(7, 59)) == 0
+    assert limiter.current_rate(local_timestamp(8, 0)) == 1024
+    assert limiter.current_rate(local_timestamp(17, 59)) == 1024
+    assert limiter.current_rate(local_timestamp(18, 0)) is None
+    assert limiter.current_rate(local_timestamp(23, 1)) == 0
+    
+    #Downloads are paused until the schedule allows them: 22:00 - 08:00
+    fake = FakeClock(local_timestamp(22, 0))
+    limiter = RateLimiter(schedule=parse_schedule("08:00=1k,22:00=0"))
+    limiter.clock, limiter.sleep = fake.clock, fake.sleep
+    limiter.consume(1024)
+    print "Slept:", fake.slept / 3600, "h"
+    assert 10 * 3600 <= fake.slept <= 10 * 3600 + limiter.pause_interval + 1
+    
+    #Limits that would pause the downloads forever are rejected
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0)
+    with pytest.raises(ValueError):
+        limiter.set_limit(schedule=[(datetime.time(8, 0), 0)])
+    
+    
+def test_RateLimiter_threads():
+    "Test RateLimiter: Several threads share the bandwidth."
+    from mob_map_dl.ratelimit import RateLimiter
+    from mob_map_dl.common import run_parallel
+    
+    print "Start"
+    limiter = RateLimiter(rate=400 * 1024)
+    def transfer(_):
+        for _ in range(10):
+            limiter.consume(10 * 1024)
+    
+    t0 = time.time()
+    _, errors = run_parallel(transfer, range(4), 4)
+    t1 = time.time()
+    print "Time for 400 KiB at 400 KiB/s:", t1 - t0, "s"
+    assert errors == []
+    assert 0.9 < t1 - t0 < 1.5
+    
+    
+if __name__ == "__main__":
+#    test_parse_rate()
+#    test_parse_schedule()
+#    test_RateLimiter_consume()
+    test_RateLimiter_schedule()
+#    test_RateLimiter_threads()
+    
+    pass #IGNORE:W0107